@@ -205,13 +205,13 @@ def deserialise_artifact(encoded):
     # add source dependencies
     for source_id, source_dict in sources_dict.iteritems():
         source = sources[source_id]
-        source.dependencies = [artifacts[aid]
-                               for aid in source_dict['dependencies']]
+        source.dependencies = morphlib.orderedset.OrderedSet(
+            artifacts[aid] for aid in source_dict['dependencies'])
 
     # add artifact dependents
     for artifact_id, artifact in artifacts.iteritems():
         artifact_dict = artifacts_dict[artifact_id]
-        artifact.dependents = [sources[sid]
-                               for sid in artifact_dict['dependents']]
+        artifact.dependents = morphlib.orderedset.OrderedSet(
+            sources[sid] for sid in artifact_dict['dependents'])
 
     return artifacts[root_artifact]
@@ -555,7 +555,8 @@ class WorkerConnection(distbuild.StateMachine):
             filename = '%s.%s' % (kind, self._job.artifact.name)
             suffixes = [filename]
 
-            if kind == 'stratum':
+            morphology = self._job.artifact.source.morphology
+            if morphology.needs_artifact_metadata_cached:
                 suffixes.append(filename + '.meta')
         
         suffixes = [urllib.quote(x) for x in suffixes]
@@ -48,6 +48,8 @@ class Error(cliapp.AppException):
 
 
 import artifact
+import artifactcachecollector
+import artifactcacheindex
 import artifactcachereference
 import artifactresolver
 import artifactsplitrule
@@ -56,35 +58,48 @@ import bins
 import buildbranch
 import buildcommand
 import buildenvironment
+import buildgraphcache
+import buildscheduler
 import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import directorycache
+import downloadmanager
 import extensions
 import extractedtarball
 import fsutils
 import git
 import gitdir
 import gitindex
+import jobserver
+import linkmanifest
 import localartifactcache
 import localrepocache
 import mountableimage
+import morphologycache
 import morphologyfactory
 import morphologyfinder
 import morphology
 import morphloader
 import morphset
+import orderedset
+import prefetcher
+import refcache
 import remoteartifactcache
 import remoterepocache
 import repoaliasresolver
 import savefile
 import source
 import sourcepool
+import sourcepoolsnapshot
 import sourceresolver
+import sourcetreecache
 import stagingarea
 import stopwatch
 import sysbranchdir
 import systemmetadatadir
+import unpackedchunkcache
 import util
 import workspace
 
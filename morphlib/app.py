@@ -15,6 +15,7 @@
 
 
 import cliapp
+import itertools
 import logging
 import os
 import pipes
@@ -47,7 +48,8 @@ defaults = {
             'ssh://git@github.com/%s'),
     ],
     'cachedir': os.path.expanduser('~/.cache/morph'),
-    'max-jobs': morphlib.util.make_concurrency()
+    'max-jobs': morphlib.util.make_concurrency(),
+    'resolve-jobs': 4,
 }
 
 
@@ -83,6 +85,26 @@ class Morph(cliapp.Application):
                               'do not update the cached git repositories '
                               'automatically',
                               group=group_advanced)
+        self.settings.integer(['resolve-jobs'],
+                              'update and resolve refs in at most N git '
+                              'repositories at once (default: %default)',
+                              metavar='N',
+                              default=defaults['resolve-jobs'],
+                              group=group_advanced)
+        self.settings.integer(['ref-cache-ttl'],
+                              'reuse what named refs resolved to for up to '
+                              'SECONDS seconds, without updating git '
+                              'repositories or asking the cache server; '
+                              '0 disables this (default: %default)',
+                              metavar='SECONDS',
+                              default=0,
+                              group=group_advanced)
+        self.settings.string_list(['ref-cache-refresh'],
+                                  'always resolve named refs in REPO again, '
+                                  'ignoring --ref-cache-ttl',
+                                  metavar='REPO',
+                                  default=[],
+                                  group=group_advanced)
         self.settings.boolean(['build-log-on-stdout'],
                               'write build log on stdout',
                               group=group_advanced)
@@ -107,6 +129,13 @@ class Morph(cliapp.Application):
             metavar='URL',
             default=None,
             group=group_advanced)
+        self.settings.integer(
+            ['artifact-download-jobs'],
+            'download at most N files from the artifact cache server '
+            'at once (default: %default)',
+            metavar='N',
+            default=4,
+            group=group_advanced)
         self.settings.string(
             ['git-resolve-cache-server'],
             'HTTP URL for the git ref resolving cache server; '
@@ -130,6 +159,40 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['max-parallel-builds'],
+                              'build at most N chunks or strata at once, '
+                              'each in its own staging area, sharing the '
+                              'max-jobs make jobs between them '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
+        self.settings.boolean(['no-jobserver'],
+                              'give each make its own max-jobs jobs, '
+                              'instead of sharing them between all the '
+                              'makes running at once through a jobserver',
+                              group=group_build)
+        self.settings.integer(['prefetch-sources'],
+                              'while building, fetch cached artifacts and '
+                              'git repos for the next N sources in the '
+                              'background; 0 disables this '
+                              '(default: %default)',
+                              metavar='N',
+                              default=3,
+                              group=group_build)
+        self.settings.integer(['prefetch-jobs'],
+                              'run at most N background fetches at once '
+                              '(default: %default)',
+                              metavar='N',
+                              default=2,
+                              group=group_build)
+        self.settings.bytesize(['prefetch-bandwidth'],
+                               'download artifacts in the background at '
+                               'most SIZE bytes per second in total; '
+                               '0 means no limit (default: %default)',
+                               metavar='SIZE',
+                               default='0',
+                               group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
@@ -170,6 +233,56 @@ class Morph(cliapp.Application):
                              metavar='DIR',
                              group=group_storage,
                              default=None)
+        self.settings.bytesize(['morphology-cache-max-size'],
+                               'keep at most SIZE bytes of parsed '
+                               'morphologies in CACHEDIR/morphologies; '
+                               '0 disables the cache (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='64M')
+        self.settings.integer(['staging-link-jobs'],
+                              'link files into staging areas using N '
+                              'threads (default: %default)',
+                              metavar='N',
+                              group=group_storage,
+                              default=1)
+        self.settings.boolean(['staging-overlayfs'],
+                              'stack the chunks in staging areas with '
+                              'overlayfs instead of hardlinking their files, '
+                              'if the kernel supports it',
+                              group=group_storage)
+        self.settings.integer(['staging-templates'],
+                              'keep up to N staging areas, as they are '
+                              'before building, in TEMPDIR/chunks, to copy '
+                              'for later builds with the same dependencies; '
+                              '0 disables this (default: %default)',
+                              metavar='N',
+                              group=group_storage,
+                              default=4)
+        self.settings.bytesize(['chunk-cache-max-size'],
+                               'keep at most SIZE bytes of chunks unpacked '
+                               'for staging areas in TEMPDIR/chunks, '
+                               'removing the least recently used; 0 for no '
+                               'limit (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
+        self.settings.bytesize(['source-cache-max-size'],
+                               'keep at most SIZE bytes of extracted source '
+                               'trees in TEMPDIR/sources, to copy instead of '
+                               'checking them out again, removing the least '
+                               'recently used; 0 disables the cache '
+                               '(default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='4G')
+        self.settings.bytesize(['build-graph-cache-max-size'],
+                               'keep at most SIZE bytes of resolved build '
+                               'graphs in CACHEDIR/build-graphs; '
+                               '0 disables the cache (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='256M')
         # The tempdir default size of 4G comes from the staging area needing to
         # be the size of the largest known system, plus the largest repository,
         # plus the largest working directory.
@@ -264,6 +377,7 @@ class Morph(cliapp.Application):
 
         tmpdir = self.settings['tempdir']
         for required_dir in (os.path.join(tmpdir, 'chunks'),
+                             os.path.join(tmpdir, 'sources'),
                              os.path.join(tmpdir, 'staging'),
                              os.path.join(tmpdir, 'failed'),
                              os.path.join(tmpdir, 'deployments'),
@@ -298,24 +412,41 @@ class Morph(cliapp.Application):
             args = args[3:]
 
     def cache_repo_and_submodules(self, cache, url, ref, done):
-        subs_to_process = set()
-        subs_to_process.add((url, ref))
-        while subs_to_process:
-            url, ref = subs_to_process.pop()
-            done.add((url, ref))
+        def cache_repo_and_list_submodules(item):
+            url, refs = item
             cached_repo = cache.cache_repo(url)
             cached_repo.update()
 
-            try:
-                submodules = morphlib.git.Submodules(self, cached_repo.path,
-                                                     ref)
-                submodules.load()
-            except morphlib.git.NoModulesFileError:
-                pass
-            else:
-                for submod in submodules:
-                    if (submod.url, submod.commit) not in done:
-                        subs_to_process.add((submod.url, submod.commit))
+            found = []
+            for ref in refs:
+                try:
+                    submodules = morphlib.git.Submodules(
+                        self, cached_repo.path, ref)
+                    submodules.load()
+                except morphlib.git.NoModulesFileError:
+                    pass
+                else:
+                    found.extend((submod.url, submod.commit)
+                                 for submod in submodules)
+            return found
+
+        # Each round updates a set of independent repos concurrently. All
+        # refs wanted from the same repo are handled by a single worker, so
+        # no two workers ever touch the same cached repo. Different URLs,
+        # such as a repo alias and what it expands to, may name the same
+        # repo, so the refs are grouped by the URL the repo is pulled from.
+        subs_to_process = set([(url, ref)])
+        while subs_to_process:
+            done.update(subs_to_process)
+            refs_by_repo = {}
+            for url, ref in sorted(subs_to_process):
+                pull_url = cache._resolver.pull_url(url)
+                refs_by_repo.setdefault(pull_url, (url, []))[1].append(ref)
+            found = morphlib.util.map_concurrently(
+                cache_repo_and_list_submodules, sorted(refs_by_repo.values()),
+                self.settings['resolve-jobs'])
+            subs_to_process = set(itertools.chain.from_iterable(found))
+            subs_to_process.difference_update(done)
 
     def _write_status(self, text):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
@@ -14,6 +14,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import morphlib
+
+
 class Artifact(object):
 
     '''Represent a build result generated from a source.
@@ -22,14 +25,21 @@ class Artifact(object):
 
     * ``source`` -- the source from which the artifact is built
     * ``name`` -- the name of the artifact
-    * ``dependents`` -- list of Sources that need this Artifact to be built
+    * ``dependents`` -- OrderedSet of Sources that need this Artifact to be
+      built
+
+    Like Source, artifacts keep their attributes in slots, with a dict only
+    for any other attributes attached to them.
 
     '''
 
+    __slots__ = ('source', 'name', 'dependents', 'arch', 'build_env',
+                 'state', '__dict__')
+
     def __init__(self, source, name):
         self.source = source
         self.name = name
-        self.dependents = []
+        self.dependents = morphlib.orderedset.OrderedSet()
 
     def basename(self):  # pragma: no cover
         return '%s.%s' % (self.source.basename(), str(self.name))
@@ -46,20 +56,23 @@ class Artifact(object):
 
     def walk(self): # pragma: no cover
         '''Return list of an artifact and its build dependencies.
-        
+
         The artifacts are returned in depth-first order: an artifact
         is returned only after all of its dependencies.
-        
+
         '''
-        
-        done = set()
-        
-        def depth_first(a):
-            if a not in done:
-                done.add(a)
-                for dep in a.source.dependencies:
-                    for ret in depth_first(dep):
-                        yield ret
-                yield a
-
-        return list(depth_first(self))
+
+        done = set([self])
+        result = []
+        stack = [(self, iter(self.source.dependencies))]
+        while stack:
+            artifact, dependencies = stack[-1]
+            for dep in dependencies:
+                if dep not in done:
+                    done.add(dep)
+                    stack.append((dep, iter(dep.source.dependencies)))
+                    break
+            else:
+                stack.pop()
+                result.append(artifact)
+        return result
@@ -58,3 +58,21 @@ class ArtifactTests(unittest.TestCase):
 
     def test_sets_dependents_to_empty(self):
         self.assertEqual(self.artifact.dependents, [])
+
+    def test_walks_dependencies_first(self):
+        self.source.add_dependency(self.other)
+        self.assertEqual(self.artifact.walk(), [self.other, self.artifact])
+
+    def test_walks_deep_graphs(self):
+        artifact = self.artifact
+        for i in xrange(2000):
+            source, = morphlib.source.make_sources(
+                'repo', 'ref', 'chunk-%d.morph' % i, 'sha1', 'tree',
+                self.source.morphology)
+            dependency = source.artifacts[self.artifact_name]
+            artifact.source.add_dependency(dependency)
+            artifact = dependency
+        walked = self.artifact.walk()
+        self.assertEqual(len(walked), 2001)
+        self.assertEqual(walked[0], artifact)
+        self.assertEqual(walked[-1], self.artifact)
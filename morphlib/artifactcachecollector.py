@@ -0,0 +1,175 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import json
+import logging
+import time
+
+from morphlib.artifactcachereference import ArtifactCacheReference
+
+
+CachedSource = collections.namedtuple(
+    'CachedSource', ('cachekey', 'size', 'last_used'))
+
+
+class ArtifactCacheCollector(object):
+
+    '''Choose which sources to remove to keep the artifact cache in a budget.
+
+    Sources are removed least recently used first, but a source counts as
+    used whenever a stratum or system that refers to it was, so that the
+    chunks of a recently used system are kept for as long as the system
+    is. Where several sources were last used at the same time, systems are
+    removed before strata, and strata before chunks, so a stratum or system
+    is never kept without what it refers to.
+
+    What strata and systems refer to is read from their artifacts and
+    metadata the first time it is needed, and kept in the artifact cache
+    index. Reading can be limited, to bound the work done at once: any
+    source which a stratum or system not yet read might refer to is then
+    kept. The same goes for strata and systems whose references cannot be
+    read, which are tried again next time.
+
+    The index is first made to match the cache directory, so that files
+    written there or removed by other programs are taken into account.
+
+    '''
+
+    def __init__(self, lac, clock=time.time):
+        self.lac = lac
+        self._clock = clock
+
+    def plan(self, budget, keep_younger_than=0, max_removals=0,
+             max_reads=0):
+        '''Choose the sources to remove to bring the cache within budget.
+
+        Sources used in the last `keep_younger_than` seconds are kept,
+        even if the cache stays over budget. At most `max_removals` sources
+        are chosen, and the references of at most `max_reads` strata and
+        systems are read; 0 means no limit.
+
+        Returns a list of CachedSource for the sources to remove, in the
+        order to remove them, with the time their closure was last used,
+        and the size the cache will have after removing them.
+
+        '''
+
+        self.lac.flush()
+        self.lac.index.reconcile()
+        files = collections.defaultdict(set)
+        sizes = collections.defaultdict(int)
+        last_used = collections.defaultdict(float)
+        for cachekey, filename, size, used in self.lac.index.contents():
+            files[cachekey].add(filename[len(cachekey) + 1:])
+            sizes[cachekey] += size
+            last_used[cachekey] = max(last_used[cachekey], used)
+
+        references = self.lac.index.references()
+        unread = sorted((cachekey for cachekey in files
+                         if cachekey not in references and
+                         self._kind(files[cachekey]) != 'chunk'),
+                        key=lambda k: last_used[k], reverse=True)
+        if max_reads > 0:
+            unread, to_read = unread[max_reads:], unread[:max_reads]
+        else:
+            unread, to_read = [], unread
+        for cachekey in to_read:
+            referenced = self._read_references(cachekey, files[cachekey])
+            if referenced is None:
+                # Try again next time, when the file may be there.
+                unread.append(cachekey)
+            else:
+                references[cachekey] = referenced
+                self.lac.index.set_references(cachekey, referenced)
+
+        closure_used = self._closure_last_used(last_used, references)
+        # Anything newer than this may be referred to by a stratum or system
+        # whose references are still to be read.
+        unsafe_before = max([last_used[k] for k in unread] or [None])
+        keep_after = self._clock() - keep_younger_than
+        rank = {'system': 0, 'stratum': 1, 'chunk': 2}
+        order = sorted(files, key=lambda k: (closure_used[k],
+                                             rank[self._kind(files[k])]))
+
+        total = sum(sizes.itervalues())
+        removals = []
+        for cachekey in order:
+            if total <= budget or closure_used[cachekey] >= keep_after:
+                break
+            if max_removals > 0 and len(removals) >= max_removals:
+                break
+            if (unsafe_before is not None and
+                    closure_used[cachekey] < unsafe_before):
+                continue
+            removals.append(CachedSource(cachekey, sizes[cachekey],
+                                         closure_used[cachekey]))
+            total -= sizes[cachekey]
+        return removals, total
+
+    @staticmethod
+    def _kind(filenames):
+        '''Return whether the files are of a system, stratum or other.'''
+
+        for filename in filenames:
+            kind = filename.split('.', 1)[0]
+            if kind in ('system', 'stratum'):
+                return kind
+        return 'chunk'
+
+    @staticmethod
+    def _closure_last_used(last_used, references):
+        '''Count every use of a source as a use of what it refers to.'''
+
+        closure_used = dict(last_used)
+        stack = list(closure_used)
+        while stack:
+            cachekey = stack.pop()
+            for referenced in references.get(cachekey, ()):
+                if (referenced in closure_used and
+                        closure_used[referenced] < closure_used[cachekey]):
+                    closure_used[referenced] = closure_used[cachekey]
+                    stack.append(referenced)
+        return closure_used
+
+    def _read_references(self, cachekey, filenames):
+        '''Return the cache keys a stratum or system refers to.
+
+        A stratum artifact is a list of the chunk artifacts in it, and the
+        metadata of a system artifact lists the stratum artifacts in it.
+        Returns None if any of them is missing or cannot be read, as for a
+        system fetched from a remote cache without its metadata.
+
+        '''
+
+        referenced = set()
+        for filename in filenames:
+            kind = filename.split('.', 1)[0]
+            if kind not in ('stratum', 'system') or filename.endswith('.meta'):
+                continue
+            path = filename if kind == 'stratum' else filename + '.meta'
+            reference = ArtifactCacheReference('%s.%s' % (cachekey, path))
+            try:
+                with open(self.lac.artifact_filename(reference)) as f:
+                    data = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.warning('Could not read references from %s: %s' %
+                                (reference.basename(), e))
+                return None
+            if kind == 'system':
+                data = data.get('contents', [])
+            referenced.update(basename.split('.', 1)[0] for basename in data)
+        return referenced
@@ -0,0 +1,184 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import fs.tempfs
+
+import morphlib
+
+
+class ArtifactCacheCollectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.tempdir = tempfile.mkdtemp()
+        self.lac = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, os.path.join(self.tempdir, 'artifacts.index'))
+        self.now = 1000.0
+        self.collector = morphlib.artifactcachecollector.\
+            ArtifactCacheCollector(self.lac, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.tempfs.close()
+        shutil.rmtree(self.tempdir)
+
+    def put(self, basename, data, last_used):
+        with open(self.tempfs.getsyspath(basename), 'w') as f:
+            f.write(data)
+        self.lac.index.add(basename, len(data), last_used=last_used)
+
+    def put_chunk(self, cachekey, size, last_used):
+        self.put('%s.chunk.foo-runtime' % cachekey, 'x' * size, last_used)
+
+    def put_stratum(self, cachekey, chunk_keys, last_used):
+        basename = '%s.stratum.core-runtime' % cachekey
+        self.put(basename, json.dumps(['%s.chunk.foo-runtime' % key
+                                       for key in chunk_keys]), last_used)
+        self.put(basename + '.meta', '{}', last_used)
+
+    def put_system(self, cachekey, stratum_keys, last_used):
+        basename = '%s.system.base-rootfs' % cachekey
+        self.put(basename, 'x' * 100, last_used)
+        self.put(basename + '.meta', json.dumps({
+            'contents': ['%s.stratum.core-runtime' % key
+                         for key in stratum_keys]}), last_used)
+
+    def plan(self, budget, **kwargs):
+        removals, remaining = self.collector.plan(budget, **kwargs)
+        return [source.cachekey for source in removals], remaining
+
+    def test_removes_nothing_within_budget(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.assertEqual(self.plan(10), ([], 10))
+
+    def test_removes_least_recently_used_first(self):
+        self.put_chunk('a' * 64, 10, 2)
+        self.put_chunk('b' * 64, 10, 1)
+        self.put_chunk('c' * 64, 10, 3)
+        self.assertEqual(self.plan(15), (['b' * 64, 'a' * 64], 10))
+
+    def test_keeps_chunks_of_recently_used_system(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_chunk('b' * 64, 10, 2)
+        self.put_stratum('s' * 64, ['a' * 64], 3)
+        self.put_system('y' * 64, ['s' * 64], 950)
+        removals, remaining = self.plan(0, keep_younger_than=100)
+        self.assertEqual(removals, ['b' * 64])
+
+    def test_removes_system_before_what_it_refers_to(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_stratum('s' * 64, ['a' * 64], 2)
+        self.put_system('y' * 64, ['s' * 64], 3)
+        removals, remaining = self.plan(0)
+        self.assertEqual(removals, ['y' * 64, 's' * 64, 'a' * 64])
+        self.assertEqual(remaining, 0)
+
+    def test_keeps_recently_used_sources(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_chunk('b' * 64, 10, 950)
+        self.assertEqual(self.plan(0, keep_younger_than=100),
+                         (['a' * 64], 10))
+
+    def test_removes_at_most_max_removals(self):
+        for key in 'abc':
+            self.put_chunk(key * 64, 10, 1)
+        removals, remaining = self.plan(0, max_removals=2)
+        self.assertEqual(len(removals), 2)
+        self.assertEqual(remaining, 10)
+
+    def test_keeps_what_unread_strata_may_refer_to(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_chunk('b' * 64, 10, 1)
+        self.put_stratum('s' * 64, ['a' * 64], 3)
+        self.put_stratum('t' * 64, ['b' * 64], 2)
+        removals, remaining = self.plan(0, max_reads=1)
+        self.assertEqual(removals, ['t' * 64, 's' * 64, 'a' * 64])
+
+        for cachekey in removals:
+            self.lac.remove(cachekey)
+        removals, remaining = self.plan(0, max_reads=1)
+        self.assertEqual(removals, ['b' * 64])
+
+    def test_remembers_references(self):
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_stratum('s' * 64, ['a' * 64], 3)
+        self.plan(1000)
+        self.assertEqual(self.lac.index.references(),
+                         {'s' * 64: set(['a' * 64])})
+
+    def test_counts_files_missing_from_the_index(self):
+        self.put_chunk('a' * 64, 10, 2)
+        with open(self.tempfs.getsyspath('b' * 64 + '.chunk.foo-runtime'),
+                  'w') as f:
+            f.write('x' * 10)
+        os.utime(self.tempfs.getsyspath('b' * 64 + '.chunk.foo-runtime'),
+                 (1, 1))
+        self.assertEqual(self.plan(15), (['b' * 64], 10))
+
+    def test_ignores_indexed_files_no_longer_there(self):
+        self.put_chunk('a' * 64, 10, 2)
+        self.put_chunk('b' * 64, 10, 1)
+        os.remove(self.tempfs.getsyspath('b' * 64 + '.chunk.foo-runtime'))
+        self.assertEqual(self.plan(15), ([], 10))
+
+    def test_keeps_what_an_unreadable_stratum_may_refer_to(self):
+        self.put_chunk('a' * 64, 10, 1)
+        basename = '%s.stratum.core-runtime' % ('s' * 64)
+        self.put(basename, 'not json', 3)
+        removals, remaining = self.plan(0)
+        self.assertEqual(removals, ['s' * 64])
+        self.assertEqual(self.lac.index.references(), {})
+
+    def test_reads_stratum_references_without_its_metadata(self):
+        self.put_chunk('a' * 64, 10, 1)
+        basename = '%s.stratum.core-runtime' % ('s' * 64)
+        self.put(basename, json.dumps(['%s.chunk.foo-runtime' % ('a' * 64)]),
+                 3)
+        self.plan(1000)
+        self.assertEqual(self.lac.index.references(),
+                         {'s' * 64: set(['a' * 64])})
+
+    def test_keeps_closure_of_system_without_metadata(self):
+        # As for a system fetched from a remote cache which lacked it.
+        self.put_chunk('a' * 64, 10, 1)
+        self.put_stratum('s' * 64, ['a' * 64], 2)
+        self.put('%s.system.base-rootfs' % ('y' * 64), 'x' * 100, 990)
+        removals, remaining = self.plan(50, keep_younger_than=100)
+        self.assertEqual(removals, [])
+        self.assertEqual(self.lac.index.references(),
+                         {'s' * 64: set(['a' * 64])})
+
+        self.put('%s.system.base-rootfs.meta' % ('y' * 64),
+                 json.dumps({'contents': ['%s.stratum.core-runtime' %
+                                          ('s' * 64)]}), 990)
+        self.plan(50, keep_younger_than=100)
+        self.assertEqual(self.lac.index.references()['y' * 64],
+                         set(['s' * 64]))
+
+    def test_reads_references_only_from_strata_and_systems(self):
+        self.put_stratum('s' * 64, ['a' * 64], 3)
+        basename = '%s.chunk.foo-runtime' % ('s' * 64)
+        self.put(basename, json.dumps(['%s.chunk.foo-runtime' % ('b' * 64)]),
+                 3)
+        self.put(basename + '.meta', '{}', 3)
+        self.plan(1000)
+        self.assertEqual(self.lac.index.references(),
+                         {'s' * 64: set(['a' * 64])})
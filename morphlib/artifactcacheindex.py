@@ -0,0 +1,290 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+
+# Files in the cache are named after the cache key of their source, except
+# for the temporary files SaveFile writes to.
+_cache_filename = re.compile(r'^[0-9a-f]{64}\.')
+
+
+class ArtifactCacheIndex(object):
+
+    '''Record which files are in the local artifact cache.
+
+    The index is an SQLite database, which records the cache key, size and
+    last time of use of every file in the cache directory. Finding the
+    files of a cache key, or listing the whole cache, is then a lookup
+    instead of a walk over the directory.
+
+    The first time an index is opened, the files already in the directory
+    are added to it, using their modification times as the time they were
+    last used, which is what the cache used before. Files written to or
+    removed from the directory without going through the index, for example
+    by morph-cache-server, are picked up by reconcile().
+
+    Each thread and each process gets its own connection, as SQLite
+    connections must not be shared between them. Several Morph processes
+    can use the same index at once. The cache directory is often on NFS,
+    so the index uses SQLite's default rollback journal: WAL mode needs
+    shared memory, which NFS does not provide.
+
+    '''
+
+    def __init__(self, path, dirname):
+        self.path = path
+        self.dirname = dirname
+        self._local = threading.local()
+        # Connections inherited from a parent process must not be closed,
+        # or even garbage collected, by the child.
+        self._inherited = []
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        if connection is not None:
+            self._inherited.append(connection)
+
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.text_factory = str
+        self._setup(connection)
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    def _setup(self, connection):
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'filename TEXT PRIMARY KEY, '
+                'cachekey TEXT NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'last_used REAL NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS files_by_cachekey '
+                'ON files (cachekey)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS settings ('
+                'name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            # The cache keys each source refers to, for the sources whose
+            # references have been read. Sources are never changed once
+            # cached, so neither are their references.
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS references_read ('
+                'cachekey TEXT PRIMARY KEY)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS source_references ('
+                'cachekey TEXT NOT NULL, '
+                'referenced TEXT NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS source_references_by_cachekey '
+                'ON source_references (cachekey)')
+
+        if self._get_setting(connection, 'scanned') is None:
+            # Taking the write lock first stops two processes from adding
+            # the existing files at the same time.
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                if self._get_setting(connection, 'scanned') is None:
+                    self._add_existing_files(connection)
+                    connection.execute(
+                        'INSERT INTO settings VALUES (?, ?)',
+                        ('scanned', str(time.time())))
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+
+    @staticmethod
+    def _get_setting(connection, name):
+        row = connection.execute('SELECT value FROM settings WHERE name = ?',
+                                 (name,)).fetchone()
+        return row[0] if row else None
+
+    def _add_existing_files(self, connection):
+        logging.info('Indexing the artifact cache in %s' % self.dirname)
+        rows = self._scan(os.listdir(self.dirname))
+        connection.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', rows)
+        logging.info('Indexed %d files' % len(rows))
+
+    def _scan(self, filenames):
+        '''Return a row of the files table for each cache file named.'''
+
+        rows = []
+        for filename in filenames:
+            if not _cache_filename.match(filename):
+                continue
+            try:
+                st = os.stat(os.path.join(self.dirname, filename))
+            except OSError:
+                continue
+            rows.append((filename, self._cachekey(filename), st.st_size,
+                         st.st_mtime))
+        return rows
+
+    @staticmethod
+    def _cachekey(filename):
+        return filename.split('.', 1)[0]
+
+    def reconcile(self):
+        '''Make the index match the files in the cache directory.
+
+        Files in the directory but not in the index are added, using their
+        modification times as the time they were last used, and files in
+        the index but no longer in the directory are forgotten.
+
+        '''
+
+        connection = self._connection()
+        # The directory is listed with the write lock held, so that a file
+        # added to the index while it is listed is not forgotten.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            indexed = set(row[0] for row in
+                          connection.execute('SELECT filename FROM files'))
+            present = set(os.listdir(self.dirname))
+            rows = self._scan(present - indexed)
+            connection.executemany(
+                'INSERT INTO files VALUES (?, ?, ?, ?)', rows)
+            gone = indexed - present
+            connection.executemany('DELETE FROM files WHERE filename = ?',
+                                   ((filename,) for filename in gone))
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        if rows or gone:
+            logging.info('Added %d files to the index of %s and forgot %d' %
+                         (len(rows), self.dirname, len(gone)))
+
+    def add(self, filename, size, last_used=None):
+        '''Record that a file is in the cache.'''
+
+        if last_used is None:
+            last_used = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                (filename, self._cachekey(filename), size, last_used))
+
+    def record_uses(self, uses, gone, size_of):
+        '''Record when files were used, and which files were not found.
+
+        `uses` maps file names to the time they were last used, and `gone`
+        is a list of files which are no longer in the cache. A file which
+        was used but is not in the index is added, with the size returned
+        by `size_of`, unless that returns None. Everything is recorded in a
+        single transaction.
+
+        '''
+
+        connection = self._connection()
+        with connection:
+            for filename, last_used in uses.iteritems():
+                cursor = connection.execute(
+                    'UPDATE files SET last_used = MAX(last_used, ?) '
+                    'WHERE filename = ?', (last_used, filename))
+                if cursor.rowcount > 0:
+                    continue
+                size = size_of(filename)
+                if size is not None:
+                    connection.execute(
+                        'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                        (filename, self._cachekey(filename), size,
+                         last_used))
+            connection.executemany('DELETE FROM files WHERE filename = ?',
+                                   ((filename,) for filename in gone))
+
+    def discard(self, filename):
+        '''Record that a file is no longer in the cache.'''
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM files WHERE filename = ?',
+                               (filename,))
+
+    def files(self, cachekey):
+        '''Return the names of the files of a cache key.'''
+
+        return [row[0] for row in self._connection().execute(
+            'SELECT filename FROM files WHERE cachekey = ?', (cachekey,))]
+
+    def remove(self, cachekey):
+        '''Forget all the files of a cache key.'''
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM files WHERE cachekey = ?',
+                               (cachekey,))
+            connection.execute('DELETE FROM references_read '
+                               'WHERE cachekey = ?', (cachekey,))
+            connection.execute('DELETE FROM source_references '
+                               'WHERE cachekey = ?', (cachekey,))
+
+    def contents(self):
+        '''Return (cachekey, filename, size, last_used) for every file.'''
+
+        return self._connection().execute(
+            'SELECT cachekey, filename, size, last_used FROM files '
+            'ORDER BY cachekey').fetchall()
+
+    def set_references(self, cachekey, referenced):
+        '''Record the cache keys a source refers to.'''
+
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO references_read '
+                               'VALUES (?)', (cachekey,))
+            connection.execute('DELETE FROM source_references '
+                               'WHERE cachekey = ?', (cachekey,))
+            connection.executemany(
+                'INSERT INTO source_references VALUES (?, ?)',
+                ((cachekey, key) for key in set(referenced)))
+
+    def references(self):
+        '''Return the references of every source they are known for.
+
+        The result is a dict of cache keys to sets of the cache keys they
+        refer to.
+
+        '''
+
+        connection = self._connection()
+        references = dict(
+            (row[0], set()) for row in
+            connection.execute('SELECT cachekey FROM references_read'))
+        for cachekey, referenced in connection.execute(
+                'SELECT cachekey, referenced FROM source_references'):
+            references.setdefault(cachekey, set()).add(referenced)
+        return references
+
+    def clear(self):
+        '''Forget every file.'''
+
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM files')
+            connection.execute('DELETE FROM references_read')
+            connection.execute('DELETE FROM source_references')
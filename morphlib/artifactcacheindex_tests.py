@@ -0,0 +1,216 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import morphlib
+
+
+class ArtifactCacheIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'artifacts')
+        os.mkdir(self.dirname)
+        self.path = os.path.join(self.tempdir, 'artifacts.index')
+        self.key1 = '1' * 64
+        self.key2 = '2' * 64
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_index(self):
+        return morphlib.artifactcacheindex.ArtifactCacheIndex(
+            self.path, self.dirname)
+
+    def test_is_empty_initially(self):
+        self.assertEqual(self.new_index().contents(), [])
+
+    def test_adds_existing_files_when_first_opened(self):
+        with open(os.path.join(self.dirname, self.key1 + '.foo'), 'w') as f:
+            f.write('data')
+        os.utime(os.path.join(self.dirname, self.key1 + '.foo'), (10, 20))
+        with open(os.path.join(self.dirname, 'tmpABCDEF'), 'w') as f:
+            pass
+
+        index = self.new_index()
+        self.assertEqual(index.contents(),
+                         [(self.key1, self.key1 + '.foo', 4, 20)])
+
+    def test_adds_existing_files_only_once(self):
+        self.new_index().contents()
+        with open(os.path.join(self.dirname, self.key1 + '.foo'), 'w') as f:
+            f.write('data')
+        self.assertEqual(self.new_index().contents(), [])
+
+    def test_finds_files_by_cache_key(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.add(self.key1 + '.bar', 2)
+        index.add(self.key2 + '.foo', 3)
+        self.assertEqual(sorted(index.files(self.key1)),
+                         [self.key1 + '.bar', self.key1 + '.foo'])
+
+    def test_removes_files_by_cache_key(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.add(self.key2 + '.foo', 3)
+        index.remove(self.key1)
+        self.assertEqual(index.files(self.key1), [])
+        self.assertEqual(index.files(self.key2), [self.key2 + '.foo'])
+
+    def test_records_uses(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1, last_used=10)
+        index.add(self.key1 + '.bar', 2, last_used=10)
+        index.record_uses({self.key1 + '.foo': 20}, [], lambda f: None)
+        self.assertEqual(sorted(index.contents()),
+                         [(self.key1, self.key1 + '.bar', 2, 10),
+                          (self.key1, self.key1 + '.foo', 1, 20)])
+
+    def test_keeps_latest_use(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1, last_used=30)
+        index.record_uses({self.key1 + '.foo': 20}, [], lambda f: None)
+        self.assertEqual(index.contents(),
+                         [(self.key1, self.key1 + '.foo', 1, 30)])
+
+    def test_adds_used_files_not_in_index(self):
+        index = self.new_index()
+        index.record_uses({self.key1 + '.foo': 20, self.key1 + '.bar': 20},
+                          [], lambda f: 5 if f.endswith('.foo') else None)
+        self.assertEqual(index.contents(),
+                         [(self.key1, self.key1 + '.foo', 5, 20)])
+
+    def test_records_files_gone(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.add(self.key1 + '.bar', 2)
+        index.record_uses({}, [self.key1 + '.foo'], lambda f: None)
+        self.assertEqual(index.files(self.key1), [self.key1 + '.bar'])
+
+    def test_discards_file(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.discard(self.key1 + '.foo')
+        self.assertEqual(index.contents(), [])
+
+    def test_is_shared_between_instances(self):
+        self.new_index().add(self.key1 + '.foo', 1)
+        self.assertEqual(self.new_index().files(self.key1),
+                         [self.key1 + '.foo'])
+
+    def test_can_be_used_from_several_threads(self):
+        index = self.new_index()
+
+        def add(i):
+            index.add('%s.%d' % (self.key1, i), i)
+
+        threads = [threading.Thread(target=add, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(index.files(self.key1)), 4)
+
+    def test_records_references(self):
+        index = self.new_index()
+        index.set_references(self.key1, [self.key2, self.key2])
+        index.set_references(self.key2, [])
+        self.assertEqual(index.references(),
+                         {self.key1: set([self.key2]), self.key2: set()})
+
+    def test_forgets_references_of_removed_source(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.set_references(self.key1, [self.key2])
+        index.remove(self.key1)
+        self.assertEqual(index.references(), {})
+
+    def test_does_not_add_dangling_symlinks(self):
+        os.symlink('missing', os.path.join(self.dirname, self.key1 + '.foo'))
+        self.assertEqual(self.new_index().contents(), [])
+
+    def test_adds_existing_files_again_after_failing(self):
+        os.rmdir(self.dirname)
+        self.assertRaises(OSError, self.new_index().contents)
+        os.mkdir(self.dirname)
+        with open(os.path.join(self.dirname, self.key1 + '.foo'), 'w') as f:
+            f.write('data')
+        self.assertEqual(self.new_index().files(self.key1),
+                         [self.key1 + '.foo'])
+
+    def test_reconcile_adds_files_written_behind_its_back(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1, last_used=10)
+        with open(os.path.join(self.dirname, self.key1 + '.foo'), 'w') as f:
+            f.write('data')
+        with open(os.path.join(self.dirname, self.key2 + '.foo'), 'w') as f:
+            f.write('data')
+        os.utime(os.path.join(self.dirname, self.key2 + '.foo'), (10, 20))
+        with open(os.path.join(self.dirname, 'tmpABCDEF'), 'w') as f:
+            pass
+        index.reconcile()
+        self.assertEqual(index.contents(),
+                         [(self.key1, self.key1 + '.foo', 1, 10),
+                          (self.key2, self.key2 + '.foo', 4, 20)])
+
+    def test_reconcile_forgets_files_removed_behind_its_back(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.reconcile()
+        self.assertEqual(index.contents(), [])
+
+    def test_reconcile_changes_nothing_if_listing_fails(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        os.rmdir(self.dirname)
+        self.assertRaises(OSError, index.reconcile)
+        self.assertEqual(index.files(self.key1), [self.key1 + '.foo'])
+
+    def test_keeps_connection_inherited_from_parent_process(self):
+        index = self.new_index()
+        parent_connection = index._connection()
+        # Pretend the connection was opened by a parent process.
+        index._local.pid = -1
+        index.add(self.key1 + '.foo', 1)
+        self.assertNotEqual(index._connection(), parent_connection)
+        self.assertEqual(index._inherited, [parent_connection])
+        self.assertEqual(index.files(self.key1), [self.key1 + '.foo'])
+
+    def test_does_not_use_write_ahead_log(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['artifacts', 'artifacts.index'])
+
+    def test_clears_files(self):
+        index = self.new_index()
+        index.add(self.key1 + '.foo', 1)
+        index.add(self.key2 + '.foo', 1)
+        index.clear()
+        self.assertEqual(index.contents(), [])
+
+    def test_clears_references(self):
+        index = self.new_index()
+        index.set_references(self.key1, [self.key2])
+        index.clear()
+        self.assertEqual(index.references(), {})
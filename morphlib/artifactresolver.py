@@ -28,6 +28,14 @@ class MutualDependencyError(cliapp.AppException):
             self, 'Cyclic dependency between %s and %s detected' % (a, b))
 
 
+class DependencyCycleError(cliapp.AppException):
+
+    def __init__(self, cycle):
+        cliapp.AppException.__init__(
+            self, 'Cyclic dependency detected: %s' %
+            ' -> '.join(str(source) for source in cycle))
+
+
 class DependencyOrderError(cliapp.AppException):
 
     def __init__(self, stratum_source, chunk, dependency_name):
@@ -51,6 +59,7 @@ class ArtifactResolver(object):
     def __init__(self):
         self._added_artifacts = None
         self._source_pool = None
+        self._kinds = None
 
     def resolve_root_artifacts(self, source_pool): #pragma: no cover
         return [a for a in self._resolve_artifacts(source_pool)
@@ -72,8 +81,7 @@ class ArtifactResolver(object):
 
         # If we were not given systems, return the strata here,
         # rather than have the systems return them.
-        if not any(s.morphology['kind'] == 'system'
-                   for s in self._source_pool):
+        if 'system' not in self._kinds:
             for stratum in (s for s in strata
                             if s not in self._added_artifacts):
                 artifacts.append(stratum)
@@ -92,8 +100,7 @@ class ArtifactResolver(object):
                   for name in source.split_rules.artifacts]
         # If we were only given chunks, return them here, rather than
         # have the strata return them.
-        if not any(s.morphology['kind'] == 'stratum'
-                   for s in self._source_pool):
+        if 'stratum' not in self._kinds:
             for chunk in (c for c in chunks
                           if c not in self._added_artifacts):
                 artifacts.append(chunk)
@@ -102,11 +109,9 @@ class ArtifactResolver(object):
     def _resolve_artifacts(self, source_pool):
         self._source_pool = source_pool
         self._added_artifacts = set()
+        self._kinds = set(s.morphology['kind'] for s in source_pool)
         artifacts = []
 
-        # TODO perform cycle detection, e.g. based on:
-        # http://stackoverflow.com/questions/546655/finding-all-cycles-in-graph
-
         resolvers = {'system': self._resolve_system_artifacts,
                      'stratum': self._resolve_stratum_artifacts,
                      'chunk': self._resolve_chunk_artifacts}
@@ -114,8 +119,43 @@ class ArtifactResolver(object):
         for source in self._source_pool:
             resolvers[source.morphology['kind']](source, artifacts)
 
+        self._check_for_cycles(source_pool)
+
         return artifacts
 
+    def _check_for_cycles(self, source_pool):
+        '''Raise DependencyCycleError if any source depends on itself.
+
+        This is a depth-first search over the sources, which keeps the path
+        it is on so that the whole cycle can be reported. It is iterative,
+        as the graph may be deeper than Python's recursion limit.
+
+        '''
+
+        done = set()
+        for root in source_pool:
+            if root in done:
+                continue
+            path = [root]
+            on_path = {root: 0}
+            stack = [iter(root.dependencies)]
+            while stack:
+                for artifact in stack[-1]:
+                    source = artifact.source
+                    if source in on_path:
+                        raise DependencyCycleError(
+                            path[on_path[source]:] + [source])
+                    if source not in done:
+                        on_path[source] = len(path)
+                        path.append(source)
+                        stack.append(iter(source.dependencies))
+                        break
+                else:
+                    stack.pop()
+                    source = path.pop()
+                    del on_path[source]
+                    done.add(source)
+
     def _resolve_system_dependencies(self, systems, source): # pragma: no cover
         artifacts = []
 
@@ -123,7 +163,8 @@ class ArtifactResolver(object):
             for stratum_source in self._source_pool.lookup(
                 info.get('repo') or source.repo_name,
                 info.get('ref') or source.original_ref,
-                morphlib.util.sanitise_morphology_path(info['morph'])):
+                morphlib.util.sanitise_morphology_path(info['morph']),
+                source.arch):
 
                 stratum_morph_name = stratum_source.morphology['name']
 
@@ -149,7 +190,8 @@ class ArtifactResolver(object):
             for other_source in self._source_pool.lookup(
                 stratum_info.get('repo') or source.repo_name,
                 stratum_info.get('ref') or source.original_ref,
-                morphlib.util.sanitise_morphology_path(stratum_info['morph'])):
+                morphlib.util.sanitise_morphology_path(stratum_info['morph']),
+                source.arch):
 
                 # Make every stratum artifact this stratum source produces
                 # depend on every stratum artifact the other stratum source
@@ -173,6 +215,7 @@ class ArtifactResolver(object):
 
         # 'name' here is the chunk artifact name
         name_to_processed_artifacts = {}
+        returned_chunks = set()
 
         for info in source.morphology['chunks']:
             filename = morphlib.util.sanitise_morphology_path(
@@ -180,7 +223,8 @@ class ArtifactResolver(object):
             chunk_source = self._source_pool.lookup(
                 info['repo'],
                 info['ref'],
-                filename)[0]
+                filename,
+                source.arch)[0]
 
             chunk_name = chunk_source.name
 
@@ -212,7 +256,8 @@ class ArtifactResolver(object):
                 chunk_artifact = chunk_source.artifacts[ca_name]
                 source.add_dependency(chunk_artifact)
                 # Only return chunks required to build strata we need
-                if chunk_artifact not in artifacts:
+                if chunk_artifact not in returned_chunks:
+                    returned_chunks.add(chunk_artifact)
                     artifacts.append(chunk_artifact)
 
             # Add these chunks to the processed artifacts, so other
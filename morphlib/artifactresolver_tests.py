@@ -194,6 +194,62 @@ class ArtifactResolverTests(unittest.TestCase):
             self.assertTrue(any(dep in stratum_sources
                                 for dep in chunk_artifact.dependents))
 
+    def test_resolve_stratum_added_before_its_chunk(self):
+        pool = morphlib.sourcepool.SourcePool()
+
+        morph = get_stratum_morphology(
+            'stratum', chunks=[('chunk', 'chunk', 'repo', 'ref')])
+        for stratum in morphlib.source.make_sources('repo', 'ref',
+                                                    'stratum.morph', 'sha1',
+                                                    'tree', morph):
+            pool.add(stratum)
+
+        morph = get_chunk_morphology('chunk')
+        for chunk in morphlib.source.make_sources('repo', 'ref',
+                                                  'chunk.morph', 'sha1',
+                                                  'tree', morph):
+            pool.add(chunk)
+
+        artifacts = self.resolver._resolve_artifacts(pool)
+
+        self.assertTrue(any(dep.source is chunk
+                            for dep in stratum.dependencies))
+        self.assertEqual(
+            set(a.name for a in artifacts),
+            set(stratum.split_rules.artifacts) |
+            set(chunk.split_rules.artifacts))
+
+    def test_resolve_stratum_and_chunk_for_two_archs(self):
+        pool = morphlib.sourcepool.SourcePool()
+
+        for arch in ('x86_64', 'armv7lhf'):
+            morph = get_chunk_morphology('chunk')
+            for source in morphlib.source.make_sources(
+                    'repo', 'ref', 'chunk.morph', 'sha1', 'tree', morph,
+                    arch):
+                pool.add(source)
+
+            morph = get_stratum_morphology(
+                'stratum', chunks=[('chunk', 'chunk', 'repo', 'ref')])
+            for source in morphlib.source.make_sources(
+                    'repo', 'ref', 'stratum.morph', 'sha1', 'tree', morph,
+                    arch):
+                pool.add(source)
+
+        artifacts = self.resolver._resolve_artifacts(pool)
+
+        for artifact in artifacts:
+            for dependency in artifact.source.dependencies:
+                self.assertEqual(dependency.source.arch,
+                                 artifact.source.arch)
+            for dependent in artifact.dependents:
+                self.assertEqual(dependent.arch, artifact.source.arch)
+        stratum_sources = [s for s in pool
+                           if s.morphology['kind'] == 'stratum']
+        self.assertEqual(sorted(set(s.arch for s in stratum_sources)),
+                         ['armv7lhf', 'x86_64'])
+        self.assertTrue(all(s.dependencies for s in stratum_sources))
+
     def test_resolve_stratum_and_chunk_with_two_new_artifacts(self):
         pool = morphlib.sourcepool.SourcePool()
 
@@ -280,6 +336,34 @@ class ArtifactResolverTests(unittest.TestCase):
         self.assertRaises(morphlib.artifactresolver.MutualDependencyError,
                           self.resolver._resolve_artifacts, pool)
 
+    def test_detection_of_cycle_between_three_strata(self):
+        pool = morphlib.sourcepool.SourcePool()
+
+        for name, build_depends in (('stratum1', 'stratum2'),
+                                    ('stratum2', 'stratum3'),
+                                    ('stratum3', 'stratum1')):
+            chunk_name = name.replace('stratum', 'chunk')
+            morph = get_chunk_morphology(chunk_name)
+            for source in morphlib.source.make_sources(
+                    'repo', 'ref', '%s.morph' % chunk_name, 'sha1', 'tree',
+                    morph):
+                pool.add(source)
+
+            morph = get_stratum_morphology(
+                name,
+                chunks=[(chunk_name, '%s.morph' % chunk_name, 'repo', 'ref')],
+                build_depends=['%s.morph' % build_depends])
+            for source in morphlib.source.make_sources(
+                    'repo', 'ref', '%s.morph' % name, 'sha1', 'tree', morph):
+                pool.add(source)
+
+        with self.assertRaises(
+                morphlib.artifactresolver.DependencyCycleError) as cm:
+            self.resolver._resolve_artifacts(pool)
+        message = str(cm.exception)
+        for name in ('stratum1', 'stratum2', 'stratum3'):
+            self.assertTrue(name in message)
+
     def test_detection_of_chunk_dependencies_in_invalid_order(self):
         pool = morphlib.sourcepool.SourcePool()
 
@@ -22,8 +22,12 @@ Binaries are chunks, strata, and system images.
 
 
 import cliapp
+import collections
+import copy
+import grp
 import logging
 import os
+import pwd
 import sys
 import re
 import errno
@@ -51,11 +55,6 @@ if sys.version_info < (2, 7, 4): # pragma: no cover
 
 # Work around http://bugs.python.org/issue12841
 if sys.version_info < (2, 7, 3): # pragma: no cover
-    try:
-        import grp, pwd
-    except ImportError:
-        grp = pwd = None
-
     def fixed_chown(self, tarinfo, targetpath):
         '''Set owner of targetpath according to tarinfo.'''
 
@@ -86,38 +85,121 @@ def create_chunk(rootdir, f, include, dump_memory_profile=None):
 
     '''
 
+    create_chunks(rootdir, [(f, include)], dump_memory_profile)
+
+
+def create_chunks(rootdir, outputs, dump_memory_profile=None):
+    '''Create several chunks from the contents of a directory at once.
+
+    ``outputs`` is a list of ``(f, include)`` pairs: the names in
+    ``include``, relative to ``rootdir``, are written as a tar file to the
+    open file handle ``f``. The names are visited once, in sorted order,
+    and each is put in every chunk that includes it, so that however many
+    chunks there are, everything is examined and read only once. Hard links
+    are kept within each chunk. Everything but directories is then removed.
+
+    '''
+
     dump_memory_profile = dump_memory_profile or (lambda msg: None)
+    dump_memory_profile('at beginning of create_chunks')
+
+    wanted = collections.defaultdict(list)
+    for index, (f, include) in enumerate(outputs):
+        for relname in include:
+            wanted[relname].append(index)
+    tars = [tarfile.open(fileobj=f, mode='w') for f, include in outputs]
+    # The first name each chunk has for a file with several links.
+    links = {}
+    owner_names = {}
+    to_remove = []
+    for relname in sorted(wanted):
+        filename = os.path.join(rootdir, relname)
+        st = os.lstat(filename)
+        tarinfo = _tarinfo(filename, relname, st, owner_names)
+        if tarinfo is None:
+            logging.warning('Not putting %s in a chunk: unsupported type' %
+                            filename)
+        elif tarinfo.isreg():
+            with open(filename, 'rb') as fileobj:
+                for index in wanted[relname]:
+                    if st.st_nlink > 1:
+                        linkname = links.setdefault(
+                            (index, st.st_dev, st.st_ino), relname)
+                        if linkname != relname:
+                            linkinfo = copy.copy(tarinfo)
+                            linkinfo.type = tarfile.LNKTYPE
+                            linkinfo.linkname = linkname
+                            linkinfo.size = 0
+                            tars[index].addfile(linkinfo)
+                            continue
+                    fileobj.seek(0)
+                    tars[index].addfile(tarinfo, fileobj=fileobj)
+        else:
+            for index in wanted[relname]:
+                tars[index].addfile(tarinfo)
+        if not stat.S_ISDIR(st.st_mode):
+            to_remove.append(filename)
+    for tar in tars:
+        tar.close()
+
+    for filename in to_remove:
+        os.remove(filename)
+    dump_memory_profile('after removing in create_chunks')
+
 
+def _tarinfo(filename, arcname, st, owner_names):
+    '''Describe a file for a chunk, as TarFile.gettarinfo() would.
+
+    ``st`` is the result of os.lstat() for the file, and ``owner_names``
+    a dict in which to remember the names of users and groups. Returns
+    None for sockets, which cannot be put in a tar file.
+
+    '''
+
+    mode = st.st_mode
+    tarinfo = tarfile.TarInfo(arcname)
+    if stat.S_ISREG(mode):
+        tarinfo.type = tarfile.REGTYPE
+        tarinfo.size = st.st_size
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(filename)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        tarinfo.type = (tarfile.CHRTYPE if stat.S_ISCHR(mode)
+                        else tarfile.BLKTYPE)
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    else:
+        return None
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
     # This timestamp is used to normalize the mtime for every file in
     # chunk artifact. This is useful to avoid problems from smallish
     # clock skew. It needs to be recent enough, however, that GNU tar
     # does not complain about an implausibly old timestamp.
-    normalized_timestamp = 683074800
+    tarinfo.mtime = 683074800
+    tarinfo.uname, tarinfo.gname = _owner_names(st, owner_names)
+    return tarinfo
 
-    dump_memory_profile('at beginning of create_chunk')
-    
-    path_pairs = [(relname, os.path.join(rootdir, relname))
-                  for relname in include]
-    tar = tarfile.open(fileobj=f, mode='w')
-    for relname, filename in path_pairs:
-        # Normalize mtime for everything.
-        tarinfo = tar.gettarinfo(filename,
-                                 arcname=relname)
-        tarinfo.ctime = normalized_timestamp
-        tarinfo.mtime = normalized_timestamp
-        if tarinfo.isreg():
-            with open(filename, 'rb') as f:
-                tar.addfile(tarinfo, fileobj=f)
-        else:
-            tar.addfile(tarinfo)
-    tar.close()
 
-    for relname, filename in reversed(path_pairs):
-        if os.path.isdir(filename) and not os.path.islink(filename):
-            continue
-        else:
-            os.remove(filename)
-    dump_memory_profile('after removing in create_chunks')
+def _owner_names(st, owner_names):
+    key = (st.st_uid, st.st_gid)
+    if key not in owner_names:
+        try:
+            uname = pwd.getpwuid(st.st_uid)[0]
+        except KeyError:
+            uname = ''
+        try:
+            gname = grp.getgrgid(st.st_gid)[0]
+        except KeyError:
+            gname = ''
+        owner_names[key] = (uname, gname)
+    return owner_names[key]
 
 
 def unpack_binary_from_file(f, dirname):  # pragma: no cover
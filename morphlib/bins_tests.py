@@ -14,9 +14,13 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import errno
+import grp
 import gzip
 import os
+import pwd
 import shutil
+import socket
 import stat
 import tempfile
 import tarfile
@@ -142,6 +146,138 @@ class ChunkTests(BinsTest):
         f.close()
 
 
+class MultipleChunkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.instdir = os.path.join(self.tempdir, 'inst')
+        for dirname in ('bin', 'lib'):
+            os.makedirs(os.path.join(self.instdir, dirname))
+        for filename in ('bin/foo', 'lib/libfoo.so'):
+            with open(os.path.join(self.instdir, filename), 'w') as f:
+                f.write(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunks(self, *includes):
+        outputs = [(StringIO.StringIO(), include) for include in includes]
+        morphlib.bins.create_chunks(self.instdir, outputs)
+        members = []
+        for f, include in outputs:
+            f.seek(0)
+            tar = tarfile.open(fileobj=f)
+            members.append([(m.name, m.type, m.linkname) for m in tar])
+        return members
+
+    def test_puts_names_in_each_chunk_including_them(self):
+        self.assertEqual(
+            self.create_chunks(['bin', 'bin/foo'], ['bin', 'lib',
+                                                    'lib/libfoo.so']),
+            [[('bin', tarfile.DIRTYPE, ''), ('bin/foo', tarfile.REGTYPE, '')],
+             [('bin', tarfile.DIRTYPE, ''), ('lib', tarfile.DIRTYPE, ''),
+              ('lib/libfoo.so', tarfile.REGTYPE, '')]])
+
+    def test_empties_files(self):
+        self.create_chunks(['bin/foo'], ['lib/libfoo.so'])
+        self.assertEqual(sorted(os.listdir(self.instdir)), ['bin', 'lib'])
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'bin')), [])
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'lib')), [])
+
+    def test_keeps_hard_links_within_a_chunk(self):
+        os.link(os.path.join(self.instdir, 'bin', 'foo'),
+                os.path.join(self.instdir, 'bin', 'bar'))
+        self.assertEqual(
+            self.create_chunks(['bin/bar', 'bin/foo']),
+            [[('bin/bar', tarfile.REGTYPE, ''),
+              ('bin/foo', tarfile.LNKTYPE, 'bin/bar')]])
+
+    def test_does_not_link_across_chunks(self):
+        os.link(os.path.join(self.instdir, 'bin', 'foo'),
+                os.path.join(self.instdir, 'lib', 'foo'))
+        self.assertEqual(
+            self.create_chunks(['bin/foo'], ['lib/foo']),
+            [[('bin/foo', tarfile.REGTYPE, '')],
+             [('lib/foo', tarfile.REGTYPE, '')]])
+
+
+    def test_puts_fifos_in_chunks(self):
+        os.mkfifo(os.path.join(self.instdir, 'bin', 'fifo'))
+        self.assertEqual(self.create_chunks(['bin/fifo']),
+                         [[('bin/fifo', tarfile.FIFOTYPE, '')]])
+
+    def test_leaves_sockets_out_of_chunks(self):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.bind(os.path.join(self.instdir, 'bin', 'socket'))
+        finally:
+            sock.close()
+        self.assertEqual(self.create_chunks(['bin/foo', 'bin/socket']),
+                         [[('bin/foo', tarfile.REGTYPE, '')]])
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'bin')), [])
+
+    def test_aborts_every_chunk_if_one_fails(self):
+        cachedir = os.path.join(self.tempdir, 'cache')
+        os.mkdir(cachedir)
+
+        class FullFile(morphlib.savefile.SaveFile):
+
+            def write(self, data):
+                raise IOError(errno.ENOSPC, 'No space left on device')
+
+        outputs = [
+            (morphlib.savefile.SaveFile(os.path.join(cachedir, 'a'), 'w'),
+             ['bin', 'bin/foo']),
+            (FullFile(os.path.join(cachedir, 'b'), 'w'),
+             ['lib', 'lib/libfoo.so']),
+        ]
+        self.assertRaises(IOError, morphlib.bins.create_chunks,
+                          self.instdir, outputs)
+        # ChunkBuilder then aborts every chunk.
+        for f, include in outputs:
+            f.abort()
+        self.assertEqual(os.listdir(cachedir), [])
+        # Nothing is removed unless every chunk is written.
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'bin')),
+                         ['foo'])
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'lib')),
+                         ['libfoo.so'])
+
+    def test_fails_for_missing_names(self):
+        self.assertRaises(OSError, self.create_chunks, ['bin/missing'])
+        self.assertEqual(os.listdir(os.path.join(self.instdir, 'bin')),
+                         ['foo'])
+
+
+class TarInfoTests(unittest.TestCase):
+
+    def stat_result(self, mode, uid=0, gid=0, rdev=0):
+        return os.stat_result((mode, 0, 0, 1, uid, gid, 0, 0, 0, 0),
+                              {'st_rdev': rdev})
+
+    def test_describes_character_devices(self):
+        st = self.stat_result(stat.S_IFCHR | 0666, rdev=os.makedev(1, 3))
+        tarinfo = morphlib.bins._tarinfo('/dev/null', 'dev/null', st, {})
+        self.assertEqual(tarinfo.type, tarfile.CHRTYPE)
+        self.assertEqual((tarinfo.devmajor, tarinfo.devminor), (1, 3))
+        self.assertEqual(tarinfo.mode, stat.S_IFCHR | 0666)
+
+    def test_describes_block_devices(self):
+        st = self.stat_result(stat.S_IFBLK | 0660, rdev=os.makedev(8, 1))
+        tarinfo = morphlib.bins._tarinfo('/dev/sda1', 'dev/sda1', st, {})
+        self.assertEqual(tarinfo.type, tarfile.BLKTYPE)
+        self.assertEqual((tarinfo.devmajor, tarinfo.devminor), (8, 1))
+
+    def test_leaves_owner_names_of_unknown_ids_empty(self):
+        uid = max(p.pw_uid for p in pwd.getpwall()) + 1
+        gid = max(g.gr_gid for g in grp.getgrall()) + 1
+        owner_names = {}
+        st = self.stat_result(stat.S_IFREG | 0644, uid, gid)
+        self.assertEqual(morphlib.bins._owner_names(st, owner_names),
+                         ('', ''))
+        self.assertEqual(owner_names, {(uid, gid): ('', '')})
+
+
 class ExtractTests(unittest.TestCase):
 
     def setUp(self):
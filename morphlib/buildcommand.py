@@ -14,12 +14,16 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import collections
 import itertools
 import os
-import shutil
+import signal
 import logging
 import tempfile
+import threading
+import time
 import datetime
+import traceback
 
 import morphlib
 import distbuild
@@ -33,6 +37,13 @@ class MultipleRootArtifactsError(morphlib.Error):
         self.artifacts = artifacts
 
 
+class BuildFailedError(morphlib.Error):
+
+    def __init__(self, source):
+        self.msg = 'Building %s %s failed' % (source.morphology['kind'],
+                                              source.name)
+
+
 class BuildCommand(object):
 
     '''High level logic for building.
@@ -49,6 +60,21 @@ class BuildCommand(object):
         self.app = app
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
+        self.morphology_cache = morphlib.util.new_morphology_cache(
+            self.app.settings)
+        self.ref_cache = morphlib.util.new_ref_cache(self.app.settings)
+        self.source_pool_snapshot = morphlib.util.new_source_pool_snapshot(
+            self.app.settings)
+        self.build_graph_cache = morphlib.util.new_build_graph_cache(
+            self.app.settings)
+        self.jobserver = None
+        self._jobserver_dir = None
+        self.prefetch_bandwidth = None
+        # Updating the local repo cache is not safe in several threads at
+        # once, so the prefetcher and the build take turns.
+        self.repo_cache_lock = threading.RLock()
+        # Artifacts the remote cache did not have when the build started.
+        self.remote_missing = set()
 
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
@@ -58,10 +84,8 @@ class BuildCommand(object):
             repo_name=repo_name, ref=ref, filename=filename)
 
         self.app.status(msg='Deciding on task order')
-        srcpool = self.create_source_pool(
+        root_artifact = self.get_root_artifact(
             repo_name, ref, filename, original_ref)
-        self.validate_sources(srcpool)
-        root_artifact = self.resolve_artifacts(srcpool)
         self.build_in_order(root_artifact)
 
         self.app.status(
@@ -98,9 +122,54 @@ class BuildCommand(object):
             self.lrc, self.rrc, repo_name, ref, filename,
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            resolve_jobs=self.app.settings['resolve-jobs'],
+            morphology_cache=self.morphology_cache,
+            ref_cache=self.ref_cache,
+            snapshot=self.source_pool_snapshot)
         return srcpool
 
+    def new_source_resolver(self):
+        '''Create a SourceResolver like the one create_source_pool uses.'''
+        return morphlib.sourceresolver.SourceResolver(
+            self.lrc, self.rrc,
+            not self.app.settings['no-git-update'],
+            self.app.status,
+            self.app.settings['resolve-jobs'],
+            self.morphology_cache,
+            self.ref_cache)
+
+    def get_root_artifact(self, repo_name, ref, filename, original_ref=None):
+        '''Return the root artifact of the build graph for a system.
+
+        This creates and validates a source pool, resolves its artifacts
+        and computes their cache keys, unless an earlier run already did
+        that for the same commit and system and the graph is still valid.
+
+        '''
+
+        resolver = self.new_source_resolver()
+        commit, tree = resolver.resolve_ref(repo_name, ref)
+        graph_ref = original_ref or ref
+        root_artifact = self.build_graph_cache.get(
+            repo_name, graph_ref, commit, filename,
+            self.new_build_env, resolver.resolve_refs)
+        self.ref_cache.save()
+        if root_artifact is not None:
+            self.app.status(msg='Reusing cached build graph for %(filename)s',
+                            filename=filename, chatty=True)
+            self._validate_root_artifact(root_artifact)
+            return root_artifact
+
+        srcpool = self.create_source_pool(
+            repo_name, ref, filename, original_ref)
+        self.validate_sources(srcpool)
+        root_artifact = self.resolve_artifacts(srcpool)
+        self.build_graph_cache.put(repo_name, graph_ref,
+                                   root_artifact.source.sha1, filename,
+                                   root_artifact)
+        return root_artifact
+
     def validate_sources(self, srcpool):
         self.app.status(
             msg='Validating cross-morphology references', chatty=True)
@@ -246,7 +315,8 @@ class BuildCommand(object):
             logging.debug(
                 'Validating cross ref to %s:%s:%s' %
                     (repo_name, ref, filename))
-            for other in srcpool.lookup(repo_name, ref, filename):
+            for other in srcpool.lookup(repo_name, ref, filename,
+                                        src.arch):
                 if other.morphology['kind'] != wanted:
                     raise morphlib.Error(
                         '%s %s references %s:%s:%s which is a %s, '
@@ -274,48 +344,347 @@ class BuildCommand(object):
         self.app.status(msg='Building a set of sources', chatty=True)
         build_env = root_artifact.build_env
         ordered_sources = list(self.get_ordered_sources(root_artifact.walk()))
+        states = self.get_cache_states(
+            a for s in ordered_sources for a in s.artifacts.itervalues())
+        self.report_cache_states(states)
+        self.remote_missing = set(a for a, state in states.iteritems()
+                                  if state == 'missing')
+        self.start_jobserver()
+        try:
+            if self.app.settings['max-parallel-builds'] > 1:
+                self.build_in_parallel(ordered_sources, build_env)
+                return
+
+            old_prefix = self.app.status_prefix
+            prefetcher = self.new_prefetcher(ordered_sources)
+            try:
+                for i, s in enumerate(ordered_sources):
+                    self.app.status_prefix = self.build_status_prefix(
+                        old_prefix, i, len(ordered_sources), s)
+
+                    prefetcher.wait_for(i)
+                    self.cache_or_build_source(s, build_env)
+            finally:
+                prefetcher.close()
+
+            self.app.status_prefix = old_prefix
+        finally:
+            self.stop_jobserver()
+
+    def new_prefetcher(self, ordered_sources):
+        '''Return a Prefetcher to fetch for sources before they are built.'''
+
+        settings = self.app.settings
+        if settings['prefetch-bandwidth'] > 0:
+            self.prefetch_bandwidth = morphlib.prefetcher.BandwidthLimit(
+                settings['prefetch-bandwidth'])
+        return morphlib.prefetcher.Prefetcher(
+            ordered_sources, self.prefetch_source,
+            settings['prefetch-sources'], settings['prefetch-jobs'])
+
+    def prefetch_source(self, source):  # pragma: no cover
+        '''Fetch what a source will need, without showing progress.
+
+        The source's artifacts are fetched from the remote artifact cache.
+        If any are still missing, the source will be built, so its git
+        repository is updated too, and the chunks to go in its staging area
+        which are already cached are unpacked.
+
+        '''
+
+        artifacts = source.artifacts.values()
+        if self.rac is not None and self.remote_missing.isdisjoint(artifacts):
+            try:
+                self.cache_artifacts_locally(artifacts, background=True)
+            except morphlib.remoteartifactcache.GetError:
+                pass
+        if all(self.lac.has(artifact) for artifact in artifacts):
+            return
+        if not self.app.settings['no-git-update']:
+            self.fetch_sources(source, status=self._log_status)
+        if source.morphology['kind'] == 'chunk':
+            chunk_cache = morphlib.util.new_unpacked_chunk_cache(
+                self.app.settings)
+            deps = self.get_recursive_deps(artifacts)
+            for artifact in self.staged_artifacts(deps, source):
+                if self.lac.has(artifact):
+                    with self.lac.get(artifact) as handle:
+                        chunk_cache.prepare(handle, status=self._log_status)
+
+    @staticmethod
+    def _log_status(**kwargs):  # pragma: no cover
+        # Background threads only log their progress, as the status prefix
+        # belongs to the source being built.
+        logging.debug(kwargs['msg'] % kwargs)
+
+    def get_cache_states(self, artifacts):
+        '''Return whether each artifact is cached locally or remotely.
+
+        The result maps each artifact to 'local', 'remote' or 'missing'.
+        All the artifacts that are not in the local cache are looked up in
+        the remote cache in a single request. If the remote cache cannot be
+        reached, that is reported once and they are all 'missing'.
+
+        '''
+
+        states = {}
+        not_local = []
+        for artifact in artifacts:
+            if self.lac.has(artifact):
+                states[artifact] = 'local'
+            else:
+                not_local.append(artifact)
+        remote = {}
+        if self.rac is not None:
+            try:
+                remote = self.rac.has_many(not_local)
+            except morphlib.remoteartifactcache.UnreachableError, e:
+                self.app.status(msg='%(error)s; treating the remote cache '
+                                    'as empty', error=str(e))
+        for artifact in not_local:
+            states[artifact] = 'remote' if remote.get(artifact) else 'missing'
+        return states
+
+    def report_cache_states(self, states):
+        counts = collections.defaultdict(int)
+        for state in states.itervalues():
+            counts[state] += 1
+        self.app.status(msg='%(local)d artifacts are cached locally, '
+                            '%(remote)d in the remote cache, and '
+                            '%(missing)d need building',
+                        local=counts['local'], remote=counts['remote'],
+                        missing=counts['missing'])
+
+    def start_jobserver(self):  # pragma: no cover
+        '''Start a make jobserver for the builds to share, unless disabled.
+
+        Every make can run one job without taking a token, so the jobserver
+        holds max-jobs tokens less one for each build that can run at once.
+        With one build at a time, make's own -j does the same job, so no
+        jobserver is started.
+
+        '''
+
+        settings = self.app.settings
+        if settings['no-jobserver'] or settings['max-parallel-builds'] <= 1:
+            return
+        tokens = max(0, settings['max-jobs'] -
+                        settings['max-parallel-builds'])
+        dirname = tempfile.mkdtemp(dir=settings['tempdir'],
+                                   prefix='jobserver-')
+        try:
+            self.jobserver = morphlib.jobserver.JobServer(
+                os.path.join(dirname, 'fifo'), tokens)
+        except morphlib.jobserver.JobServerError:
+            os.rmdir(dirname)
+            raise
+        self._jobserver_dir = dirname
+
+    def attach_jobserver(self, path):  # pragma: no cover
+        '''Share the make jobserver of another process, if it has one.
+
+        `path` is where the other process keeps the jobserver's FIFO.
+
+        '''
+
+        if self.app.settings['no-jobserver'] or not os.path.exists(path):
+            return
+        self.jobserver = morphlib.jobserver.JobServer.attach(path)
+
+    def stop_jobserver(self):  # pragma: no cover
+        '''Stop using the make jobserver, if there is one.'''
+
+        if self.jobserver is not None:
+            self.jobserver.close()
+            self.jobserver = None
+        if self._jobserver_dir is not None:
+            os.rmdir(self._jobserver_dir)
+            self._jobserver_dir = None
+
+    @staticmethod
+    def build_status_prefix(old_prefix, index, total, source):
+        return old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
+            'index': (index+1),
+            'total': total,
+            'name': source.name,
+        }
+
+    def build_in_parallel(self, ordered_sources, build_env):
+        '''Build sources in dependency order, several at once.
+
+        Each source whose artifacts are not in a cache is built in a child
+        process, in its own staging area, once all its dependencies are
+        done. At most `max-parallel-builds` builds run at once, and the
+        `max-jobs` make jobs are shared between them.
+
+        Fetching artifacts from the remote cache and updating git repos is
+        done here in the parent, one source at a time, so that no two
+        builds update the same cached repository at the same time.
+
+        If a build fails, the other running builds are stopped, and
+        BuildFailedError is raised.
+
+        '''
+
+        scheduler = morphlib.buildscheduler.BuildScheduler(ordered_sources)
+        max_parallel = self.app.settings['max-parallel-builds']
+        max_jobs = self.app.settings['max-jobs']
+        total = len(ordered_sources)
+        started = 0
+        running = {}
         old_prefix = self.app.status_prefix
-        for i, s in enumerate(ordered_sources):
-            self.app.status_prefix = (
-                old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
-                    'index': (i+1),
-                    'total': len(ordered_sources),
-                    'name': s.name,
-                })
 
-            self.cache_or_build_source(s, build_env)
+        try:
+            while not scheduler.finished:
+                while len(running) < max_parallel:
+                    source = scheduler.take()
+                    if source is None:
+                        break
+                    self.app.status_prefix = self.build_status_prefix(
+                        old_prefix, started, total, source)
+                    started += 1
+                    if self.fetch_cached_artifacts(source):
+                        self.report_cached_artifacts(source)
+                        scheduler.done(source)
+                        continue
+
+                    self.fetch_sources(source)
+                    # Share the make jobs between the builds that will run
+                    # alongside this one.
+                    builds = min(max_parallel,
+                                 len(running) + 1 + scheduler.ready_count())
+                    jobs = max(1, max_jobs // builds)
+                    pid = self.start_build(source, build_env, jobs)
+                    running[pid] = (source, self.app.status_prefix)
+                self.app.status_prefix = old_prefix
+
+                if not running:
+                    continue
+                pid, status = os.wait()
+                if pid not in running: # pragma: no cover
+                    continue
+                source, prefix = running.pop(pid)
+                if status != 0:
+                    raise BuildFailedError(source)
+                self.app.status_prefix = prefix
+                self.report_cached_artifacts(source)
+                self.app.status_prefix = old_prefix
+                scheduler.done(source)
+        except BaseException:
+            self.app.status_prefix = old_prefix
+            self.stop_builds(running)
+            raise
 
         self.app.status_prefix = old_prefix
 
+    def start_build(self, source, build_env, jobs):  # pragma: no cover
+        '''Build a source in a child process, and return its process ID.
+
+        The child is put in its own process group, so that stopping it
+        also stops the commands it is running.
+
+        '''
+
+        if self.app.settings['staging-overlayfs']:
+            # Find out once, rather than in every child.
+            morphlib.stagingarea.overlayfs_supported(self.app)
+
+        pid = os.fork()
+        if pid != 0:
+            try:
+                os.setpgid(pid, pid)
+            except OSError:
+                # The child may already have done this itself, or exited.
+                pass
+            return pid
+
+        status = 1
+        try:
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, self._stop_child_build)
+            # The child must not share the parent's git cat-file processes.
+            morphlib.gitdir.CatFileBatch.forget_all()
+            self.app.settings['max-jobs'] = jobs
+            # The sources were fetched before forking, and updating them
+            # here could race with builds running alongside this one.
+            self.build_source(source, build_env, fetch=False)
+            status = 0
+        except BaseException, e:
+            logging.error(traceback.format_exc())
+            self.app.status(msg='Build failed: %(reason)s', error=True,
+                            reason=str(e) or e.__class__.__name__)
+        finally:
+            self.app.output.flush()
+            # Exiting this way skips atexit handlers.
+            self.lac.flush()
+            os._exit(status)
+
+    @staticmethod
+    def _stop_child_build(signum, frame):  # pragma: no cover
+        # Raising unwinds the build, so that its staging area is removed
+        # and no partly written artifacts are left in the cache.
+        raise SystemExit(1)
+
+    def stop_builds(self, running):  # pragma: no cover
+        '''Stop the builds running in child processes, and wait for them.'''
+
+        for pid, (source, prefix) in running.iteritems():
+            self.app.status(msg='Stopping build of %(name)s',
+                            name=source.name)
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in running:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        running.clear()
+
     def cache_or_build_source(self, source, build_env):
         '''Make artifacts of the built source available in the local cache.
 
         This can be done by retrieving from a remote artifact cache, or if
         that doesn't work for some reason, by building the source locally.
 
+        '''
+        if not self.fetch_cached_artifacts(source):
+            self.build_source(source, build_env)
+        self.report_cached_artifacts(source)
+
+    def fetch_cached_artifacts(self, source):
+        '''Get a source's artifacts into the local cache, if they exist.
+
+        Returns True if all the artifacts are now in the local cache.
+
         '''
         artifacts = source.artifacts.values()
-        if self.rac is not None:
+        # There is no point asking the remote cache again for artifacts it
+        # did not have when the build started.
+        if self.rac is not None and self.remote_missing.isdisjoint(artifacts):
             try:
                 self.cache_artifacts_locally(artifacts)
             except morphlib.remoteartifactcache.GetError:
                 # Error is logged by the RemoteArtifactCache object.
                 pass
 
-        if any(not self.lac.has(artifact) for artifact in artifacts):
-            self.build_source(source, build_env)
+        return all(self.lac.has(artifact) for artifact in artifacts)
 
-        for a in artifacts:
+    def report_cached_artifacts(self, source):
+        for a in source.artifacts.values():
             self.app.status(msg='%(kind)s %(name)s is cached at %(cachepath)s',
                             kind=source.morphology['kind'], name=a.name,
                             cachepath=self.lac.artifact_filename(a),
                             chatty=(source.morphology['kind'] != "system"))
 
-    def build_source(self, source, build_env):
+    def build_source(self, source, build_env, fetch=True):
         '''Build all artifacts for one source.
 
         All the dependencies are assumed to be built and available
-        in either the local or remote cache already.
+        in either the local or remote cache already. If `fetch` is false,
+        the source's repository must already be in the local cache, as
+        fetch_sources() leaves it.
 
         '''
         starttime = datetime.datetime.now()
@@ -323,7 +692,8 @@ class BuildCommand(object):
                         name=source.name,
                         kind=source.morphology['kind'])
 
-        self.fetch_sources(source)
+        if fetch:
+            self.fetch_sources(source)
         # TODO: Make an artifact.walk() that takes multiple root artifacts.
         # as this does a walk for every artifact. This was the status
         # quo before build logic was made to work per-source, but we can
@@ -382,12 +752,17 @@ class BuildCommand(object):
                     ordered_deps.append(dep)
         return ordered_deps
 
-    def fetch_sources(self, source):
+    def fetch_sources(self, source, status=None):
         '''Update the local git repository cache with the sources.'''
 
+        status = status or self.app.status
+        with self.repo_cache_lock:
+            self._fetch_sources(source, status)
+
+    def _fetch_sources(self, source, status):
         repo_name = source.repo_name
         if self.app.settings['no-git-update']:
-            self.app.status(msg='Not updating existing git repository '
+            status(msg='Not updating existing git repository '
                                 '%(repo_name)s '
                                 'because of no-git-update being set',
                             chatty=True,
@@ -400,17 +775,17 @@ class BuildCommand(object):
             try:
                 sha1 = source.sha1
                 source.repo.resolve_ref_to_commit(sha1)
-                self.app.status(msg='Not updating git repository '
+                status(msg='Not updating git repository '
                                     '%(repo_name)s because it '
                                     'already contains sha1 %(sha1)s',
                                 chatty=True, repo_name=repo_name,
                                 sha1=sha1)
             except morphlib.gitdir.InvalidRefError:
-                self.app.status(msg='Updating %(repo_name)s',
+                status(msg='Updating %(repo_name)s',
                                 repo_name=repo_name)
                 source.repo.update()
         else:
-            self.app.status(msg='Cloning %(repo_name)s',
+            status(msg='Cloning %(repo_name)s',
                             repo_name=repo_name)
             source.repo = self.lrc.cache_repo(repo_name)
 
@@ -420,49 +795,59 @@ class BuildCommand(object):
             self.lrc, source.repo.url,
             source.sha1, done)
 
-    def cache_artifacts_locally(self, artifacts):
-        '''Get artifacts missing from local cache from remote cache.'''
+    def cache_artifacts_locally(self, artifacts, background=False):
+        '''Get artifacts missing from local cache from remote cache.
 
-        def fetch_files(to_fetch):
-            '''Fetch a set of files atomically.
+        With `background`, this is being done ahead of the build by the
+        prefetcher, so progress is not shown, artifacts missing from the
+        remote cache are not logged as errors, and downloads are kept within
+        the prefetch bandwidth limit.
 
-            If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
+        '''
 
-            '''
-            try:
-                for remote, local in to_fetch:
-                    shutil.copyfileobj(remote, local)
-            except BaseException:
-                for remote, local in to_fetch:
-                    local.abort()
-                raise
-            else:
-                for remote, local in to_fetch:
-                    remote.close()
-                    local.close()
+        log = logging.debug if background else logging.error
+        limit = self.prefetch_bandwidth if background else None
 
+        # All the files of one source are saved together, or not at all.
+        groups = collections.OrderedDict()
         for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
             to_fetch = []
             if not self.lac.has(artifact):
-                to_fetch.append((self.rac.get(artifact),
-                                 self.lac.put(artifact)))
+                to_fetch.append((artifact, None))
 
-            if artifact.source.morphology.needs_artifact_metadata_cached:
-                if not self.lac.has_artifact_metadata(artifact, 'meta'):
-                    to_fetch.append((
-                        self.rac.get_artifact_metadata(artifact, 'meta'),
-                        self.lac.put_artifact_metadata(artifact, 'meta')))
+            morphology = artifact.source.morphology
+            if (morphology.needs_artifact_metadata_cached and
+                    not self.lac.has_artifact_metadata(artifact, 'meta')):
+                # Systems built before their metadata was cached have none,
+                # and can still be deployed without it.
+                if (morphology['kind'] != 'system' or
+                        self.rac.has_artifact_metadata(artifact, 'meta')):
+                    to_fetch.append((artifact, 'meta'))
 
             if len(to_fetch) > 0:
-                self.app.status(
-                    msg='Fetching to local cache: artifact %(name)s',
-                    name=artifact.name)
-                fetch_files(to_fetch)
+                if background:
+                    logging.debug('Prefetching artifact %s' % artifact.name)
+                else:
+                    self.app.status(
+                        msg='Fetching to local cache: artifact %(name)s',
+                        name=artifact.name)
+                groups.setdefault(artifact.source, []).extend(to_fetch)
+
+        if not groups:
+            return
+        starttime = time.time()
+        size = self.rac.copy_to(self.lac, groups.values(), log=log,
+                                limit=limit)
+        if not background:
+            self.report_download(sum(len(g) for g in groups.itervalues()),
+                                 size, time.time() - starttime)
+
+    def report_download(self, files, size, seconds):
+        mebibytes = size / float(1024 ** 2)
+        self.app.status(msg='Fetched %(files)d files, %(size).1f MiB, '
+                            'in %(seconds).1f seconds (%(rate).1f MiB/s)',
+                        files=files, size=mebibytes, seconds=seconds,
+                        rate=mebibytes / max(seconds, 0.001), chatty=True)
 
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
@@ -502,6 +887,17 @@ class BuildCommand(object):
             return set(s.morphology for s in dependent_strata)
         return dependent_stratum_morphs(s1) == dependent_stratum_morphs(s2)
 
+    def staged_artifacts(self, artifacts, target_source):
+        '''Return the artifacts to install in a source's staging area.'''
+
+        for artifact in artifacts:
+            if artifact.source.morphology['kind'] != 'chunk':
+                continue
+            if artifact.source.build_mode == 'bootstrap':
+                if not self.in_same_stratum(artifact.source, target_source):
+                    continue
+            yield artifact
+
     def install_dependencies(self, staging_area, artifacts, target_source):
         '''Install chunk artifacts into staging area.
 
@@ -513,22 +909,16 @@ class BuildCommand(object):
 
         '''
 
-        for artifact in artifacts:
-            if artifact.source.morphology['kind'] != 'chunk':
-                continue
-            if artifact.source.build_mode == 'bootstrap':
-               if not self.in_same_stratum(artifact.source, target_source):
-                    continue
+        handles = []
+        for artifact in self.staged_artifacts(artifacts, target_source):
             self.app.status(
                 msg='Installing chunk %(chunk_name)s from cache %(cache)s',
                 chunk_name=artifact.name,
                 cache=artifact.source.cache_key[:7],
                 chatty=True)
-            handle = self.lac.get(artifact)
-            staging_area.install_artifact(handle)
-
-        if target_source.build_mode == 'staging':
-            morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
+            handles.append(self.lac.get(artifact))
+        staging_area.install_artifacts(
+            handles, ldconfig=target_source.build_mode == 'staging')
 
     def build_and_cache(self, staging_area, source, setup_mounts):
         '''Build a source and put its artifacts into the local cache.'''
@@ -538,7 +928,7 @@ class BuildCommand(object):
                         name=source.name, sha1=source.sha1[:7])
         builder = morphlib.builder.Builder(
             self.app, staging_area, self.lac, self.rac, self.lrc,
-            self.app.settings['max-jobs'], setup_mounts)
+            self.app.settings['max-jobs'], setup_mounts, self.jobserver)
         return builder.build_and_cache(source)
 
 class InitiatorBuildCommand(BuildCommand):
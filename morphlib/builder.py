@@ -36,15 +36,15 @@ import morphlib.gitversion
 SYSTEM_INTEGRATION_PATH = os.path.join('baserock', 'system-integration')
 
 def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
-    '''Get sources from git to a source directory, including submodules'''
+    '''Get sources from git to a source directory, including submodules
 
-    def extract_repo(repo, sha1, destdir):
-        app.status(msg='Extracting %(source)s into %(target)s',
-                   source=repo.original_name,
-                   target=destdir)
+    If the same tree, with the same submodules, was extracted before, it
+    is copied from the source tree cache instead, and only the .git
+    directories are set up again.
+
+    '''
 
-        repo.checkout(sha1, destdir)
-        morphlib.git.reset_workdir(app.runcmd, destdir)
+    def submodules_of(repo, sha1, destdir):
         submodules = morphlib.git.Submodules(app, repo.path, sha1)
         try:
             submodules.load()
@@ -58,12 +58,46 @@ def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
                 tuples.append((cached_repo, sub.commit, sub_dir))
             return tuples
 
+    # Each repository comes before its submodules, which are checked out
+    # inside it.
+    checkouts = []
     todo = [(repo, sha1, srcdir)]
     while todo:
-        repo, sha1, srcdir = todo.pop()
-        todo += extract_repo(repo, sha1, srcdir)
+        checkouts.append(todo.pop())
+        todo += submodules_of(*checkouts[-1])
+
+    source_cache = morphlib.util.new_source_tree_cache(app.settings)
+    if source_cache is not None:
+        key = source_cache.key(
+            repo.resolve_ref_to_tree(sha1),
+            [(os.path.relpath(destdir, srcdir), commit)
+             for cached_repo, commit, destdir in checkouts[1:]])
+        reference = source_cache.acquire_existing(key)
+        if reference is not None:
+            app.status(msg='Copying %(source)s into %(target)s from the '
+                           'source tree cache',
+                       source=repo.original_name, target=srcdir)
+            try:
+                source_cache.copy_tree(reference, srcdir, app.runcmd)
+            finally:
+                reference.release()
+            for cached_repo, commit, destdir in checkouts:
+                cached_repo.add_git_directory(commit, destdir)
+            return
+
+    for cached_repo, commit, destdir in checkouts:
+        app.status(msg='Extracting %(source)s into %(target)s',
+                   source=cached_repo.original_name,
+                   target=destdir)
+        cached_repo.checkout(commit, destdir)
     set_mtime_recursively(srcdir)
 
+    if source_cache is not None:
+        source_cache.add_tree(
+            key, srcdir,
+            [os.path.join(destdir, '.git') for r, c, destdir in checkouts],
+            app.runcmd)
+
 def set_mtime_recursively(root):  # pragma: no cover
     '''Set the mtime for every file in a directory tree to the same.
 
@@ -124,22 +158,20 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
 
 
 def download_depends(constituents, lac, rac, metadatas=None):
+    groups = []
     for constituent in constituents:
+        group = []
         if not lac.has(constituent):
-            source = rac.get(constituent)
-            target = lac.put(constituent)
-            shutil.copyfileobj(source, target)
-            target.close()
-            source.close()
+            group.append((constituent, None))
         if metadatas is not None:
             for metadata in metadatas:
                 if not lac.has_artifact_metadata(constituent, metadata):
                     if rac.has_artifact_metadata(constituent, metadata):
-                        src = rac.get_artifact_metadata(constituent, metadata)
-                        dst = lac.put_artifact_metadata(constituent, metadata)
-                        shutil.copyfileobj(src, dst)
-                        dst.close()
-                        src.close()
+                        group.append((constituent, metadata))
+        if group:
+            groups.append(group)
+    if groups:
+        rac.copy_to(lac, groups)
 
 
 class BuilderBase(object):
@@ -148,7 +180,7 @@ class BuilderBase(object):
 
     def __init__(self, app, staging_area, local_artifact_cache,
                  remote_artifact_cache, source, repo_cache, max_jobs,
-                 setup_mounts):
+                 setup_mounts, jobserver=None):
         self.app = app
         self.staging_area = staging_area
         self.local_artifact_cache = local_artifact_cache
@@ -158,6 +190,7 @@ class BuilderBase(object):
         self.max_jobs = max_jobs
         self.build_watch = morphlib.stopwatch.Stopwatch()
         self.setup_mounts = setup_mounts
+        self.jobserver = jobserver
 
     def save_build_times(self):
         '''Write the times captured by the stopwatch'''
@@ -290,6 +323,8 @@ class ChunkBuilder(BuilderBase):
                 self.create_devices(destdir)
 
                 os.rename(temppath, logpath)
+                cache.add_source_metadata(
+                    self.source, self.source.cache_key, 'build-log')
             except BaseException, e:
                 logging.error('Caught exception: %s' % str(e))
                 logging.info('Cleaning up staging area')
@@ -301,6 +336,8 @@ class ChunkBuilder(BuilderBase):
                                           line.rstrip('\n'))
 
                     os.rename(temppath, logpath)
+                    cache.add_source_metadata(
+                        self.source, self.source.cache_key, 'build-log')
                 else:
                     logging.error("Couldn't find build log at %s", temppath)
 
@@ -348,11 +385,17 @@ class ChunkBuilder(BuilderBase):
                         log.write('# %s\n' % step)
 
                 for cmd in cmds:
+                    jobserver = None
                     if in_parallel:
                         max_jobs = self.source.morphology['max-jobs']
-                        if max_jobs is None:
-                            max_jobs = self.max_jobs
-                        extra_env['MAKEFLAGS'] = '-j%s' % max_jobs
+                        if max_jobs is None and self.jobserver:
+                            # Share the jobs with the other builds.
+                            jobserver = self.jobserver
+                            extra_env['MAKEFLAGS'] = jobserver.makeflags()
+                        else:
+                            if max_jobs is None:
+                                max_jobs = self.max_jobs
+                            extra_env['MAKEFLAGS'] = '-j%s' % max_jobs
                     else:
                         extra_env['MAKEFLAGS'] = '-j1'
 
@@ -372,7 +415,8 @@ class ChunkBuilder(BuilderBase):
                                     stdout=stdout or subprocess.PIPE,
                                     stderr=subprocess.STDOUT,
                                     logfile=logfilepath,
-                                    ccache_dir=ccache_dir)
+                                    ccache_dir=ccache_dir,
+                                    jobserver=jobserver)
 
                         if stdout:
                             stdout.flush()
@@ -437,37 +481,49 @@ class ChunkBuilder(BuilderBase):
 
         system_integration = morphology.get(sys_tag) or {}
 
+        def all_parents(path):
+            while path != '':
+                yield path
+                path = os.path.dirname(path)
+
+        def parentify(filenames):
+            names = set()
+            for name in filenames:
+                names.update(all_parents(name))
+            return sorted(names)
+
         with self.build_watch('create-chunks'):
-            for chunk_artifact_name, chunk_artifact \
-                in source.artifacts.iteritems():
-                file_paths = matches[chunk_artifact_name]
-                chunk_artifact = source.artifacts[chunk_artifact_name]
-
-                def all_parents(path):
-                    while path != '':
-                        yield path
-                        path = os.path.dirname(path)
-
-                def parentify(filenames):
-                    names = set()
-                    for name in filenames:
-                        names.update(all_parents(name))
-                    return sorted(names)
-
-                extra_files = self.write_system_integration_commands(
-                                  destdir, system_integration,
-                                  chunk_artifact_name)
-                extra_files += ['baserock/%s.meta' % chunk_artifact_name]
-                parented_paths = parentify(file_paths + extra_files)
-
-                with self.local_artifact_cache.put(chunk_artifact) as f:
+            # All the artifacts are written in one pass over destdir.
+            # Leaving the with block on an error would still save the
+            # files, so an interrupted build could leave truncated
+            # artifacts in the cache.
+            outputs = []
+            try:
+                for chunk_artifact_name, chunk_artifact \
+                    in source.artifacts.iteritems():
+                    file_paths = matches[chunk_artifact_name]
+
+                    extra_files = self.write_system_integration_commands(
+                                      destdir, system_integration,
+                                      chunk_artifact_name)
+                    extra_files += ['baserock/%s.meta' % chunk_artifact_name]
+                    parented_paths = parentify(file_paths + extra_files)
+
                     self.write_metadata(destdir, chunk_artifact_name,
                                         parented_paths)
 
                     self.app.status(msg='Creating chunk artifact %(name)s',
                                     name=chunk_artifact_name)
-                    morphlib.bins.create_chunk(destdir, f, parented_paths)
-                built_artifacts.append(chunk_artifact)
+                    handle = self.local_artifact_cache.put(chunk_artifact)
+                    outputs.append((handle, parented_paths))
+                    built_artifacts.append(chunk_artifact)
+                morphlib.bins.create_chunks(destdir, outputs)
+            except BaseException:
+                for handle, parented_paths in outputs:
+                    handle.abort()
+                raise
+            for handle, parented_paths in outputs:
+                handle.close()
 
         for dirname, subdirs, files in os.walk(destdir):
             if files:
@@ -508,10 +564,23 @@ class StratumBuilder(BuilderBase):
                     meta = self.create_metadata(
                         a_name,
                         [x.name for x in constituents])
-                    with lac.put_artifact_metadata(a, 'meta')  as f:
-                        json.dump(meta, f, indent=4, sort_keys=True)
-                    with self.local_artifact_cache.put(a) as f:
-                        json.dump([c.basename() for c in constituents], f)
+                    handle = lac.put_artifact_metadata(a, 'meta')
+                    try:
+                        json.dump(meta, handle, indent=4, sort_keys=True)
+                    except BaseException:
+                        handle.abort()
+                        raise
+                    else:
+                        handle.close()
+                    handle = self.local_artifact_cache.put(a)
+                    try:
+                        json.dump([c.basename() for c in constituents],
+                                  handle)
+                    except BaseException:
+                        handle.abort()
+                        raise
+                    else:
+                        handle.close()
         self.save_build_times()
         return self.source.artifacts.values()
 
@@ -561,6 +630,20 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
                 else:
                     handle.close()
 
+                # The strata are recorded so that `morph gc` can keep what
+                # the system refers to for as long as the system.
+                meta = self.create_metadata(
+                    a_name, [a.basename() for a in self.source.dependencies])
+                handle = self.local_artifact_cache.put_artifact_metadata(
+                    artifact, 'meta')
+                try:
+                    json.dump(meta, handle, indent=4, sort_keys=True)
+                except BaseException:
+                    handle.abort()
+                    raise
+                else:
+                    handle.close()
+
         self.save_build_times()
         return self.source.artifacts.itervalues()
 
@@ -675,7 +758,8 @@ class Builder(object):  # pragma: no cover
     }
 
     def __init__(self, app, staging_area, local_artifact_cache,
-                 remote_artifact_cache, repo_cache, max_jobs, setup_mounts):
+                 remote_artifact_cache, repo_cache, max_jobs, setup_mounts,
+                 jobserver=None):
         self.app = app
         self.staging_area = staging_area
         self.local_artifact_cache = local_artifact_cache
@@ -683,6 +767,7 @@ class Builder(object):  # pragma: no cover
         self.repo_cache = repo_cache
         self.max_jobs = max_jobs
         self.setup_mounts = setup_mounts
+        self.jobserver = jobserver
 
     def build_and_cache(self, source):
         kind = source.morphology['kind']
@@ -690,7 +775,7 @@ class Builder(object):  # pragma: no cover
                                self.local_artifact_cache,
                                self.remote_artifact_cache, source,
                                self.repo_cache, self.max_jobs,
-                               self.setup_mounts)
+                               self.setup_mounts, self.jobserver)
         self.app.status(msg='Builder.build: artifact %s with %s' %
                        (source.name, repr(o)),
                        chatty=True)
@@ -135,6 +135,18 @@ class FakeArtifactCache(object):
     def has_source_metadata(self, source, cachekey, name):
         return (cachekey, name) in self._cached
 
+    def copy_to(self, lac, groups):
+        for group in groups:
+            for artifact, name in group:
+                if name is None:
+                    source = self.get(artifact)
+                    target = lac.put(artifact)
+                else:
+                    source = self.get_artifact_metadata(artifact, name)
+                    target = lac.put_artifact_metadata(artifact, name)
+                target.write(source.read())
+                target.close()
+
 
 class BuilderBaseTests(unittest.TestCase):
 
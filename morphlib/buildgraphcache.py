@@ -0,0 +1,265 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import cPickle
+import hashlib
+import logging
+import os
+
+import morphlib
+
+
+def _get_fields(obj):
+    # Sources and artifacts keep most attributes in slots, and any others
+    # in their __dict__.
+    fields = dict(obj.__dict__)
+    for name in type(obj).__slots__:
+        if name != '__dict__' and hasattr(obj, name):
+            fields[name] = getattr(obj, name)
+    return fields
+
+
+def _set_fields(obj, fields):
+    for name, value in fields.iteritems():
+        setattr(obj, name, value)
+
+
+def encode_graph(root_artifact):
+    '''Flatten the build graph of an artifact into lists.
+
+    Sources and artifacts refer to each other by their index in the lists,
+    so that the graph can be pickled without recursing down every chain of
+    dependencies. Morphologies and split rules are kept as they are.
+
+    '''
+
+    # Only the sources the root artifact is built from are included. In a
+    # source pool with several systems, artifacts also have dependents
+    # from the other systems, which are left out.
+    sources = []
+    source_ids = {}
+    queue = collections.deque([root_artifact.source])
+    while queue:
+        source = queue.popleft()
+        if source in source_ids:
+            continue
+        source_ids[source] = len(sources)
+        sources.append(source)
+        queue.extend(a.source for a in source.dependencies)
+
+    artifacts = []
+    artifact_ids = {}
+    for source in sources:
+        for artifact in source.artifacts.itervalues():
+            artifact_ids[artifact] = len(artifacts)
+            artifacts.append(artifact)
+
+    def encode_source(source):
+        fields = _get_fields(source)
+        fields['dependencies'] = [artifact_ids[a]
+                                  for a in source.dependencies]
+        fields['artifacts'] = dict((name, artifact_ids[a])
+                                   for name, a
+                                   in source.artifacts.iteritems())
+        return fields
+
+    def encode_artifact(artifact):
+        fields = _get_fields(artifact)
+        fields['source'] = source_ids[artifact.source]
+        fields['dependents'] = [source_ids[s] for s in artifact.dependents
+                                if s in source_ids]
+        return fields
+
+    return {
+        'sources': [encode_source(s) for s in sources],
+        'artifacts': [encode_artifact(a) for a in artifacts],
+        'root': artifact_ids[root_artifact],
+    }
+
+
+def decode_graph(encoded):
+    '''Rebuild the build graph from encode_graph() and return its root.'''
+
+    sources = [object.__new__(morphlib.source.Source)
+               for fields in encoded['sources']]
+    artifacts = [object.__new__(morphlib.artifact.Artifact)
+                 for fields in encoded['artifacts']]
+
+    for source, fields in zip(sources, encoded['sources']):
+        _set_fields(source, fields)
+        source.dependencies = morphlib.orderedset.OrderedSet(
+            artifacts[i] for i in fields['dependencies'])
+        source.artifacts = dict((name, artifacts[i])
+                                for name, i in fields['artifacts'].iteritems())
+
+    for artifact, fields in zip(artifacts, encoded['artifacts']):
+        _set_fields(artifact, fields)
+        artifact.source = sources[fields['source']]
+        artifact.dependents = morphlib.orderedset.OrderedSet(
+            sources[i] for i in fields['dependents'])
+
+    return artifacts[encoded['root']]
+
+
+class BuildGraphCache(object):
+
+    '''Keep resolved build graphs, with cache keys, on disk.
+
+    Building, deploying and listing the artifacts of a system all start by
+    creating a source pool, resolving its artifacts and computing their
+    cache keys. For a given definitions commit and system, that always
+    gives the same graph, as long as the named chunk refs in it still point
+    at the same commits and the build environment's part of the cache keys
+    is the same. So the finished graph is stored under the repo, ref,
+    commit and filename of the system, and the version of Morph.
+
+    Each entry starts with a small header recording the named chunk refs,
+    the system's architecture and the environment, and whether the sources
+    were validated. The rest of the entry is only unpickled if the header
+    still matches.
+
+    The total size is kept below `max_size` bytes by removing the least
+    recently used entries. A `max_size` of 0 disables the cache.
+
+    '''
+
+    def __init__(self, cachedir, max_size, version=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.version = version or morphlib.__version__
+
+    def _enabled(self, commit):
+        return (self.max_size > 0 and
+                not self.version.endswith('-unreproducible') and
+                morphlib.git.is_valid_sha1(commit))
+
+    def _path(self, reponame, ref, commit, filename):
+        key = '\0'.join((self.version, reponame, ref, commit, filename))
+        return os.path.join(self.cachedir, hashlib.sha1(key).hexdigest())
+
+    @staticmethod
+    def _named_refs(root_artifact, reponame, ref):
+        named_refs = {}
+        for artifact in root_artifact.walk():
+            source = artifact.source
+            pair = (source.repo_name, source.original_ref)
+            if (pair != (reponame, ref) and
+                    not morphlib.git.is_valid_sha1(source.original_ref)):
+                named_refs[pair] = source.sha1
+        return named_refs
+
+    def get(self, reponame, ref, commit, filename, new_build_env,
+            resolve_refs, validated=True):
+        '''Return the root artifact of a cached build graph, or None.
+
+        `ref` is what the user asked for and `commit` what it resolved to.
+        `new_build_env` is called with the system's architecture to create
+        the build environment, which is set as the root artifact's
+        `build_env`. `resolve_refs` is called with a list of (repo, ref)
+        pairs and must return a dict mapping them to (commit, tree). If
+        `validated` is true, graphs that were stored without validating
+        their sources are not returned.
+
+        '''
+
+        if not self._enabled(commit):
+            return None
+        path = self._path(reponame, ref, commit, filename)
+        try:
+            with open(path, 'rb') as f:
+                header = cPickle.load(f)
+                if validated and not header['validated']:
+                    return None
+                build_env = new_build_env(header['arch'])
+                ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+                if header['env'] != ckc.get_cache_env():
+                    return None
+                named_refs = header['named-refs']
+                resolved = resolve_refs(named_refs.keys())
+                if any(resolved[pair][0] != sha1
+                       for pair, sha1 in named_refs.iteritems()):
+                    return None
+                root_artifact = decode_graph(cPickle.load(f))
+        except IOError:
+            return None
+        except (cPickle.UnpicklingError, EOFError, KeyError, IndexError,
+                AttributeError, TypeError, ValueError), e:
+            logging.warning('Removing unreadable cached build graph %s: %s' %
+                            (path, e))
+            self._remove(path)
+            return None
+
+        os.utime(path, None)
+        root_artifact.build_env = build_env
+        return root_artifact
+
+    def put(self, reponame, ref, commit, filename, root_artifact,
+            validated=True):
+        '''Store a build graph whose cache keys have been computed.'''
+
+        if not self._enabled(commit):
+            return
+        build_env = root_artifact.build_env
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        header = {
+            'arch': root_artifact.source.morphology['arch'],
+            'env': ckc.get_cache_env(),
+            'named-refs': self._named_refs(root_artifact, reponame, ref),
+            'validated': validated,
+        }
+
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        path = self._path(reponame, ref, commit, filename)
+        # The build environment is not pickled, as it is made again from
+        # the settings when the graph is loaded.
+        del root_artifact.build_env
+        try:
+            with morphlib.savefile.SaveFile(path, 'wb') as f:
+                cPickle.dump(header, f, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(encode_graph(root_artifact), f,
+                             cPickle.HIGHEST_PROTOCOL)
+        finally:
+            root_artifact.build_env = build_env
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            # Skip temporary files that SaveFile is still writing.
+            if not morphlib.git.is_valid_sha1(name):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        size = sum(size for mtime, size, path in entries)
+        for mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            logging.debug('Evicting cached build graph %s' % path)
+            self._remove(path)
+            size -= entry_size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,217 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class DummyBuildEnvironment(object):
+
+    def __init__(self, env, arch):
+        self.env = dict(env)
+        self.arch = arch
+
+
+class BuildGraphCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'build-graphs')
+        self.cache = morphlib.buildgraphcache.BuildGraphCache(
+            self.cachedir, 1024 * 1024, version='1')
+        self.commit = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        self.chunk_sha1 = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+        self.env = {
+            "LOGNAME": "foouser",
+            "MORPH_ARCH": "testarch",
+            "TARGET": "testarch-baserock-linux-gnu",
+            "TARGET_STAGE1": "testarch-baserock-linux-gnu",
+            "USER": "foouser",
+            "USERNAME": "foouser",
+        }
+        self.resolved = []
+        self.root = self.resolve_graph()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def resolve_graph(self):
+        loader = morphlib.morphloader.MorphologyLoader()
+        pool = morphlib.sourcepool.SourcePool()
+        morphs = [
+            ('definitions', 'master', 'system.morph', self.commit, '''
+                name: system
+                kind: system
+                arch: testarch
+                strata:
+                    - morph: stratum
+             '''),
+            ('definitions', 'master', 'stratum.morph', self.commit, '''
+                name: stratum
+                kind: stratum
+                build-depends: []
+                chunks:
+                    - name: chunk
+                      repo: chunks
+                      ref: master
+                      build-depends: []
+                    - name: chunk2
+                      repo: chunks
+                      ref: master
+                      morph: chunk2.morph
+                      build-depends: [chunk]
+             '''),
+            ('chunks', 'master', 'chunk.morph', self.chunk_sha1, '''
+                name: chunk
+                kind: chunk
+             '''),
+            ('chunks', 'master', 'chunk2.morph', self.chunk_sha1, '''
+                name: chunk2
+                kind: chunk
+             '''),
+        ]
+        for repo, ref, filename, sha1, text in morphs:
+            morph = loader.load_from_string(text)
+            for source in morphlib.source.make_sources(
+                    repo, ref, filename, sha1, 'tree', morph):
+                pool.add(source)
+
+        resolver = morphlib.artifactresolver.ArtifactResolver()
+        root, = resolver.resolve_root_artifacts(pool)
+        root.build_env = self.new_build_env('testarch')
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(root.build_env)
+        for source in set(a.source for a in root.walk()):
+            source.cache_key = ckc.compute_key(source)
+            source.cache_id = ckc.get_cache_id(source)
+        return root
+
+    def new_build_env(self, arch):
+        return DummyBuildEnvironment(self.env, arch)
+
+    def resolve_refs(self, pairs):
+        self.resolved.extend(pairs)
+        return dict((pair, (self.chunk_sha1, 'tree')) for pair in pairs)
+
+    def get(self, cache=None):
+        cache = cache or self.cache
+        return cache.get('definitions', 'master', self.commit,
+                         'system.morph', self.new_build_env,
+                         self.resolve_refs)
+
+    def put(self):
+        self.cache.put('definitions', 'master', self.commit, 'system.morph',
+                       self.root)
+
+    def describe(self, root):
+        return [(str(a), a.source.cache_key,
+                 sorted(str(d) for d in a.source.dependencies),
+                 sorted(str(s) for s in a.dependents))
+                for a in root.walk()]
+
+    def test_returns_none_when_not_cached(self):
+        self.assertEqual(self.get(), None)
+
+    def test_returns_same_graph(self):
+        self.put()
+        root = self.get()
+        self.assertEqual(self.describe(root), self.describe(self.root))
+        self.assertEqual(root.build_env.arch, 'testarch')
+        self.assertEqual(root.source.morphology['name'], 'system')
+
+    def test_keeps_build_env_of_stored_graph(self):
+        build_env = self.root.build_env
+        self.put()
+        self.assertTrue(self.root.build_env is build_env)
+
+    def test_checks_named_refs_only(self):
+        self.put()
+        self.get()
+        self.assertEqual(self.resolved, [('chunks', 'master')])
+
+    def test_misses_when_named_ref_moved(self):
+        self.put()
+        self.chunk_sha1 = '0' * 40
+        self.assertEqual(self.get(), None)
+
+    def test_misses_when_env_changed(self):
+        self.put()
+        self.env['USER'] = 'brian'
+        self.assertEqual(self.get(), None)
+
+    def test_keys_on_morph_version(self):
+        self.put()
+        cache = morphlib.buildgraphcache.BuildGraphCache(
+            self.cachedir, 1024 * 1024, version='2')
+        self.assertEqual(self.get(cache), None)
+
+    def test_returns_unvalidated_graph_only_if_asked(self):
+        self.cache.put('definitions', 'master', self.commit, 'system.morph',
+                       self.root, validated=False)
+        self.assertEqual(self.get(), None)
+        self.assertNotEqual(
+            self.cache.get('definitions', 'master', self.commit,
+                           'system.morph', self.new_build_env,
+                           self.resolve_refs, validated=False),
+            None)
+
+    def test_does_not_cache_named_definitions_refs(self):
+        self.cache.put('definitions', 'master', 'master', 'system.morph',
+                       self.root)
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def test_does_not_look_up_named_definitions_refs(self):
+        self.put()
+        self.assertEqual(
+            self.cache.get('definitions', 'master', 'master',
+                           'system.morph', self.new_build_env,
+                           self.resolve_refs),
+            None)
+        self.assertEqual(self.resolved, [])
+
+    def test_removes_corrupt_entries(self):
+        self.put()
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), 'w') as f:
+                f.write('garbage')
+        self.assertEqual(self.get(), None)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_evicts_when_full(self):
+        self.put()
+        path, = os.listdir(self.cachedir)
+        size = os.path.getsize(os.path.join(self.cachedir, path))
+        cache = morphlib.buildgraphcache.BuildGraphCache(
+            self.cachedir, size * 3 / 2, version='1')
+        os.utime(os.path.join(self.cachedir, path), (0, 0))
+        cache.put('definitions', 'other', self.commit, 'system.morph',
+                  self.root)
+        self.assertEqual(self.get(cache), None)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+    def test_eviction_ignores_temporary_files_and_broken_entries(self):
+        os.makedirs(self.cachedir)
+        with open(os.path.join(self.cachedir, 'tmpabcdef'), 'w') as f:
+            f.write('x' * 2 * 1024 * 1024)
+        os.symlink('missing', os.path.join(self.cachedir, '0' * 40))
+        self.put()
+        self.assertNotEqual(self.get(), None)
+
+    def test_ignores_entries_removed_by_another_process(self):
+        self.cache._remove(os.path.join(self.cachedir, '0' * 40))
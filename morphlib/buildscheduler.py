@@ -0,0 +1,79 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import heapq
+
+
+class BuildScheduler(object):
+
+    '''Decide which sources can be built while others are building.
+
+    The sources are given in build order, as from walking the root
+    artifact, so that every source comes after the sources it depends on.
+    A source is ready once every source it depends on is done. Ready
+    sources are taken in build order, so with one build at a time the
+    order is the same as building the list one by one.
+
+    '''
+
+    def __init__(self, sources):
+        self._index = dict((source, i) for i, source in enumerate(sources))
+        self._waiting_for = {}
+        self._dependents = collections.defaultdict(list)
+        self._ready = []
+        self._remaining = len(self._index)
+
+        for source, i in self._index.iteritems():
+            dependencies = set(a.source for a in source.dependencies
+                               if a.source in self._index)
+            dependencies.discard(source)
+            self._waiting_for[source] = len(dependencies)
+            for dependency in dependencies:
+                self._dependents[dependency].append(source)
+            if not dependencies:
+                heapq.heappush(self._ready, (i, source))
+
+    @property
+    def finished(self):
+        '''Are all the sources done?'''
+        return self._remaining == 0
+
+    def ready_count(self):
+        '''Return how many sources are ready to be taken.'''
+        return len(self._ready)
+
+    def take(self):
+        '''Return the next source that is ready, or None if there is none.
+
+        The caller must call done() once the source has been built.
+
+        '''
+
+        if not self._ready:
+            return None
+        i, source = heapq.heappop(self._ready)
+        return source
+
+    def done(self, source):
+        '''Record that a source taken earlier has been built.'''
+
+        self._remaining -= 1
+        for dependent in self._dependents.pop(source, []):
+            self._waiting_for[dependent] -= 1
+            if self._waiting_for[dependent] == 0:
+                heapq.heappush(self._ready, (self._index[dependent],
+                                             dependent))
@@ -0,0 +1,91 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import morphlib
+
+
+class DummyArtifact(object):
+
+    def __init__(self, source):
+        self.source = source
+
+
+class DummySource(object):
+
+    def __init__(self, name, *dependencies):
+        self.name = name
+        self.dependencies = [DummyArtifact(d) for d in dependencies]
+
+    def __repr__(self):
+        return self.name
+
+
+class BuildSchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        # a and b are independent, c needs both, d needs c
+        self.a = DummySource('a')
+        self.b = DummySource('b')
+        self.c = DummySource('c', self.a, self.b)
+        self.d = DummySource('d', self.c)
+        self.scheduler = morphlib.buildscheduler.BuildScheduler(
+            [self.a, self.b, self.c, self.d])
+
+    def take_all(self):
+        taken = []
+        while True:
+            source = self.scheduler.take()
+            if source is None:
+                return taken
+            taken.append(source)
+
+    def test_independent_sources_are_ready_together(self):
+        self.assertEqual(self.scheduler.ready_count(), 2)
+        self.assertEqual(self.take_all(), [self.a, self.b])
+
+    def test_waits_for_all_dependencies(self):
+        self.take_all()
+        self.scheduler.done(self.a)
+        self.assertEqual(self.take_all(), [])
+        self.scheduler.done(self.b)
+        self.assertEqual(self.take_all(), [self.c])
+
+    def test_builds_in_given_order_one_at_a_time(self):
+        order = []
+        while not self.scheduler.finished:
+            source = self.scheduler.take()
+            order.append(source)
+            self.scheduler.done(source)
+        self.assertEqual(order, [self.a, self.b, self.c, self.d])
+
+    def test_ignores_dependencies_outside_the_list(self):
+        other = DummySource('other')
+        source = DummySource('source', other)
+        scheduler = morphlib.buildscheduler.BuildScheduler([source])
+        self.assertEqual(scheduler.take(), source)
+        scheduler.done(source)
+        self.assertTrue(scheduler.finished)
+
+    def test_is_finished_only_when_all_done(self):
+        for source in (self.a, self.b, self.c):
+            self.scheduler.take()
+            self.assertFalse(self.scheduler.finished)
+            self.scheduler.done(source)
+        self.scheduler.take()
+        self.scheduler.done(self.d)
+        self.assertTrue(self.scheduler.finished)
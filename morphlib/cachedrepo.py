@@ -15,7 +15,11 @@
 
 
 import cliapp
+import contextlib
+import fcntl
 import os
+import shutil
+import tempfile
 
 import morphlib
 
@@ -131,6 +135,15 @@ class CachedRepo(object):
         '''
         return self._gitdir.list_files(ref, recurse)
 
+    def list_file_sha1s(self, ref):  # pragma: no cover
+        '''Return a dict mapping each file at a ref to its object SHA1.
+
+        Raises a gitdir.InvalidRefError if the ref is not found in the
+        repository.
+
+        '''
+        return self._gitdir.list_file_sha1s(ref)
+
     def clone_checkout(self, ref, target_dir):
         '''Clone from the cache into the target path and check out a given ref.
 
@@ -162,13 +175,41 @@ class CachedRepo(object):
         if not os.path.exists(target_dir):
             os.mkdir(target_dir)
 
-        # Note, we copy instead of cloning because it's much faster in the case
-        # that the target is on a different filesystem from the cache. We then
-        # take care to turn the copy into something as good as a real clone.
+        # The copy shares its objects with the cache where possible, so only
+        # the work tree is written out.
         self._copy_repository(self.path, target_dir)
 
         self._checkout_ref_in_clone(ref, target_dir)
 
+    def add_git_directory(self, ref, target_dir):  # pragma: no cover
+        '''Make a directory holding the files of a commit a checkout of it.
+
+        This sets up `.git` in `target_dir` as checkout() would, without
+        writing out the files again. Raises a CopyError or a CheckoutError
+        if something goes wrong.
+
+        '''
+
+        clone_dir = tempfile.mkdtemp(dir=target_dir)
+        try:
+            self._copy_repository(self.path, clone_dir)
+            os.rename(os.path.join(clone_dir, '.git'),
+                      os.path.join(target_dir, '.git'))
+        finally:
+            shutil.rmtree(clone_dir)
+
+        try:
+            morphlib.git.gitcmd(self.app.runcmd, 'update-ref', '--no-deref',
+                                'HEAD', ref, cwd=target_dir)
+            morphlib.git.gitcmd(self.app.runcmd, 'read-tree', ref,
+                                cwd=target_dir)
+            # read-tree leaves no stat information in the index, so every
+            # file would look modified to git diff-index and the like.
+            morphlib.git.gitcmd(self.app.runcmd, 'update-index', '-q',
+                                '--refresh', cwd=target_dir)
+        except cliapp.AppException:
+            raise CheckoutError(self, ref, target_dir)
+
     def requires_update_for_ref(self, ref):
         '''Returns False if there's no need to update this cached repo.
 
@@ -205,12 +246,31 @@ class CachedRepo(object):
             return
 
         try:
-            self._gitdir.update_remotes(
-                echo_stderr=self.app.settings['verbose'])
+            with self._update_lock():
+                self._gitdir.update_remotes(
+                    echo_stderr=self.app.settings['verbose'])
             self.already_updated = True
         except cliapp.AppException:
             raise UpdateError(self)
 
+    @contextlib.contextmanager
+    def _update_lock(self):
+        '''Hold an exclusive lock on the repository while updating it.
+
+        Other Morph processes using the same cache, such as parallel
+        builds, wait for an update to finish rather than running git
+        remote update in the same repository at once.
+
+        '''
+
+        fd = os.open(os.path.join(self.path, 'morph-update.lock'),
+                     os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
     def _runcmd(self, *args, **kwargs):  # pragma: no cover
         if not 'cwd' in kwargs:
             kwargs['cwd'] = self.path
@@ -227,7 +287,7 @@ class CachedRepo(object):
     def _copy_repository(self, source_dir, target_dir):  # pragma: no cover
         try:
             morphlib.git.copy_repository(
-                self._runcmd, source_dir, target_dir, self.is_mirror)
+                self._runcmd, source_dir, target_dir)
         except cliapp.AppException:
             raise CopyError(self, target_dir)
 
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import fcntl
 import logging
 import os
 import unittest
@@ -78,14 +79,18 @@ class CachedRepoTests(unittest.TestCase):
         raise cliapp.AppException('git remote update origin')
 
     def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
         self.repo_name = 'foo'
         self.repo_url = 'git://foo.bar/foo.git'
-        self.repo_path = '/tmp/foo'
+        self.repo_path = self.tempfs.getsyspath('foo')
+        os.mkdir(self.repo_path)
         with morphlib.gitdir_tests.allow_nonexistant_git_repos():
             self.repo = morphlib.cachedrepo.CachedRepo(
                 FakeApplication(), self.repo_name, self.repo_url,
                 self.repo_path)
-        self.tempfs = fs.tempfs.TempFS()
+
+    def tearDown(self):
+        self.tempfs.close()
 
     def test_constructor_sets_name_and_url_and_path(self):
         self.assertEqual(self.repo.original_name, self.repo_name)
@@ -149,6 +154,18 @@ class CachedRepoTests(unittest.TestCase):
         self.repo._gitdir.update_remotes = self.update_with_failure
         self.assertRaises(morphlib.cachedrepo.UpdateError, self.repo.update)
 
+    def test_update_locks_out_other_updates(self):
+        def update_remotes(**kwargs):
+            fd = os.open(os.path.join(self.repo_path, 'morph-update.lock'),
+                         os.O_RDWR)
+            try:
+                self.assertRaises(IOError, fcntl.flock, fd,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
+        self.repo._gitdir.update_remotes = update_remotes
+        self.repo.update()
+
     def test_no_update_if_local(self):
         with morphlib.gitdir_tests.allow_nonexistant_git_repos():
             self.repo = morphlib.cachedrepo.CachedRepo(
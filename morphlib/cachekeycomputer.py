@@ -32,6 +32,10 @@ class CacheKeyComputer(object):
                 "USER", "USERNAME"]
         return dict([(k, env[k]) for k in keys])
 
+    def get_cache_env(self):
+        '''Return the part of the build environment in every cache key.'''
+        return self._filterenv(self._build_env.env)
+
     def compute_key(self, source):
         try:
             return self._hashed[source]
@@ -81,7 +85,7 @@ class CacheKeyComputer(object):
 
     def _calculate(self, source):
         keys = {
-            'env': self._filterenv(self._build_env.env),
+            'env': self.get_cache_env(),
             'kids': [{'artifact': a.name,
                       'cache-key': self.compute_key(a.source)}
                      for a in source.dependencies],
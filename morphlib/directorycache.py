@@ -0,0 +1,270 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+
+import morphlib
+
+
+class DirectoryCache(object):
+
+    '''Directory trees kept in a directory, shared between processes.
+
+    Each tree is kept in `DIRNAME/BASENAME.d`. Several processes may use
+    the cache at once:
+
+    * A tree is created in a temporary directory, which is then renamed
+      into place. If another process got there first, the rename fails,
+      and the temporary directory is removed.
+
+    * A process using a tree holds a shared lock on `BASENAME.d.lock`
+      meanwhile, so that the tree is not removed under its feet. The locks
+      are released by the kernel if the process dies.
+
+    * When the trees take up more than `max_size` bytes, the least
+      recently used trees that are not in use are removed. The size of
+      each tree is kept in `BASENAME.d.size`.
+
+    '''
+
+    # Files kept beside each tree, named BASENAME.d.SUFFIX.
+    side_files = ('.size', '.lock')
+
+    def __init__(self, dirname, max_size=0):
+        self.dirname = dirname
+        self.max_size = max_size
+
+    def _path(self, basename, suffix=''):
+        return os.path.join(self.dirname, basename + '.d' + suffix)
+
+    def acquire_existing(self, basename):
+        '''Return a reference to a tree in the cache, or None.
+
+        The directory the tree is in, given by the `path` attribute of the
+        reference, is not removed until the reference's release method is
+        called.
+
+        '''
+
+        if not os.path.exists(self._path(basename)):
+            return None
+        return self._acquire(basename, None)
+
+    def add(self, basename, fill):
+        '''Add a tree to the cache, unless it is there already.
+
+        `fill` is called with the name of an empty directory, to put the
+        tree in. What it returns is passed on to _created().
+
+        '''
+
+        self._acquire(basename, fill).release()
+
+    def _acquire(self, basename, fill):
+        path = self._path(basename)
+        added = False
+        fd = self._lock(basename, fcntl.LOCK_SH)
+        try:
+            if not os.path.exists(path):
+                if fill is None:
+                    os.close(fd)
+                    return None
+                self._create(basename, fill)
+                added = True
+            os.utime(self._path(basename, '.lock'), None)
+        except BaseException:
+            os.close(fd)
+            raise
+        return _Reference(self, path, fd, added)
+
+    def _release(self, reference):
+        os.close(reference.fd)
+        if reference.added and self.max_size > 0:
+            self.evict(self.max_size)
+
+    def _lock(self, basename, operation):
+        '''Lock the lock file of a tree, and return its file descriptor.
+
+        Removing a tree also removes its lock file, so the lock is only
+        taken once the file locked is still the one in the directory.
+
+        '''
+
+        path = self._path(basename, '.lock')
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, operation)
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return fd
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            os.close(fd)
+
+    def _create(self, basename, fill):
+        savedir = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            result = fill(savedir)
+            with morphlib.savefile.SaveFile(
+                    self._path(basename, '.size'), 'w') as f:
+                f.write('%d\n' % self._disk_usage(savedir))
+            self._created(basename, savedir, result)
+            os.rename(savedir, self._path(basename))
+        except OSError as e:
+            shutil.rmtree(savedir)
+            # Another process added the same tree first.
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+        except BaseException:
+            shutil.rmtree(savedir)
+            raise
+
+    def _created(self, basename, dirname, result):
+        '''Called once a tree is filled in, before it is renamed into place.
+
+        `result` is what the fill function returned.
+
+        '''
+
+    @staticmethod
+    def _disk_usage(dirname):
+        '''Return the size of a tree, counting hardlinked files once.'''
+
+        inodes = set()
+        size = 0
+        for dirpath, subdirs, filenames in os.walk(dirname):
+            for name in subdirs + filenames:
+                st = os.lstat(os.path.join(dirpath, name))
+                if (st.st_dev, st.st_ino) not in inodes:
+                    inodes.add((st.st_dev, st.st_ino))
+                    size += st.st_size
+        return size
+
+    def _size(self, basename):
+        try:
+            with open(self._path(basename, '.size')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            size = self._disk_usage(self._path(basename))
+            with morphlib.savefile.SaveFile(
+                    self._path(basename, '.size'), 'w') as f:
+                f.write('%d\n' % size)
+            return size
+
+    def _last_used(self, basename):
+        for suffix in ('.lock', ''):
+            try:
+                return os.stat(self._path(basename, suffix)).st_mtime
+            except OSError:
+                pass
+        return 0
+
+    def contents(self):
+        '''Return (basename, size, last_used) for every tree.'''
+
+        result = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith('.d'):
+                continue
+            basename = name[:-len('.d')]
+            try:
+                result.append((basename, self._size(basename),
+                               self._last_used(basename)))
+            except OSError:
+                # Removed by another process meanwhile.
+                pass
+        return result
+
+    def evict(self, max_size):
+        '''Remove trees until they fit in `max_size` bytes.
+
+        The least recently used trees are removed first. Trees in use are
+        kept, even if that leaves more than `max_size` bytes.
+
+        '''
+
+        contents = self.contents()
+        total = sum(size for basename, size, last_used in contents)
+        for basename, size, last_used in sorted(contents,
+                                                key=lambda x: x[2]):
+            if total <= max_size:
+                break
+            if self._remove(basename):
+                total -= size
+        return total
+
+    def evict_count(self, prefix, max_count):
+        '''Keep only the `max_count` most recently used of some trees.
+
+        This applies to the trees whose basenames start with `prefix`.
+        Those in use are kept regardless.
+
+        '''
+
+        contents = [x for x in self.contents() if x[0].startswith(prefix)]
+        contents.sort(key=lambda x: x[2], reverse=True)
+        for basename, size, last_used in contents[max_count:]:
+            self._remove(basename)
+
+    def _remove(self, basename):
+        try:
+            fd = self._lock(basename, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        try:
+            logging.debug('Removing %s from %s' % (basename, self.dirname))
+            trash = tempfile.mkdtemp(dir=self.dirname)
+            try:
+                os.rename(self._path(basename), os.path.join(trash, 'old'))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            for suffix in self.side_files:
+                try:
+                    os.remove(self._path(basename, suffix))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        finally:
+            os.close(fd)
+        shutil.rmtree(trash)
+        return True
+
+
+class _Reference(object):
+
+    '''A use of a tree, which keeps it in the cache.'''
+
+    def __init__(self, cache, path, fd, added):
+        self.cache = cache
+        self.path = path
+        self.fd = fd
+        self.added = added
+
+    def release(self):
+        if self.fd is not None:
+            self.cache._release(self)
+            self.fd = None
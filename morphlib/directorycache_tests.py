@@ -0,0 +1,319 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class DirectoryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.directorycache.DirectoryCache(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def fill(self, size):
+        def fill(savedir):
+            with open(os.path.join(savedir, 'f'), 'w') as f:
+                f.write('x' * size)
+        return fill
+
+    def add(self, basename, size, last_used):
+        self.cache.add(basename, self.fill(size))
+        os.utime(os.path.join(self.tempdir, basename + '.d.lock'),
+                 (last_used, last_used))
+
+    def names(self):
+        return sorted(x[0] for x in self.cache.contents())
+
+    def test_adds_tree(self):
+        self.cache.add('a', self.fill(10))
+        reference = self.cache.acquire_existing('a')
+        self.assertEqual(reference.path, os.path.join(self.tempdir, 'a.d'))
+        self.assertEqual(os.listdir(reference.path), ['f'])
+        reference.release()
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['a.d', 'a.d.lock', 'a.d.size'])
+
+    def test_passes_result_of_fill_on(self):
+        created = []
+        self.cache._created = lambda basename, dirname, result: \
+            created.append((basename, os.listdir(dirname), result))
+        self.cache.add('a', lambda savedir: 'result')
+        self.assertEqual(created, [('a', [], 'result')])
+
+    def test_does_not_fill_existing_tree(self):
+        self.cache.add('a', self.fill(10))
+        self.cache.add('a', lambda savedir: self.fail('filled again'))
+
+    def test_finds_no_missing_tree(self):
+        self.assertEqual(self.cache.acquire_existing('a'), None)
+
+    def test_finds_no_tree_removed_while_locking(self):
+        self.cache.add('a', self.fill(10))
+        real_lock = self.cache._lock
+
+        def lock(basename, operation):
+            fd = real_lock(basename, operation)
+            shutil.rmtree(os.path.join(self.tempdir, 'a.d'))
+            return fd
+
+        self.cache._lock = lock
+        self.assertEqual(self.cache.acquire_existing('a'), None)
+
+    def test_keeps_tree_added_by_another_process_first(self):
+        def fill(savedir):
+            os.mkdir(os.path.join(self.tempdir, 'a.d'))
+            open(os.path.join(self.tempdir, 'a.d', 'winner'), 'w').close()
+
+        self.cache.add('a', fill)
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, 'a.d')),
+                         ['winner'])
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['a.d', 'a.d.lock', 'a.d.size'])
+
+    def test_removes_temporary_directory_if_fill_fails(self):
+        def fill(savedir):
+            raise RuntimeError('failed')
+
+        self.assertRaises(RuntimeError, self.cache.add, 'a', fill)
+        self.assertEqual(os.listdir(self.tempdir), ['a.d.lock'])
+        self.assertEqual(self.cache.contents(), [])
+
+    def test_removes_temporary_directory_if_rename_fails(self):
+        real_rename = os.rename
+
+        def rename(src, dst):
+            if os.path.isdir(src):
+                raise OSError(errno.EXDEV, 'cross-device link')
+            real_rename(src, dst)
+
+        os.rename = rename
+        try:
+            self.assertRaises(OSError, self.cache.add, 'a', self.fill(10))
+        finally:
+            os.rename = real_rename
+        self.assertEqual([x for x in os.listdir(self.tempdir)
+                          if not x.startswith('a.d.')], [])
+
+    def test_records_size(self):
+        self.cache.add('a', self.fill(1000))
+        (basename, size, last_used), = self.cache.contents()
+        self.assertEqual(basename, 'a')
+        self.assertTrue(size >= 1000)
+
+    def test_counts_hardlinked_files_once(self):
+        def fill(savedir):
+            with open(os.path.join(savedir, 'f'), 'w') as f:
+                f.write('x' * 1000)
+            os.link(os.path.join(savedir, 'f'), os.path.join(savedir, 'g'))
+
+        self.cache.add('a', fill)
+        (basename, size, last_used), = self.cache.contents()
+        self.assertTrue(1000 <= size < 2000)
+
+    def test_measures_tree_without_recorded_size(self):
+        os.mkdir(os.path.join(self.tempdir, 'a.d'))
+        with open(os.path.join(self.tempdir, 'a.d', 'f'), 'w') as f:
+            f.write('x' * 100)
+        with open(os.path.join(self.tempdir, 'a.d.size'), 'w') as f:
+            f.write('garbage')
+        (basename, size, last_used), = self.cache.contents()
+        self.assertEqual(size, 100)
+        with open(os.path.join(self.tempdir, 'a.d.size')) as f:
+            self.assertEqual(f.read(), '100\n')
+
+    def test_uses_modification_time_of_tree_without_lock_file(self):
+        os.mkdir(os.path.join(self.tempdir, 'a.d'))
+        os.utime(os.path.join(self.tempdir, 'a.d'), (10, 10))
+        (basename, size, last_used), = self.cache.contents()
+        self.assertEqual(last_used, 10)
+
+    def test_counts_tree_removed_meanwhile_as_never_used(self):
+        self.assertEqual(self.cache._last_used('a'), 0)
+
+    def test_skips_tree_removed_while_listing(self):
+        self.cache.add('a', self.fill(10))
+        self.cache._size = lambda basename: os.lstat(
+            os.path.join(self.tempdir, 'missing'))
+        self.assertEqual(self.cache.contents(), [])
+
+    def test_ignores_other_files(self):
+        self.cache.add('a', self.fill(10))
+        os.mkdir(os.path.join(self.tempdir, 'tmpABCDEF'))
+        self.assertEqual(self.names(), ['a'])
+
+    def test_evicts_least_recently_used(self):
+        self.add('a', 1000, 2)
+        self.add('b', 1000, 1)
+        self.add('c', 1000, 3)
+        total = self.cache.evict(2500)
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.assertTrue(total <= 2500)
+        self.assertEqual(sorted(os.listdir(self.tempdir)),
+                         ['a.d', 'a.d.lock', 'a.d.size',
+                          'c.d', 'c.d.lock', 'c.d.size'])
+
+    def test_keeps_trees_in_use(self):
+        self.add('a', 1000, 1)
+        reference = self.cache.acquire_existing('a')
+        self.cache.evict(0)
+        self.assertEqual(self.names(), ['a'])
+        reference.release()
+        self.cache.evict(0)
+        self.assertEqual(self.names(), [])
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_keeps_trees_in_use_by_another_process(self):
+        self.add('a', 1000, 1)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                os.close(read_fd)
+                self.cache.acquire_existing('a')
+                os.write(write_fd, 'x')
+                time.sleep(60)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        try:
+            os.read(read_fd, 1)
+            self.cache.evict(0)
+            self.assertEqual(self.names(), ['a'])
+        finally:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+            os.close(read_fd)
+        self.cache.evict(0)
+        self.assertEqual(self.names(), [])
+
+    def test_evicts_beyond_count(self):
+        self.add('template.a', 10, 3)
+        self.add('template.b', 10, 1)
+        self.add('template.c', 10, 2)
+        self.add('other', 10, 0)
+        self.cache.evict_count('template.', 2)
+        self.assertEqual(self.names(),
+                         ['other', 'template.a', 'template.c'])
+
+    def test_evicts_after_adding_beyond_max_size(self):
+        self.cache.max_size = 1500
+        self.add('a', 1000, 1)
+        self.cache.add('b', self.fill(1000))
+        self.assertEqual(self.names(), ['b'])
+
+    def test_does_not_evict_after_using_existing_tree(self):
+        self.cache.add('a', self.fill(1000))
+        self.cache.max_size = 500
+        self.cache.acquire_existing('a').release()
+        self.assertEqual(self.names(), ['a'])
+
+    def test_releases_reference_once(self):
+        self.cache.add('a', self.fill(10))
+        reference = self.cache.acquire_existing('a')
+        reference.release()
+        reference.release()
+        self.assertEqual(reference.fd, None)
+
+    def test_removes_tree_already_gone(self):
+        open(os.path.join(self.tempdir, 'a.d.size'), 'w').close()
+        self.assertTrue(self.cache._remove('a'))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_remove_fails_if_tree_cannot_be_moved(self):
+        self.cache.add('a', self.fill(10))
+        real_rename = os.rename
+
+        def rename(src, dst):
+            raise OSError(errno.EACCES, 'denied')
+
+        os.rename = rename
+        try:
+            self.assertRaises(OSError, self.cache._remove, 'a')
+        finally:
+            os.rename = real_rename
+        self.assertEqual(self.names(), ['a'])
+
+    def test_remove_fails_if_side_file_cannot_be_removed(self):
+        self.cache.add('a', self.fill(10))
+        os.remove(os.path.join(self.tempdir, 'a.d.size'))
+        os.mkdir(os.path.join(self.tempdir, 'a.d.size'))
+        self.assertRaises(OSError, self.cache._remove, 'a')
+
+    def test_remove_fails_if_lock_cannot_be_taken(self):
+        self.cache.add('a', self.fill(10))
+        real_flock = fcntl.flock
+
+        def flock(fd, operation):
+            raise IOError(errno.EBADF, 'bad file descriptor')
+
+        fcntl.flock = flock
+        try:
+            self.assertRaises(IOError, self.cache._remove, 'a')
+        finally:
+            fcntl.flock = real_flock
+
+    def test_locks_lock_file_recreated_while_locking(self):
+        self.cache.add('a', self.fill(10))
+        lock_path = os.path.join(self.tempdir, 'a.d.lock')
+        real_flock = fcntl.flock
+        replaced = []
+
+        def flock(fd, operation):
+            if not replaced:
+                replaced.append(True)
+                os.remove(lock_path)
+                open(lock_path, 'w').close()
+            real_flock(fd, operation)
+
+        fcntl.flock = flock
+        try:
+            reference = self.cache.acquire_existing('a')
+        finally:
+            fcntl.flock = real_flock
+        self.assertEqual(os.fstat(reference.fd).st_ino,
+                         os.stat(lock_path).st_ino)
+        reference.release()
+
+    def test_locks_again_if_lock_file_removed_while_locking(self):
+        self.cache.add('a', self.fill(10))
+        lock_path = os.path.join(self.tempdir, 'a.d.lock')
+        real_stat = os.stat
+        removed = []
+
+        def stat(path):
+            if path == lock_path and not removed:
+                removed.append(True)
+                raise OSError(errno.ENOENT, 'removed', path)
+            return real_stat(path)
+
+        os.stat = stat
+        try:
+            reference = self.cache.acquire_existing('a')
+        finally:
+            os.stat = real_stat
+        self.assertEqual(removed, [True])
+        reference.release()
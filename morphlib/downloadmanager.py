@@ -0,0 +1,231 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import httplib
+import logging
+import multiprocessing.pool
+import os
+import socket
+import sys
+import threading
+import urlparse
+
+import morphlib
+
+
+class DownloadError(morphlib.Error):
+
+    def __init__(self, url, reason):
+        self.url = url
+        self.msg = 'Failed to download %s: %s' % (url, reason)
+
+
+class _Interrupted(Exception):
+
+    pass
+
+
+class DownloadManager(object):
+
+    '''Download files over HTTP, several at once.
+
+    Each thread takes an idle connection to the server from a pool, and
+    puts it back when its download is done, so that the same few
+    connections are kept alive and reused for many small files.
+
+    A download that is cut short is resumed with a Range request for the
+    rest of the file, up to `retries` times. If the server does not
+    support ranges, the file is downloaded again from the start.
+
+    '''
+
+    def __init__(self, max_workers=4, retries=3, timeout=60,
+                 chunk_size=64 * 1024):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self._pid = os.getpid()
+
+    def _new_connection(self, scheme, netloc):  # pragma: no cover
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _get_connection(self, scheme, netloc):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections made before a fork belong to the parent.
+                self._idle.clear()
+                self._pid = os.getpid()
+            idle = self._idle[scheme, netloc]
+            if idle:
+                return idle.pop()
+        return self._new_connection(scheme, netloc)
+
+    def _put_connection(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle[scheme, netloc].append(connection)
+
+    def close(self):
+        '''Close the connections that are being kept for reuse.'''
+
+        with self._lock:
+            connections = [connection
+                           for idle in self._idle.itervalues()
+                           for connection in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+    def fetch(self, groups, limit=None):
+        '''Download groups of files, several files at once.
+
+        `groups` is a list of lists of (url, open_target) pairs, where
+        `open_target` is called to open the file to save the download to,
+        just before the download starts. The targets are SaveFiles: once
+        every file in a group has been downloaded, they are all closed,
+        and if any of them failed, all are aborted instead.
+
+        If `limit` is given, it is a BandwidthLimit for the downloads.
+
+        Returns the list of the first exception for each group, or None
+        where the group was saved, and the number of bytes downloaded.
+
+        '''
+
+        jobs = [(g, url, open_target)
+                for g, group in enumerate(groups)
+                for url, open_target in group]
+        remaining = [len(group) for group in groups]
+        targets = [[] for group in groups]
+        errors = [None for group in groups]
+        sizes = []
+
+        def finish(g):
+            if errors[g] is None:
+                for target in targets[g]:
+                    target.close()
+            else:
+                for target in targets[g]:
+                    target.abort()
+
+        def run(job):
+            g, url, open_target = job
+            size = 0
+            try:
+                if errors[g] is None:
+                    target = open_target()
+                    with self._lock:
+                        targets[g].append(target)
+                    size = self._download(url, target, limit)
+            except Exception, e:
+                with self._lock:
+                    if errors[g] is None:
+                        errors[g] = e
+            with self._lock:
+                sizes.append(size)
+                remaining[g] -= 1
+                done = remaining[g] == 0
+            if done:
+                finish(g)
+
+        if self.max_workers <= 1 or len(jobs) <= 1:
+            for job in jobs:
+                run(job)
+        else:
+            pool = multiprocessing.pool.ThreadPool(
+                min(self.max_workers, len(jobs)))
+            try:
+                # A timeout is given so that the wait can be interrupted
+                # with ^C.
+                pool.map_async(run, jobs).get(sys.maxint)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        for g, group in enumerate(groups):
+            if not group:
+                finish(g)
+        return errors, sum(sizes)
+
+    def _download(self, url, target, limit):
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        attempt = 0
+        while True:
+            # Everything written so far was received whole, so a retry
+            # carries on from there.
+            received = target.tell()
+            connection = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                received, reusable = self._request(
+                    connection, url, path, target, received, limit)
+            except (_Interrupted, httplib.HTTPException, socket.error), e:
+                connection.close()
+                attempt += 1
+                logging.debug('Download of %s interrupted after %d bytes: '
+                              '%s' % (url, target.tell(), e))
+                if attempt > self.retries:
+                    raise DownloadError(url, str(e) or e.__class__.__name__)
+            except BaseException:
+                connection.close()
+                raise
+            else:
+                if reusable:
+                    self._put_connection(parts.scheme, parts.netloc,
+                                         connection)
+                else:
+                    connection.close()
+                return received
+
+    def _request(self, connection, url, path, target, received, limit):
+        headers = {}
+        if received:
+            headers['Range'] = 'bytes=%d-' % received
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+
+        if response.status == httplib.PARTIAL_CONTENT and received:
+            pass
+        elif response.status == httplib.OK:
+            if received:
+                logging.debug('Server does not support ranges, '
+                              'downloading %s again' % url)
+                target.seek(0)
+                target.truncate()
+                received = 0
+        else:
+            response.read()
+            raise DownloadError(url, '%d %s' % (response.status,
+                                                response.reason))
+
+        length = response.getheader('content-length')
+        expected = None if length is None else received + int(length)
+        while True:
+            data = response.read(self.chunk_size)
+            if not data:
+                break
+            if limit is not None:
+                limit.consume(len(data))
+            target.write(data)
+            received += len(data)
+        if expected is not None and received < expected:
+            raise _Interrupted('got %d of %d bytes' % (received, expected))
+        return received, not response.will_close
@@ -0,0 +1,235 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import BaseHTTPServer
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+
+import morphlib
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        data = server.files.get(self.path)
+        byte_range = self.headers.getheader('Range')
+        with server.lock:
+            server.ranges_requested.append(byte_range)
+
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start = 0
+        if byte_range and server.supports_ranges:
+            start = int(byte_range[len('bytes='):-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        if server.close_connections:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+
+        if self.path in server.cut_short:
+            server.cut_short.remove(self.path)
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeHandler)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.cut_short = set()
+        self.supports_ranges = True
+        self.close_connections = False
+        self.connections = 0
+        self.ranges_requested = []
+        self.threads = []
+
+    def process_request(self, request, client_address):
+        # As ThreadingMixIn does, but remembering the threads, so that
+        # they can be waited for.
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self.lock:
+            self.threads.append(thread)
+        thread.start()
+
+    def close(self):
+        '''Stop serving, and wait for the connections to be closed.'''
+        self.shutdown()
+        self.server_close()
+        for thread in self.threads:
+            thread.join()
+
+
+class DownloadManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.server = FakeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.manager = morphlib.downloadmanager.DownloadManager(
+            max_workers=2, chunk_size=100)
+
+    def tearDown(self):
+        # The handlers of kept-alive connections run until the client
+        # closes them.
+        self.manager.close()
+        self.server.close()
+        shutil.rmtree(self.tempdir)
+
+    def add_file(self, name, data):
+        self.server.files['/' + name] = data
+
+    def job(self, name):
+        path = os.path.join(self.tempdir, name)
+        return (self.base_url + '/' + name,
+                lambda: morphlib.savefile.SaveFile(path, 'w'))
+
+    def saved(self, name):
+        path = os.path.join(self.tempdir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    def test_saves_files(self):
+        self.add_file('a', 'aaa')
+        self.add_file('b', 'bb')
+        errors, size = self.manager.fetch([[self.job('a')],
+                                           [self.job('b')]])
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(size, 5)
+        self.assertEqual(self.saved('a'), 'aaa')
+        self.assertEqual(self.saved('b'), 'bb')
+
+    def test_reuses_connections(self):
+        names = [str(i) for i in range(10)]
+        for name in names:
+            self.add_file(name, name * 10)
+        self.manager.max_workers = 1
+        errors, size = self.manager.fetch([[self.job(name)]
+                                           for name in names])
+        self.assertEqual(errors, [None] * 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_resumes_download_that_was_cut_short(self):
+        self.add_file('a', 'x' * 1000)
+        self.server.cut_short.add('/a')
+        errors, size = self.manager.fetch([[self.job('a')]])
+        self.assertEqual(errors, [None])
+        self.assertEqual(self.saved('a'), 'x' * 1000)
+        self.assertEqual(self.server.ranges_requested, [None, 'bytes=500-'])
+
+    def test_restarts_download_if_server_ignores_ranges(self):
+        self.add_file('a', ''.join(chr(i % 256) for i in range(1000)))
+        self.server.cut_short.add('/a')
+        self.server.supports_ranges = False
+        errors, size = self.manager.fetch([[self.job('a')]])
+        self.assertEqual(errors, [None])
+        self.assertEqual(self.saved('a'), self.server.files['/a'])
+
+    def test_saves_nothing_from_group_with_missing_file(self):
+        self.add_file('a', 'aaa')
+        self.add_file('c', 'ccc')
+        errors, size = self.manager.fetch([[self.job('a'), self.job('b')],
+                                           [self.job('c')]])
+        self.assertTrue(isinstance(errors[0],
+                                   morphlib.downloadmanager.DownloadError))
+        self.assertEqual(errors[1], None)
+        self.assertEqual(self.saved('a'), None)
+        self.assertEqual(self.saved('c'), 'ccc')
+        self.assertEqual(os.listdir(self.tempdir), ['c'])
+
+    def test_gives_up_after_retries(self):
+        self.add_file('a', 'x' * 1000)
+        self.server.cut_short.add('/a')
+        self.manager.retries = 0
+        errors, size = self.manager.fetch([[self.job('a')]])
+        self.assertTrue(isinstance(errors[0],
+                                   morphlib.downloadmanager.DownloadError))
+        self.assertEqual(os.listdir(self.tempdir), [])
+
+    def test_closes_connections_the_server_will_close(self):
+        self.add_file('a', 'aaa')
+        self.add_file('b', 'bbb')
+        self.server.close_connections = True
+        self.manager.max_workers = 1
+        errors, size = self.manager.fetch([[self.job('a')], [self.job('b')]])
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_does_not_reuse_connections_after_fork(self):
+        self.add_file('a', 'aaa')
+        self.manager.fetch([[self.job('a')]])
+        # As if this were a child process, forked since the first fetch.
+        self.manager._pid = -1
+        self.manager.fetch([[self.job('a')]])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_finishes_empty_groups(self):
+        self.add_file('a', 'aaa')
+        errors, size = self.manager.fetch([[], [self.job('a')]])
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(self.saved('a'), 'aaa')
+
+    def test_counts_downloads_against_limit(self):
+        consumed = []
+
+        class Limit(object):
+            def consume(self, size):
+                consumed.append(size)
+
+        self.add_file('a', 'x' * 250)
+        errors, size = self.manager.fetch([[self.job('a')]], limit=Limit())
+        self.assertEqual(errors, [None])
+        self.assertEqual(sum(consumed), 250)
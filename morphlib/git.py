@@ -221,55 +221,19 @@ def check_config_set(runcmd, keys, cwd='.'):
     return found
 
 
-def copy_repository(runcmd, repo, destdir, is_mirror=True):
-    '''Copies a cached repository into a directory using cp.
+def copy_repository(runcmd, repo, destdir):
+    '''Copies a cached repository into a directory, sharing its objects.
 
-    This also fixes up the repository afterwards, so that it can contain
-    code etc.  It does not leave any given branch ready for use.
+    The copy is a clone, with an origin remote pointing at the cached
+    repository. Git hardlinks the objects of a clone from a local path
+    where it can, so when `destdir` is on the same filesystem as the cache
+    only the refs are actually copied, however big the history is. The
+    copy keeps working if the cached repository changes or is removed.
+
+    No work tree is checked out; `destdir` must not exist or be empty.
 
     '''
-    if is_mirror == False:
-        runcmd(['cp', '-a', os.path.join(repo, '.git'),
-                os.path.join(destdir, '.git')])
-        return
-
-    runcmd(['cp', '-a', repo, os.path.join(destdir, '.git')])
-    # core.bare should be false so that git believes work trees are possible
-    gitcmd(runcmd, 'config', 'core.bare', 'false', cwd=destdir)
-    # we do not want the origin remote to behave as a mirror for pulls
-    gitcmd(runcmd, 'config', '--unset', 'remote.origin.mirror', cwd=destdir)
-    # we want a traditional refs/heads -> refs/remotes/origin ref mapping
-    gitcmd(runcmd, 'config', 'remote.origin.fetch',
-           '+refs/heads/*:refs/remotes/origin/*', cwd=destdir)
-    # set the origin url to the cached repo so that we can quickly clean up
-    gitcmd(runcmd, 'config', 'remote.origin.url', repo, cwd=destdir)
-    # by packing the refs, we can then edit then en-masse easily
-    gitcmd(runcmd, 'pack-refs', '--all', '--prune', cwd=destdir)
-    # turn refs/heads/* into refs/remotes/origin/* in the packed refs
-    # so that the new copy behaves more like a traditional clone.
-    logging.debug("Adjusting packed refs for %s" % destdir)
-    with open(os.path.join(destdir, ".git", "packed-refs"), "r") as ref_fh:
-        pack_lines = ref_fh.read().split("\n")
-    with open(os.path.join(destdir, ".git", "packed-refs"), "w") as ref_fh:
-        ref_fh.write(pack_lines.pop(0) + "\n")
-        for refline in pack_lines:
-            if ' refs/remotes/' in refline:
-                continue
-            if ' refs/heads/' in refline:
-                sha, ref = refline[:40], refline[41:]
-                if ref.startswith("refs/heads/"):
-                    ref = "refs/remotes/origin/" + ref[11:]
-                refline = "%s %s" % (sha, ref)
-            ref_fh.write("%s\n" % (refline))
-    # Finally run a remote update to clear up the refs ready for use.
-    gitcmd(runcmd, 'remote', 'update', 'origin', '--prune', cwd=destdir)
-
-
-def reset_workdir(runcmd, gitdir):
-    '''Removes any differences between the current commit '''
-    '''and the status of the working directory'''
-    gitcmd(runcmd, 'clean', '-fxd', cwd=gitdir)
-    gitcmd(runcmd, 'reset', '--hard', 'HEAD', cwd=gitdir)
+    gitcmd(runcmd, 'clone', '--quiet', '--no-checkout', repo, destdir)
 
 
 def clone_into(runcmd, srcpath, targetpath, ref=None):
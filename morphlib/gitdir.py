@@ -16,10 +16,17 @@
 # =*= License: GPL-2 =*=
 
 
+import atexit
+import binascii
 import cliapp
+import collections
+import fcntl
 import itertools
+import logging
 import os
 import re
+import subprocess
+import threading
 
 import morphlib
 
@@ -58,6 +65,13 @@ class RefChangeError(cliapp.AppException):
     pass
 
 
+class CatFileBatchError(cliapp.AppException):
+
+    def __init__(self, dirname, reason):
+        cliapp.AppException.__init__(
+            self, 'git cat-file --batch failed in %s: %s' % (dirname, reason))
+
+
 class RefAddError(RefChangeError):
 
     def __init__(self, gd, ref, sha1, original_exception):
@@ -348,6 +362,187 @@ class Remote(object):
         return ret
 
 
+class CatFileBatch(object):
+
+    '''A long-lived `git cat-file --batch` process for one repository.
+
+    Looking up an object through the batch process costs a write and a
+    read on a pipe, rather than forking and executing a new git process.
+    The process is started on first use.
+
+    Every open batch process holds two pipes open in this process, so only
+    the `max_open` most recently used ones are kept running. The others
+    are shut down, and are started again if they are needed later.
+
+    '''
+
+    max_open = 32
+
+    _open = collections.OrderedDict()
+    _open_lock = threading.Lock()
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._process = None
+        self._lock = threading.Lock()
+
+    def query(self, object_name):
+        '''Look up an object, which may be any git revision expression.
+
+        Returns a (sha1, type, contents) tuple, or None if there is no
+        such object. Raises CatFileBatchError if the batch process fails.
+
+        '''
+
+        if '\n' in object_name:
+            raise CatFileBatchError(self.dirname,
+                                    'object name %r has a newline' %
+                                    object_name)
+        with self._lock:
+            started = self._process is None
+            if started:
+                self._start()
+            try:
+                result = self._query(object_name)
+            except (IOError, OSError, ValueError), e:
+                self._stop()
+                raise CatFileBatchError(self.dirname, str(e))
+        self._mark_used(started)
+        return result
+
+    def close(self):
+        '''Shut down the batch process, if it is running.'''
+
+        with self._lock:
+            self._stop()
+        with self._open_lock:
+            self._open.pop(self, None)
+
+    @classmethod
+    def close_all(cls):
+        with cls._open_lock:
+            batches = cls._open.keys()
+        for batch in batches:
+            batch.close()
+
+    @classmethod
+    def forget_all(cls):
+        '''Let go of the batch processes after a fork, in the child.
+
+        The processes belong to the parent, which goes on using them, so
+        the child only closes its copies of the pipes. Batch processes it
+        needs are started again.
+
+        No locks are taken: a thread of the parent may have held one when
+        it forked, and there is no thread in the child to release it. The
+        child has only the one thread, so the locks are simply replaced.
+
+        '''
+
+        cls._open_lock = threading.Lock()
+        batches = cls._open.keys()
+        cls._open.clear()
+        for batch in batches:
+            batch._lock = threading.Lock()
+            process, batch._process = batch._process, None
+            if process is not None:
+                process.stdin.close()
+                process.stdout.close()
+
+    def _start(self):
+        env = dict(os.environ)
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        # Commands run by morph must not inherit the pipes, or the batch
+        # process would never see the end of its input. Other threads may
+        # run commands at any time, so the pipes are made close-on-exec as
+        # soon as they are created, rather than once git is running. git
+        # gets its ends as its stdin and stdout, which are not affected.
+        stdin_read, stdin_write = _cloexec_pipe()
+        stdout_read, stdout_write = _cloexec_pipe()
+        try:
+            process = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=self.dirname, env=env,
+                stdin=stdin_read, stdout=stdout_write, close_fds=True)
+        except OSError, e:
+            os.close(stdin_write)
+            os.close(stdout_read)
+            raise CatFileBatchError(self.dirname, str(e))
+        finally:
+            os.close(stdin_read)
+            os.close(stdout_write)
+        process.stdin = os.fdopen(stdin_write, 'wb')
+        process.stdout = os.fdopen(stdout_read, 'rb')
+        self._process = process
+
+    def _stop(self):
+        if self._process is not None:
+            process, self._process = self._process, None
+            try:
+                process.stdin.close()
+                process.stdout.close()
+            finally:
+                process.wait()
+
+    def _query(self, object_name):
+        stdin, stdout = self._process.stdin, self._process.stdout
+        stdin.write(object_name + '\n')
+        stdin.flush()
+        header = stdout.readline()
+        if not header.endswith('\n'):
+            raise IOError('unexpected end of output')
+        header = header[:-1]
+        if header.endswith((' missing', ' ambiguous')):
+            return None
+        sha1, kind, size = header.split(' ')
+        contents = stdout.read(int(size))
+        if len(contents) != int(size) or stdout.read(1) != '\n':
+            raise IOError('truncated contents for %s' % object_name)
+        return sha1, kind, contents
+
+    def _mark_used(self, started):
+        with self._open_lock:
+            self._open.pop(self, None)
+            self._open[self] = True
+            excess = len(self._open) - self.max_open
+            victims = self._open.keys()[:excess] if excess > 0 else []
+        # The least recently used processes are stopped without holding
+        # our own lock, so that two threads can never wait for each other.
+        for victim in victims:
+            victim.close()
+
+
+atexit.register(CatFileBatch.close_all)
+
+
+def _cloexec_pipe():
+    '''Create a pipe, with both ends marked close-on-exec.'''
+
+    fds = os.pipe()
+    for fd in fds:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return fds
+
+
+def parse_tree_object(contents):
+    '''Parse the contents of a git tree object.
+
+    Yields a (mode, name, sha1) tuple for each entry, in the same order
+    as `git ls-tree` lists them.
+
+    '''
+
+    pos = 0
+    while pos < len(contents):
+        space = contents.index(' ', pos)
+        nul = contents.index('\0', space)
+        mode = contents[pos:space]
+        name = contents[space + 1:nul]
+        sha1 = binascii.hexlify(contents[nul + 1:nul + 21])
+        pos = nul + 21
+        yield mode, name, sha1
+
+
 class GitDirectory(object):
 
     '''Represents a local Git repository.
@@ -381,6 +576,7 @@ class GitDirectory(object):
 
         self.dirname = dirname
         self._config = {}
+        self._batch = None
 
         self._ensure_is_git_repo()
 
@@ -406,8 +602,41 @@ class GitDirectory(object):
             # Exact error is logged already by the runcmd() function.
             raise NoGitRepoError(self.dirname)
 
+    def _batch_query(self, object_name):
+        '''Look up an object with the repository's cat-file batch process.
+
+        Returns what CatFileBatch.query() returns. If the batch process
+        fails, a warning is logged, this GitDirectory stops using it and
+        CatFileBatchError is raised, so that the caller can fall back to
+        running git directly.
+
+        '''
+
+        if self._batch is False:
+            raise CatFileBatchError(self.dirname, 'disabled after an error')
+        if self._batch is None:
+            self._batch = CatFileBatch(self.dirname)
+        try:
+            return self._batch.query(object_name)
+        except CatFileBatchError, e:
+            logging.warning('%s; running git directly instead' % e)
+            self._batch.close()
+            self._batch = False
+            raise
+
+    def close(self):
+        '''Shut down any helper processes used for reading the repository.
+
+        They are started again if they are needed later.
+
+        '''
+
+        if self._batch:
+            self._batch.close()
+
     def checkout(self, branch_name): # pragma: no cover
         '''Check out a git branch.'''
+        self.close()
         morphlib.git.gitcmd(self._runcmd, 'checkout', branch_name)
         if self.has_fat():
             self.fat_init()
@@ -506,6 +735,7 @@ class GitDirectory(object):
 
     def update_remotes(self, echo_stderr=False): # pragma: no cover
         '''Run "git remote update --prune".'''
+        self.close()
         morphlib.git.gitcmd(self._runcmd, 'remote', 'update', '--prune',
                             echo_stderr=echo_stderr)
 
@@ -530,6 +760,40 @@ class GitDirectory(object):
         else:
             return self._list_files_in_ref(ref, recurse)
 
+    def list_file_sha1s(self, ref):
+        '''Return a dict mapping each file at `ref` to its object SHA1.
+
+        All subdirectories are listed, but are not included themselves.
+        Comparing the results for two refs shows which files changed
+        between them without reading any of the files.
+
+        '''
+
+        tree = self.resolve_ref_to_tree(ref)
+        try:
+            return dict(self._list_file_sha1s_in_tree_object(tree))
+        except CatFileBatchError:
+            pass
+
+        output = morphlib.git.gitcmd(self._runcmd, 'ls-tree', '-r', '-z',
+                                     tree)
+        sha1s = {}
+        for entry in output.strip('\0').split('\0'):
+            if entry:
+                info, path = entry.split('\t', 1)
+                sha1s[path] = info.split(' ')[2]
+        return sha1s
+
+    def _list_file_sha1s_in_tree_object(self, tree, prefix=''):
+        sha1, kind, contents = self._batch_query(tree)
+        for mode, name, sha1 in parse_tree_object(contents):
+            if mode == '40000':
+                for entry in self._list_file_sha1s_in_tree_object(
+                        sha1, prefix + name + '/'):
+                    yield entry
+            else:
+                yield prefix + name, sha1
+
     def _rev_parse(self, ref):
         try:
             return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
@@ -566,15 +830,24 @@ class GitDirectory(object):
                 return None
             raise
 
+    def _resolve_object(self, object_name):
+        try:
+            result = self._batch_query(object_name)
+        except CatFileBatchError:
+            return self._rev_parse(object_name)
+        if result is None:
+            raise InvalidRefError(self, object_name)
+        return result[0]
+
     def resolve_ref_to_commit(self, ref):
-        return self._rev_parse('%s^{commit}' % ref)
+        return self._resolve_object('%s^{commit}' % ref)
 
     def resolve_ref_to_tree(self, ref):
-        return self._rev_parse('%s^{tree}' % ref)
+        return self._resolve_object('%s^{tree}' % ref)
 
     def ref_exists(self, ref):
         try:
-            self._rev_parse('%s^{commit}' % ref)
+            self._resolve_object('%s^{commit}' % ref)
             return True
         except InvalidRefError:
             return False
@@ -592,6 +865,11 @@ class GitDirectory(object):
     def _list_files_in_ref(self, ref, recurse=True):
         tree = self.resolve_ref_to_tree(ref)
 
+        try:
+            return self._list_files_in_tree_object(tree, recurse)
+        except CatFileBatchError:
+            pass
+
         command = ['ls-tree', '--name-only', '-z']
         if recurse:
             command.append('-r')
@@ -603,6 +881,19 @@ class GitDirectory(object):
         paths = output.strip('\0').split('\0')
         return paths
 
+    def _list_files_in_tree_object(self, tree, recurse, prefix=''):
+        # Like `git ls-tree --name-only`, list subtrees themselves only
+        # when not recursing into them.
+        sha1, kind, contents = self._batch_query(tree)
+        paths = []
+        for mode, name, sha1 in parse_tree_object(contents):
+            if recurse and mode == '40000':
+                paths.extend(self._list_files_in_tree_object(
+                    sha1, recurse, prefix + name + '/'))
+            else:
+                paths.append(prefix + name)
+        return paths
+
     def read_file(self, filename, ref=None):
         '''Attempts to read a file, from the working tree or a given ref.
 
@@ -618,10 +909,17 @@ class GitDirectory(object):
                 return f.read()
         tree = self.resolve_ref_to_tree(ref)
         try:
-            return self.get_file_from_ref(tree, filename)
-        except cliapp.AppException:
-            raise IOError('File %s does not exist in ref %s of repo %s' %
-                          (filename, ref, self))
+            result = self._batch_query('%s:%s' % (tree, filename))
+        except CatFileBatchError:
+            try:
+                return self.get_file_from_ref(tree, filename)
+            except cliapp.AppException:
+                result = None
+        else:
+            if result is not None and result[1] == 'blob':
+                return result[2]
+        raise IOError('File %s does not exist in ref %s of repo %s' %
+                      (filename, ref, self))
 
     def is_symlink(self, filename, ref=None):
         if ref is None and self.is_bare():
@@ -629,11 +927,29 @@ class GitDirectory(object):
         if ref is None:
             filepath = os.path.join(self.dirname, filename.lstrip('/'))
             return os.path.islink(filepath)
+        try:
+            return self._is_symlink_in_tree_object(ref, filename)
+        except CatFileBatchError:
+            pass
         tree_entry = morphlib.git.gitcmd(self._runcmd, 'ls-tree', ref,
                                          filename)
         file_mode = tree_entry.split(' ', 1)[0]
         return file_mode == '120000'
 
+    def _is_symlink_in_tree_object(self, ref, filename):
+        dirname, basename = os.path.split(filename.strip('/'))
+        tree = self.resolve_ref_to_tree(ref)
+        if dirname:
+            result = self._batch_query('%s:%s' % (tree, dirname))
+        else:
+            result = self._batch_query(tree)
+        if result is None or result[1] != 'tree':
+            return False
+        for mode, name, sha1 in parse_tree_object(result[2]):
+            if name == basename:
+                return mode == '120000'
+        return False
+
     @property
     def HEAD(self):
         output = morphlib.git.gitcmd(self._runcmd, 'rev-parse',
@@ -690,6 +1006,7 @@ class GitDirectory(object):
         if message is not None: # pragma: no cover
             args.extend(('-m', message))
         args.extend(ref_args)
+        self.close()
         morphlib.git.gitcmd(self._runcmd, *args)
 
     def add_ref(self, ref, sha1, message=None):
@@ -760,6 +1077,7 @@ class GitDirectory(object):
         return morphlib.git.gitcmd(self._runcmd, 'fat', 'push')
 
     def fat_pull(self): # pragma: no cover
+        self.close()
         return morphlib.git.gitcmd(self._runcmd, 'fat', 'pull')
 
     def has_fat(self): # pragma: no cover
@@ -18,8 +18,10 @@
 
 import contextlib
 import datetime
+import fcntl
 import os
 import shutil
+import StringIO
 import tempfile
 import unittest
 
@@ -304,6 +306,213 @@ class GitDirectoryFileTypeTests(unittest.TestCase):
                           gd.is_symlink, 'file')
 
 
+class FakeProcess(object):
+
+    '''A stand-in for a cat-file batch process with canned output.'''
+
+    def __init__(self, output):
+        self.stdin = StringIO.StringIO()
+        self.stdout = StringIO.StringIO(output)
+
+    def wait(self):
+        return 0
+
+
+class GitDirectoryCatFileBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'foo')
+        os.mkdir(self.dirname)
+        gd = morphlib.gitdir.init(self.dirname)
+        os.makedirs(os.path.join(self.dirname, 'strata', 'core'))
+        for fn in ('foo.morph', 'strata/bar.morph', 'strata/core/baz.morph'):
+            with open(os.path.join(self.dirname, fn), "w") as f:
+                f.write('text of %s' % fn)
+        os.symlink('baz.morph', os.path.join(self.dirname, 'strata', 'core',
+                                             'link'))
+        morphlib.git.gitcmd(gd._runcmd, 'add', '.')
+        morphlib.git.gitcmd(gd._runcmd, 'commit', '-m', 'Initial commit')
+        self.mirror = os.path.join(self.tempdir, 'mirror')
+        morphlib.git.gitcmd(gd._runcmd, 'clone', '--mirror', self.dirname,
+                            self.mirror)
+
+    def tearDown(self):
+        morphlib.gitdir.CatFileBatch.close_all()
+        shutil.rmtree(self.tempdir)
+
+    def without_batch(self, gitdir):
+        gd = morphlib.gitdir.GitDirectory(gitdir)
+        gd._batch = False
+        return gd
+
+    def test_lists_files_like_ls_tree(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        plain = self.without_batch(self.mirror)
+        for recurse in (True, False):
+            self.assertEqual(gd.list_files('master', recurse),
+                             plain.list_files('master', recurse))
+        self.assertEqual(gd.list_files('master', False),
+                         ['foo.morph', 'strata'])
+        self.assertTrue(gd._batch)
+
+    def test_lists_file_sha1s_like_ls_tree(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        plain = self.without_batch(self.mirror)
+        sha1s = gd.list_file_sha1s('master')
+        self.assertEqual(sha1s, plain.list_file_sha1s('master'))
+        self.assertEqual(sorted(sha1s), gd.list_files('master'))
+        self.assertEqual(
+            gd.get_blob_contents(sha1s['strata/core/baz.morph']),
+            'text of strata/core/baz.morph')
+
+    def test_reads_files_in_subdirectories(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertEqual(gd.read_file('strata/core/baz.morph', 'master'),
+                         'text of strata/core/baz.morph')
+
+    def test_read_of_directory_raises_io_error(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertRaises(IOError, gd.read_file, 'strata', 'master')
+
+    def test_resolves_refs_like_rev_parse(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        plain = self.without_batch(self.mirror)
+        self.assertEqual(gd.resolve_ref_to_commit('master'),
+                         plain.resolve_ref_to_commit('master'))
+        self.assertEqual(gd.resolve_ref_to_tree('master'),
+                         plain.resolve_ref_to_tree('master'))
+        self.assertRaises(morphlib.gitdir.InvalidRefError,
+                          gd.resolve_ref_to_commit, 'no-such-ref')
+        self.assertFalse(gd.ref_exists('no-such-ref'))
+
+    def test_symlinks_in_subdirectories(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertTrue(gd.is_symlink('strata/core/link', 'master'))
+        self.assertFalse(gd.is_symlink('strata/core/baz.morph', 'master'))
+        self.assertFalse(gd.is_symlink('strata', 'master'))
+
+    def test_reuses_one_process(self):
+        started = []
+        start = morphlib.gitdir.CatFileBatch._start
+        def counting_start(batch):
+            started.append(batch)
+            start(batch)
+        with monkeypatch(morphlib.gitdir.CatFileBatch, '_start',
+                         counting_start):
+            gd = morphlib.gitdir.GitDirectory(self.mirror)
+            gd.read_file('foo.morph', 'master')
+            gd.list_files('master')
+            gd.resolve_ref_to_commit('master')
+        self.assertEqual(len(started), 1)
+
+    def test_falls_back_when_batch_fails(self):
+        def failing_start(batch):
+            raise morphlib.gitdir.CatFileBatchError(batch.dirname, 'broken')
+        with monkeypatch(morphlib.gitdir.CatFileBatch, '_start',
+                         failing_start):
+            gd = morphlib.gitdir.GitDirectory(self.mirror)
+            self.assertEqual(gd.read_file('foo.morph', 'master'),
+                             'text of foo.morph')
+            self.assertEqual(gd.list_files('master', False),
+                             ['foo.morph', 'strata'])
+        self.assertEqual(gd._batch, False)
+
+    def test_falls_back_for_missing_files_and_symlinks(self):
+        def failing_start(batch):
+            raise morphlib.gitdir.CatFileBatchError(batch.dirname, 'broken')
+        with monkeypatch(morphlib.gitdir.CatFileBatch, '_start',
+                         failing_start):
+            gd = morphlib.gitdir.GitDirectory(self.mirror)
+            self.assertRaises(IOError, gd.read_file, 'no-such-file',
+                              'master')
+            self.assertTrue(gd.is_symlink('strata/core/link', 'master'))
+            self.assertFalse(gd.is_symlink('foo.morph', 'master'))
+
+    def test_missing_files_are_not_symlinks(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        self.assertFalse(gd.is_symlink('strata/no-such-file', 'master'))
+        self.assertFalse(gd.is_symlink('no-such-dir/link', 'master'))
+        self.assertFalse(gd.is_symlink('foo.morph/link', 'master'))
+
+    def test_rejects_object_names_with_newlines(self):
+        batch = morphlib.gitdir.CatFileBatch(self.mirror)
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          batch.query, 'master\nHEAD')
+        self.assertEqual(batch._process, None)
+
+    def test_fails_when_git_cannot_be_started(self):
+        batch = morphlib.gitdir.CatFileBatch(
+            os.path.join(self.tempdir, 'no-such-dir'))
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          batch.query, 'master')
+        self.assertEqual(batch._process, None)
+
+    def test_pipes_are_not_inherited(self):
+        batch = morphlib.gitdir.CatFileBatch(self.mirror)
+        batch.query('master')
+        for f in (batch._process.stdin, batch._process.stdout):
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+            self.assertTrue(flags & fcntl.FD_CLOEXEC)
+        batch.close()
+
+    def query_with_output(self, output):
+        batch = morphlib.gitdir.CatFileBatch(self.mirror)
+        batch._process = FakeProcess(output)
+        try:
+            batch.query('master')
+        finally:
+            self.assertEqual(batch._process, None)
+
+    def test_fails_on_end_of_output(self):
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.query_with_output, '')
+
+    def test_fails_on_truncated_contents(self):
+        self.assertRaises(morphlib.gitdir.CatFileBatchError,
+                          self.query_with_output,
+                          '%s blob 10\nshort' % ('0' * 40))
+
+    def test_limits_number_of_open_processes(self):
+        gds = [morphlib.gitdir.GitDirectory(d)
+               for d in (self.dirname, self.mirror)]
+        with monkeypatch(morphlib.gitdir.CatFileBatch, 'max_open', 1):
+            for gd in gds:
+                gd.resolve_ref_to_commit('master')
+        self.assertEqual(gds[0]._batch._process, None)
+        self.assertNotEqual(gds[1]._batch._process, None)
+        self.assertEqual(gds[0].resolve_ref_to_commit('master'),
+                         gds[1].resolve_ref_to_commit('master'))
+
+
+    def test_forgets_inherited_processes(self):
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        gd.resolve_ref_to_commit('master')
+        process = gd._batch._process
+        morphlib.gitdir.CatFileBatch.forget_all()
+        self.assertEqual(gd._batch._process, None)
+        self.assertEqual(gd.read_file('foo.morph', 'master'),
+                         'text of foo.morph')
+        self.assertFalse(gd._batch._process is process)
+        process.wait()
+
+    def test_forgets_processes_while_locks_are_held(self):
+        # As when another thread of the parent held them when it forked.
+        gd = morphlib.gitdir.GitDirectory(self.mirror)
+        gd.resolve_ref_to_commit('master')
+        process = gd._batch._process
+        locks = (morphlib.gitdir.CatFileBatch._open_lock, gd._batch._lock)
+        for lock in locks:
+            lock.acquire()
+        try:
+            morphlib.gitdir.CatFileBatch.forget_all()
+            self.assertEqual(gd.read_file('foo.morph', 'master'),
+                             'text of foo.morph')
+        finally:
+            for lock in locks:
+                lock.release()
+        process.wait()
+
 class GitDirectoryRefTwiddlingTests(unittest.TestCase):
 
     def setUp(self):
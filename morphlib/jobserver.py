@@ -0,0 +1,118 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import os
+import stat
+
+import morphlib
+
+
+class JobServerError(morphlib.Error):
+
+    def __init__(self, path, reason):
+        self.msg = 'Cannot use make jobserver %s: %s' % (path, reason)
+
+
+class JobServer(object):
+
+    '''A GNU make jobserver shared by several builds.
+
+    GNU make limits the jobs run by a make and all its sub-makes by passing
+    them a pipe holding one byte, or token, for each job that may run on
+    top of the one every make may always run. Here the pipe is a named
+    FIFO, so that makes run in different staging areas, by builds in
+    different processes, can share it, and the total number of jobs stays
+    the same however many builds run at once.
+
+    A new FIFO is made at `path`, and `tokens` tokens are put in it. The
+    FIFO must be kept open for the tokens to stay in it, so it is owned by
+    this object until close() is called. Other processes can share the
+    jobserver by attaching to the FIFO with attach().
+
+    Commands get the jobserver by being run through wrap_command(), which
+    opens the FIFO on the file descriptors named in makeflags() just before
+    running them. Passing the file descriptors down from Morph would not
+    work, as commands are run with every other file descriptor closed.
+
+    '''
+
+    # Shells only need to support single digit file descriptors, and these
+    # are the ones least likely to be used by build commands.
+    read_fd = 8
+    write_fd = 9
+
+    def __init__(self, path, tokens):
+        self.path = path
+        self._fd = None
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.mkfifo(self.path, 0600)
+            # Opening for both reading and writing does not block waiting
+            # for the other end, and keeps the tokens in the FIFO while no
+            # make has it open.
+            self._fd = os.open(self.path, os.O_RDWR)
+            os.write(self._fd, '+' * tokens)
+        except OSError, e:
+            raise JobServerError(self.path, e.strerror)
+
+    @classmethod
+    def attach(cls, path):
+        '''Use a jobserver that is owned by another process.
+
+        `path` is the FIFO of a JobServer in that process. It stays in
+        place when close() is called on the returned object.
+
+        '''
+
+        try:
+            mode = os.stat(path).st_mode
+        except OSError, e:
+            raise JobServerError(path, e.strerror)
+        if not stat.S_ISFIFO(mode):
+            raise JobServerError(path, 'not a FIFO')
+        jobserver = cls.__new__(cls)
+        jobserver.path = path
+        jobserver._fd = None
+        return jobserver
+
+    def makeflags(self):
+        '''Return MAKEFLAGS telling make to use the jobserver.'''
+        return '-j --jobserver-fds=%d,%d' % (self.read_fd, self.write_fd)
+
+    def wrap_command(self, argv, path=None):
+        '''Return argv changed to run with the jobserver open.
+
+        `path` is where the FIFO is seen by the command, if it is run in a
+        chroot, and defaults to where it is seen by Morph.
+
+        '''
+
+        script = 'exec %d<>"$0" %d<>"$0" && exec "$@"' % (
+            self.read_fd, self.write_fd)
+        return ['sh', '-c', script, path or self.path] + list(argv)
+
+    def close(self):
+        '''Stop owning the jobserver, removing its FIFO.'''
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            try:
+                os.remove(self.path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
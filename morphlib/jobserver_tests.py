@@ -0,0 +1,119 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import morphlib
+
+
+class JobServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'jobserver')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def read_tokens(self, jobserver, count):
+        script = 'import os, sys; sys.stdout.write(os.read(%d, %d))' % (
+            jobserver.read_fd, count)
+        return subprocess.check_output(
+            jobserver.wrap_command([sys.executable, '-c', script]),
+            close_fds=True)
+
+    def test_commands_can_take_tokens(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=3)
+        try:
+            self.assertEqual(self.read_tokens(jobserver, 3), '+++')
+        finally:
+            jobserver.close()
+
+    def test_tokens_are_shared_between_commands(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=2)
+        try:
+            self.assertEqual(self.read_tokens(jobserver, 1), '+')
+            self.assertEqual(self.read_tokens(jobserver, 1), '+')
+        finally:
+            jobserver.close()
+
+    def test_makeflags_name_file_descriptors(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        jobserver.close()
+        self.assertEqual(jobserver.makeflags(),
+                         '-j --jobserver-fds=8,9')
+
+    def test_wraps_command_with_path_seen_by_command(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        jobserver.close()
+        argv = jobserver.wrap_command(['make'], path='/tmp/jobserver')
+        self.assertEqual(argv[0:2], ['sh', '-c'])
+        self.assertEqual(argv[3:], ['/tmp/jobserver', 'make'])
+
+    def test_replaces_stale_fifo(self):
+        os.mkfifo(self.path)
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        try:
+            self.assertEqual(self.read_tokens(jobserver, 1), '+')
+        finally:
+            jobserver.close()
+
+    def test_close_removes_fifo(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        jobserver.close()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_reports_fifo_that_cannot_be_made(self):
+        path = os.path.join(self.tempdir, 'missing', 'jobserver')
+        self.assertRaises(morphlib.jobserver.JobServerError,
+                          morphlib.jobserver.JobServer, path, 1)
+
+    def test_close_tolerates_fifo_already_removed(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        os.remove(self.path)
+        jobserver.close()
+
+    def test_close_reports_fifo_that_cannot_be_removed(self):
+        jobserver = morphlib.jobserver.JobServer(self.path, tokens=1)
+        os.remove(self.path)
+        os.mkdir(self.path)
+        self.assertRaises(OSError, jobserver.close)
+
+    def test_attached_commands_share_tokens_of_owner(self):
+        owner = morphlib.jobserver.JobServer(self.path, tokens=2)
+        try:
+            attached = morphlib.jobserver.JobServer.attach(self.path)
+            self.assertEqual(self.read_tokens(attached, 1), '+')
+            attached.close()
+            self.assertTrue(os.path.exists(self.path))
+            self.assertEqual(self.read_tokens(owner, 1), '+')
+        finally:
+            owner.close()
+
+    def test_attach_reports_missing_fifo(self):
+        self.assertRaises(morphlib.jobserver.JobServerError,
+                          morphlib.jobserver.JobServer.attach, self.path)
+
+    def test_attach_reports_file_that_is_not_a_fifo(self):
+        with open(self.path, 'w'):
+            pass
+        self.assertRaises(morphlib.jobserver.JobServerError,
+                          morphlib.jobserver.JobServer.attach, self.path)
@@ -0,0 +1,136 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import errno
+import json
+import os
+import stat
+
+import morphlib
+
+
+class LinkManifest(object):
+
+    '''The contents of an unpacked chunk, to link into staging areas.
+
+    The manifest lists the directories, regular files, symbolic links and
+    device nodes in a directory tree, so that the tree can be hardlinked
+    into a staging area without examining it again. Directories are listed
+    before anything in them.
+
+    '''
+
+    def __init__(self, dirs=(), files=(), symlinks=(), devices=()):
+        self.dirs = list(dirs)
+        self.files = list(files)
+        # (path, target) pairs.
+        self.symlinks = [tuple(x) for x in symlinks]
+        # (path, mode, rdev) triples.
+        self.devices = [tuple(x) for x in devices]
+
+    @classmethod
+    def scan(cls, dirname):
+        '''Create the manifest of the tree in `dirname`.'''
+
+        manifest = cls()
+        for dirpath, subdirs, filenames in os.walk(dirname):
+            relpath = os.path.relpath(dirpath, dirname)
+            # os.walk lists symbolic links to directories as directories.
+            for name in sorted(subdirs + filenames):
+                path = os.path.normpath(os.path.join(relpath, name))
+                st = os.lstat(os.path.join(dirpath, name))
+                if stat.S_ISDIR(st.st_mode):
+                    manifest.dirs.append(path)
+                elif stat.S_ISLNK(st.st_mode):
+                    manifest.symlinks.append(
+                        (path, os.readlink(os.path.join(dirpath, name))))
+                elif stat.S_ISREG(st.st_mode):
+                    manifest.files.append(path)
+                elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+                    manifest.devices.append((path, st.st_mode, st.st_rdev))
+                else:
+                    raise IOError('Cannot extract %s into staging-area. '
+                                  'Unsupported type.' %
+                                  os.path.join(dirpath, name))
+        return manifest
+
+    @classmethod
+    def load(cls, f):
+        '''Read a manifest written by save().'''
+
+        data = json.load(f)
+        return cls(data['dirs'], data['files'], data['symlinks'],
+                   data['devices'])
+
+    def save(self, f):
+        '''Write the manifest to an open file.'''
+
+        json.dump({'dirs': self.dirs, 'files': self.files,
+                   'symlinks': self.symlinks, 'devices': self.devices}, f)
+
+    def link(self, srcdir, destdir, max_workers=1, batch_size=1000):
+        '''Hardlink the tree in `srcdir` into `destdir`.
+
+        Directories are made first, and then the files are linked, in
+        batches of `batch_size` spread over up to `max_workers` threads.
+        Anything already in `destdir` with the same name as a file,
+        symbolic link or device node is replaced. Directories may already
+        exist, or be symbolic links to directories.
+
+        If an exception is raised, the contents of `destdir` are
+        indeterminate.
+
+        '''
+
+        for path in self.dirs:
+            dest = os.path.join(destdir, path)
+            try:
+                os.mkdir(dest)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if not os.path.isdir(dest):
+                    raise IOError('Destination not a directory. source has '
+                                  '%s destination has %s' %
+                                  (os.path.join(srcdir, path), dest))
+
+        def link_files(paths):
+            for path in paths:
+                _replace(os.link, os.path.join(srcdir, path),
+                         os.path.join(destdir, path))
+
+        morphlib.util.map_concurrently(
+            link_files, morphlib.util.iter_trickle(self.files, batch_size),
+            max_workers)
+
+        for path, target in self.symlinks:
+            _replace(os.symlink, target, os.path.join(destdir, path))
+        for path, mode, rdev in self.devices:
+            dest = os.path.join(destdir, path)
+            _replace(lambda src, dest: os.mknod(dest, mode, rdev), None, dest)
+            os.chmod(dest, mode)
+
+
+def _replace(make, src, dest):
+    '''Call make(src, dest), replacing anything already at dest.'''
+
+    try:
+        make(src, dest)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        os.remove(dest)
+        make(src, dest)
@@ -0,0 +1,163 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import stat
+import StringIO
+import tempfile
+import unittest
+
+import morphlib
+
+
+class LinkManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tempdir, 'src')
+        self.dest = os.path.join(self.tempdir, 'dest')
+        os.makedirs(os.path.join(self.src, 'usr', 'bin'))
+        os.mkdir(self.dest)
+        with open(os.path.join(self.src, 'usr', 'bin', 'foo'), 'w') as f:
+            f.write('foo')
+        os.symlink('foo', os.path.join(self.src, 'usr', 'bin', 'bar'))
+        os.symlink('usr/bin', os.path.join(self.src, 'bin'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lists_tree(self):
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        self.assertEqual(manifest.dirs, ['usr', 'usr/bin'])
+        self.assertEqual(manifest.files, ['usr/bin/foo'])
+        self.assertEqual(sorted(manifest.symlinks),
+                         [('bin', 'usr/bin'), ('usr/bin/bar', 'foo')])
+        self.assertEqual(manifest.devices, [])
+
+    def test_saves_and_loads(self):
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        f = StringIO.StringIO()
+        manifest.save(f)
+        f.seek(0)
+        loaded = morphlib.linkmanifest.LinkManifest.load(f)
+        self.assertEqual(loaded.dirs, manifest.dirs)
+        self.assertEqual(loaded.files, manifest.files)
+        self.assertEqual(loaded.symlinks, manifest.symlinks)
+
+    def test_links_tree(self):
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        manifest.link(self.src, self.dest)
+        foo = os.path.join(self.dest, 'usr', 'bin', 'foo')
+        self.assertEqual(os.stat(foo).st_ino,
+                         os.stat(os.path.join(self.src, 'usr', 'bin',
+                                              'foo')).st_ino)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'bin')),
+                         'usr/bin')
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'usr', 'bin',
+                                                  'bar')), 'foo')
+
+    def test_replaces_existing_files(self):
+        os.makedirs(os.path.join(self.dest, 'usr', 'bin'))
+        with open(os.path.join(self.dest, 'usr', 'bin', 'foo'), 'w') as f:
+            f.write('old')
+        os.symlink('old', os.path.join(self.dest, 'usr', 'bin', 'bar'))
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        manifest.link(self.src, self.dest)
+        with open(os.path.join(self.dest, 'usr', 'bin', 'foo')) as f:
+            self.assertEqual(f.read(), 'foo')
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'usr', 'bin',
+                                                  'bar')), 'foo')
+
+    def test_links_through_symlinked_directories(self):
+        os.makedirs(os.path.join(self.dest, 'real'))
+        os.symlink('real', os.path.join(self.dest, 'usr'))
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        manifest.link(self.src, self.dest)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dest, 'real', 'bin', 'foo')))
+
+    def test_refuses_to_replace_file_with_directory(self):
+        open(os.path.join(self.dest, 'usr'), 'w').close()
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        self.assertRaises(IOError, manifest.link, self.src, self.dest)
+
+    def test_links_in_several_threads(self):
+        names = ['file%d' % i for i in range(20)]
+        for name in names:
+            open(os.path.join(self.src, name), 'w').close()
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        manifest.link(self.src, self.dest, max_workers=4, batch_size=3)
+        for name in names:
+            self.assertTrue(os.path.exists(os.path.join(self.dest, name)))
+
+    def test_lists_device_nodes(self):
+        open(os.path.join(self.src, 'null'), 'w').close()
+        real_lstat = os.lstat
+
+        def lstat(path):
+            st = real_lstat(path)
+            if os.path.basename(path) != 'null':
+                return st
+            fields = list(st)
+            fields[stat.ST_MODE] = stat.S_IFCHR | 0666
+            return os.stat_result(fields)
+
+        os.lstat = lstat
+        try:
+            manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        finally:
+            os.lstat = real_lstat
+        self.assertEqual(manifest.files, ['usr/bin/foo'])
+        self.assertEqual([(path, mode) for path, mode, rdev in
+                          manifest.devices],
+                         [('null', stat.S_IFCHR | 0666)])
+
+    def test_refuses_to_list_unsupported_files(self):
+        os.mkfifo(os.path.join(self.src, 'fifo'))
+        self.assertRaises(IOError, morphlib.linkmanifest.LinkManifest.scan,
+                          self.src)
+
+    def test_makes_device_nodes(self):
+        manifest = morphlib.linkmanifest.LinkManifest(
+            devices=[('null', stat.S_IFCHR | 0666, 0x103)])
+        open(os.path.join(self.dest, 'null'), 'w').close()
+        made = []
+        real_mknod = os.mknod
+
+        def mknod(path, mode, rdev):
+            made.append((path, mode, rdev))
+            # Only root may make device nodes, so make a file instead.
+            real_mknod(path, stat.S_IFREG | 0600)
+
+        os.mknod = mknod
+        try:
+            manifest.link(self.src, self.dest)
+        finally:
+            os.mknod = real_mknod
+        null = os.path.join(self.dest, 'null')
+        self.assertEqual(made, [(null, stat.S_IFCHR | 0666, 0x103),
+                                (null, stat.S_IFCHR | 0666, 0x103)])
+        self.assertEqual(stat.S_IMODE(os.stat(null).st_mode), 0666)
+
+    def test_fails_if_directory_cannot_be_made(self):
+        manifest = morphlib.linkmanifest.LinkManifest.scan(self.src)
+        self.assertRaises(OSError, manifest.link, self.src,
+                          os.path.join(self.dest, 'missing'))
+
+    def test_fails_if_file_cannot_be_linked(self):
+        manifest = morphlib.linkmanifest.LinkManifest(files=['missing'])
+        self.assertRaises(OSError, manifest.link, self.src, self.dest)
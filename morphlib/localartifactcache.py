@@ -1,4 +1,4 @@
-# Copyright (C) 2012, 2013, 2014  Codethink Limited
+# Copyright (C) 2012, 2013, 2014, 2015  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,11 +14,30 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import atexit
 import collections
+import errno
 import os
+import threading
 import time
+import weakref
 
 import morphlib
+import morphlib.savefile
+
+
+class _IndexedSaveFile(morphlib.savefile.SaveFile):
+
+    '''A SaveFile which records the saved file in the cache index.'''
+
+    def __init__(self, cache, filename, *args, **kwargs):
+        morphlib.savefile.SaveFile.__init__(self, filename, *args, **kwargs)
+        self._cache = cache
+
+    def close(self):
+        ret = morphlib.savefile.SaveFile.close(self)
+        self._cache._add_file(self.real_filename)
+        return ret
 
 
 class LocalArtifactCache(object):
@@ -27,44 +46,122 @@ class LocalArtifactCache(object):
        It provides methods for getting a file handle to cached artifacts
        so that the layout of the cache need not be known.
 
-       It also updates modification times of artifacts so that it can track
-       when they were last used, so it can be requested to clean up if
-       disk space is low.
+       Every file in the cache is recorded in an index, with its size and
+       when it was last used, so that the cache can be listed and cleaned up
+       without reading the whole directory. See ArtifactCacheIndex.
 
-       Modification time is updated in both the get and has methods.
+       The time of last use is updated in both the get and has methods.
+       They do not write anything themselves: the uses are kept in memory,
+       and written to the index all at once by flush(), which is called
+       when Morph exits, before the index is read and after every
+       `max_pending` uses.
+
+       Files may also be added to or removed from the directory behind the
+       cache's back, for example by morph-cache-server on distbuild workers.
+       Such files are noticed by the has and get methods, and the index is
+       corrected when their uses are written.
 
        NOTE: Parts of the build assume that every artifact of a source is
        available, so all the artifacts of a source need to be removed together.
 
        This complication needs to be handled either during the fetch logic, by
-       updating the mtime of every artifact belonging to a source, or at
-       cleanup time by only removing an artifact if every artifact belonging to
-       a source is too old, and then remove them all at once.
+       updating the last used time of every artifact belonging to a source, or
+       at cleanup time by only removing an artifact if every artifact
+       belonging to a source is too old, and then remove them all at once.
 
        Since the cleanup logic will be complicated for other reasons it makes
        sense to put the complication there.
        '''
 
-    def __init__(self, cachefs):
+    # Every cache which has uses still to write, so that they are written
+    # when Morph exits.
+    _pending_caches = weakref.WeakSet()
+
+    max_pending = 10000
+
+    def __init__(self, cachefs, index_path):
         self.cachefs = cachefs
+        self.index = morphlib.artifactcacheindex.ArtifactCacheIndex(
+            index_path, self._join(''))
+        self._lock = threading.Lock()
+        self._used = {}
+        self._gone = set()
+
+    def _put_file(self, filename):
+        return _IndexedSaveFile(self, filename, mode='w')
 
     def put(self, artifact):
         filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._put_file(filename)
 
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._put_file(filename)
 
     def put_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._put_file(filename)
+
+    def add_source_metadata(self, source, cachekey, name):
+        '''Record source metadata that was saved without using put.'''
+
+        filename = self._source_metadata_filename(source, cachekey, name)
+        self._add_file(filename)
+
+    def _add_file(self, filename):
+        basename = os.path.basename(filename)
+        with self._lock:
+            self._gone.discard(basename)
+        self.index.add(basename, os.path.getsize(filename))
 
     def _has_file(self, filename):
-        if os.path.exists(filename):
-            os.utime(filename, None)
-            return True
-        return False
+        exists = os.path.exists(filename)
+        self._record_use(os.path.basename(filename), exists)
+        return exists
+
+    def _record_use(self, basename, exists):
+        with self._lock:
+            if exists:
+                self._used[basename] = time.time()
+                self._gone.discard(basename)
+            else:
+                self._used.pop(basename, None)
+                self._gone.add(basename)
+            pending = len(self._used) + len(self._gone)
+            LocalArtifactCache._pending_caches.add(self)
+        if pending >= self.max_pending:
+            self.flush()
+
+    def _open_file(self, filename):
+        f = open(filename)
+        self._record_use(os.path.basename(filename), True)
+        return f
+
+    def _size_of(self, basename):
+        try:
+            return os.path.getsize(self._join(basename))
+        except OSError:
+            return None
+
+    def flush(self):
+        '''Write the uses of files recorded so far to the index.'''
+
+        with self._lock:
+            used, self._used = self._used, {}
+            gone, self._gone = self._gone, set()
+            LocalArtifactCache._pending_caches.discard(self)
+        # A file may have been saved again since it was found missing.
+        gone = [basename for basename in gone
+                if not os.path.exists(self._join(basename))]
+        if used or gone:
+            self.index.record_uses(used, gone, self._size_of)
+
+    @classmethod
+    def flush_all(cls):  # pragma: no cover
+        '''Write the uses recorded by every cache to their indexes.'''
+
+        for cache in list(cls._pending_caches):
+            cache.flush()
 
     def has(self, artifact):
         filename = self.artifact_filename(artifact)
@@ -80,21 +177,18 @@ class LocalArtifactCache(object):
 
     def get(self, artifact):
         filename = self.artifact_filename(artifact)
-        os.utime(filename, None)
-        return open(filename)
+        return self._open_file(filename)
 
     def get_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        os.utime(filename, None)
-        return open(filename)
+        return self._open_file(filename)
 
     def get_source_metadata_filename(self, source, cachekey, name):
         return self._source_metadata_filename(source, cachekey, name)
 
     def get_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        os.utime(filename, None)
-        return open(filename)
+        return self._open_file(filename)
 
     def _join(self, basename):
         '''Wrapper for pyfilesystem's getsyspath.
@@ -114,15 +208,26 @@ class LocalArtifactCache(object):
     def _source_metadata_filename(self, source, cachekey, name):
         return self._join('%s.%s' % (cachekey, name))
 
+    def _remove_file(self, basename):
+        try:
+            os.remove(self._join(basename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def clear(self):
         '''Clear everything from the artifact cache directory.
-        
+
         After calling this, the artifact cache will be entirely empty.
         Caveat caller.
 
-         '''
+        '''
         for filename in self.cachefs.walkfiles():
             self.cachefs.remove(filename)
+        with self._lock:
+            self._used.clear()
+            self._gone.clear()
+        self.index.clear()
 
     def list_contents(self):
         '''Return the set of sources cached and related information.
@@ -130,22 +235,24 @@ class LocalArtifactCache(object):
            returns a [(cache_key, set(artifacts), last_used)]
 
         '''
-        CacheInfo = collections.namedtuple('CacheInfo', ('artifacts', 'mtime'))
-        contents = collections.defaultdict(lambda: CacheInfo(set(), 0))
-        for filename in self.cachefs.walkfiles():
-            cachekey = filename[:63]
-            artifact = filename[65:]
-            artifacts, max_mtime = contents[cachekey]
-            artifacts.add(artifact)
-            art_info = self.cachefs.getinfo(filename)
-            time_t = art_info['modified_time'].timetuple()
-            contents[cachekey] = CacheInfo(artifacts,
-                                           max(max_mtime, time.mktime(time_t)))
-        return ((cache_key, info.artifacts, info.mtime)
+        self.flush()
+        CacheInfo = collections.namedtuple('CacheInfo',
+                                           ('artifacts', 'last_used'))
+        contents = collections.OrderedDict()
+        for cachekey, filename, size, last_used in self.index.contents():
+            info = contents.get(cachekey, CacheInfo(set(), 0))
+            info.artifacts.add(filename[len(cachekey) + 1:])
+            contents[cachekey] = CacheInfo(info.artifacts,
+                                           max(info.last_used, last_used))
+        return ((cache_key, info.artifacts, info.last_used)
                 for cache_key, info in contents.iteritems())
 
     def remove(self, cachekey):
         '''Remove all artifacts associated with the given cachekey.'''
-        for filename in (x for x in self.cachefs.walkfiles()
-                         if x.startswith(cachekey)):
-            self.cachefs.remove(filename)
+        self.flush()
+        for basename in self.index.files(cachekey):
+            self._remove_file(basename)
+        self.index.remove(cachekey)
+
+
+atexit.register(LocalArtifactCache.flush_all)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012,2014  Codethink Limited
+# Copyright (C) 2012,2014,2015  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,6 +16,8 @@
 
 import unittest
 import os
+import shutil
+import tempfile
 
 import fs.tempfs
 
@@ -26,6 +28,8 @@ class LocalArtifactCacheTests(unittest.TestCase):
 
     def setUp(self):
         self.tempfs = fs.tempfs.TempFS()
+        self.tempdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tempdir, 'artifacts.index')
 
         loader = morphlib.morphloader.MorphologyLoader()
         morph = loader.load_from_string(
@@ -53,14 +57,22 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.devel_artifact = morphlib.artifact.Artifact(
             self.source, 'chunk-devel')
 
+    def tearDown(self):
+        self.tempfs.close()
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self):
+        return morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, self.index_path)
+
     def test_artifact_filename(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
         filename = cache.artifact_filename(self.devel_artifact)
         expected_name = self.tempfs.getsyspath(self.devel_artifact.basename())
         self.assertEqual(filename, expected_name)
 
     def test_get_source_metadata_filename(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
         artifact = self.devel_artifact
         source = self.source
         name = 'foobar'
@@ -72,7 +84,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(filename, expected_name)
 
     def test_put_artifacts_and_check_whether_the_cache_has_them(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -88,7 +100,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertTrue(cache.has(self.devel_artifact))
 
     def test_put_artifacts_and_get_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -117,7 +129,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(stored_data, 'devel')
 
     def test_put_check_and_get_artifact_metadata(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put_artifact_metadata(self.runtime_artifact, 'log')
         handle.write('log line 1\nlog line 2\n')
@@ -133,7 +145,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(stored_metadata, 'log line 1\nlog line 2\n')
 
     def test_put_check_and_get_source_metadata(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put_source_metadata(self.source, 'mycachekey', 'log')
         handle.write('source log line 1\nsource log line 2\n')
@@ -150,7 +162,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
                          'source log line 1\nsource log line 2\n')
 
     def test_clears_artifact_cache(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -161,7 +173,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertFalse(cache.has(self.runtime_artifact))
 
     def test_put_artifacts_and_list_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -176,7 +188,7 @@ class LocalArtifactCacheTests(unittest.TestCase):
         self.assertEqual(len(list(cache.list_contents())), 1)
 
     def test_put_artifacts_and_remove_them_afterwards(self):
-        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        cache = self.new_cache()
 
         handle = cache.put(self.runtime_artifact)
         handle.write('runtime')
@@ -190,3 +202,160 @@ class LocalArtifactCacheTests(unittest.TestCase):
         cache.remove(key)
 
         self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def test_lists_artifacts_with_cache_key(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        handle = cache.put_artifact_metadata(self.runtime_artifact, 'meta')
+        handle.write('{}')
+        handle.close()
+
+        (cachekey, artifacts, last_used), = cache.list_contents()
+        self.assertEqual(cachekey, self.source.cache_key)
+        self.assertEqual(artifacts,
+                         set(['chunk.chunk-runtime',
+                              'chunk.chunk-runtime.meta']))
+
+    def test_indexes_files_cached_before_the_index_existed(self):
+        with open(self.tempfs.getsyspath(self.runtime_artifact.basename()),
+                  'w') as f:
+            f.write('runtime')
+        cache = self.new_cache()
+
+        self.assertEqual(len(list(cache.list_contents())), 1)
+        cache.remove(self.source.cache_key)
+        self.assertFalse(cache.has(self.runtime_artifact))
+
+    def test_notices_files_removed_behind_its_back(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        os.remove(cache.artifact_filename(self.runtime_artifact))
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertEqual(len(list(cache.list_contents())), 0)
+
+    def test_notices_files_added_behind_its_back(self):
+        cache = self.new_cache()
+        self.assertEqual(list(cache.list_contents()), [])
+
+        with open(cache.artifact_filename(self.runtime_artifact), 'w') as f:
+            f.write('runtime')
+        self.assertTrue(cache.has(self.runtime_artifact))
+        self.assertEqual(len(list(cache.list_contents())), 1)
+
+    def test_remove_leaves_other_sources_alone(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        handle = cache.put_source_metadata(self.source, '1' * 64, 'log')
+        handle.write('log')
+        handle.close()
+
+        cache.remove(self.source.cache_key)
+        self.assertFalse(cache.has(self.runtime_artifact))
+        self.assertTrue(cache.has_source_metadata(self.source, '1' * 64,
+                                                  'log'))
+
+    def test_records_uses_in_index_only_when_flushed(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        cache.index.add(self.runtime_artifact.basename(), 7, last_used=0)
+
+        cache.has(self.runtime_artifact)
+        self.assertEqual(cache.index.contents()[0][3], 0)
+        cache.flush()
+        self.assertTrue(cache.index.contents()[0][3] > 0)
+
+    def test_does_not_change_files_when_checking_them(self):
+        cache = self.new_cache()
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        filename = cache.artifact_filename(self.runtime_artifact)
+        os.utime(filename, (10, 10))
+
+        cache.has(self.runtime_artifact)
+        cache.get(self.runtime_artifact).close()
+        cache.flush()
+        self.assertEqual(os.stat(filename).st_mtime, 10)
+
+    def test_flushes_after_many_uses(self):
+        cache = self.new_cache()
+        cache.max_pending = 2
+
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+        os.remove(cache.artifact_filename(self.runtime_artifact))
+
+        cache.has(self.runtime_artifact)
+        self.assertEqual(len(cache.index.contents()), 1)
+        cache.has(self.devel_artifact)
+        self.assertEqual(cache.index.contents(), [])
+
+    def test_keeps_file_saved_after_it_was_found_missing(self):
+        cache = self.new_cache()
+
+        self.assertFalse(cache.has(self.runtime_artifact))
+        handle = cache.put(self.runtime_artifact)
+        handle.write('runtime')
+        handle.close()
+
+        cache.flush()
+        self.assertTrue(cache.has(self.runtime_artifact))
+        self.assertEqual(len(list(cache.list_contents())), 1)
+
+    def test_records_source_metadata_saved_without_put(self):
+        cache = self.new_cache()
+
+        filename = cache.get_source_metadata_filename(
+            self.source, self.source.cache_key, 'log')
+        with open(filename, 'w') as f:
+            f.write('log')
+        cache.add_source_metadata(self.source, self.source.cache_key, 'log')
+        self.assertEqual(cache.index.files(self.source.cache_key),
+                         [self.source.cache_key + '.log'])
+
+    def test_removes_source_with_files_already_gone(self):
+        cache = self.new_cache()
+
+        cache.index.add(self.runtime_artifact.basename(), 7)
+        cache.remove(self.source.cache_key)
+        self.assertEqual(cache.index.contents(), [])
+
+    def test_remove_fails_if_a_file_cannot_be_removed(self):
+        cache = self.new_cache()
+
+        os.mkdir(cache.artifact_filename(self.runtime_artifact))
+        cache.index.add(self.runtime_artifact.basename(), 7)
+        self.assertRaises(OSError, cache.remove, self.source.cache_key)
+
+    def test_does_not_index_file_removed_before_its_use_was_written(self):
+        cache = self.new_cache()
+
+        filename = cache.artifact_filename(self.runtime_artifact)
+        with open(filename, 'w') as f:
+            f.write('runtime')
+        self.assertTrue(cache.has(self.runtime_artifact))
+        os.remove(filename)
+        cache.flush()
+        self.assertEqual(cache.index.contents(), [])
+
+    def test_flushes_nothing_when_nothing_was_used(self):
+        cache = self.new_cache()
+        cache.index.record_uses = lambda *args: self.fail('recorded uses')
+        cache.flush()
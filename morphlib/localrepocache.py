@@ -192,7 +192,9 @@ class LocalRepoCache(object):
         '''
         errors = []
         if not self.fs.exists(self._cachedir):
-            self.fs.makedir(self._cachedir, recursive=True)
+            # Another thread may be caching a repo at the same time.
+            self.fs.makedir(self._cachedir, recursive=True,
+                            allow_recreate=True)
 
         try:
             return self.get_repo(reponame)
@@ -45,7 +45,7 @@ class Morphology(UserDict.IterableUserDict):
 
     @property
     def needs_artifact_metadata_cached(self): # pragma: no cover
-        return self.get('kind') == 'stratum'
+        return self.get('kind') in ('stratum', 'system')
 
     def __hash__(self): # pragma: no cover
         return id(self)
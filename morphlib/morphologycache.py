@@ -0,0 +1,134 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import hashlib
+import logging
+import os
+
+import morphlib
+
+
+class MorphologyCache(object):
+
+    '''Keep parsed and validated morphologies on disk.
+
+    Loading a morphology means parsing YAML, validating the result and
+    filling in the defaults or, for chunks without a morphology file,
+    detecting the build system from the files in the repository. None of
+    that can change for a given (repo, commit SHA1, filename) triple, so
+    the finished Morphology is stored under that key and loaded back with
+    no YAML work at all on later runs.
+
+    The version of Morph is part of the key too, because validation and
+    defaults change between versions. Nothing is cached when running from
+    a git tree with uncommitted changes, since the version does not
+    identify the code then.
+
+    The total size of the cache is kept below `max_size` bytes by removing
+    the least recently used entries. A `max_size` of 0 disables the cache.
+
+    '''
+
+    def __init__(self, cachedir, max_size, version=None):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.version = version or morphlib.__version__
+        self._size = None
+
+    def _enabled(self, sha1):
+        return (self.max_size > 0 and
+                not self.version.endswith('-unreproducible') and
+                morphlib.git.is_valid_sha1(sha1))
+
+    def _path(self, reponame, sha1, filename):
+        key = '\0'.join((self.version, reponame, sha1, filename))
+        return os.path.join(self.cachedir, hashlib.sha1(key).hexdigest())
+
+    def get(self, reponame, sha1, filename):
+        '''Return the cached morphology, or None if it is not cached.'''
+
+        if not self._enabled(sha1):
+            return None
+        path = self._path(reponame, sha1, filename)
+        try:
+            with open(path, 'rb') as f:
+                data, morph_filename = cPickle.load(f)
+        except IOError:
+            return None
+        except Exception, e:
+            logging.warning('Removing unreadable cached morphology %s: %s' %
+                            (path, e))
+            self._remove(path)
+            return None
+
+        # The modification time records when the entry was last used.
+        os.utime(path, None)
+        morph = morphlib.morphology.Morphology(data)
+        morph.filename = morph_filename
+        return morph
+
+    def put(self, reponame, sha1, filename, morphology):
+        '''Store a validated morphology with its defaults filled in.'''
+
+        if not self._enabled(sha1):
+            return
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        path = self._path(reponame, sha1, filename)
+        with morphlib.savefile.SaveFile(path, 'wb') as f:
+            cPickle.dump((morphology.data, morphology.filename), f,
+                         cPickle.HIGHEST_PROTOCOL)
+
+        if self._size is None:
+            self._size = sum(size for path, size, mtime in self._entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_size:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            # Skip temporary files that SaveFile is still writing.
+            if not morphlib.git.is_valid_sha1(name):
+                continue
+            path = os.path.join(self.cachedir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _evict(self):
+        # Free a quarter of the space at once, so that every put does not
+        # have to look at every entry once the cache is full.
+        target = self.max_size * 3 / 4
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if self._size <= target:
+                break
+            logging.debug('Evicting cached morphology %s' % path)
+            self._remove(path)
+            self._size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
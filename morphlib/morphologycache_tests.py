@@ -0,0 +1,126 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class MorphologyCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'morphologies')
+        self.cache = morphlib.morphologycache.MorphologyCache(
+            self.cachedir, 1024 * 1024, version='1')
+        self.sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        self.morph = morphlib.morphology.Morphology({
+            'name': 'foo',
+            'kind': 'chunk',
+            'build-system': 'autotools',
+        })
+        self.morph.filename = 'foo.morph'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_returns_none_when_not_cached(self):
+        self.assertEqual(
+            self.cache.get('repo', self.sha1, 'foo.morph'), None)
+
+    def test_returns_cached_morphology(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        morph = self.cache.get('repo', self.sha1, 'foo.morph')
+        self.assertEqual(morph.data, self.morph.data)
+        self.assertEqual(morph.filename, 'foo.morph')
+        self.assertTrue(isinstance(morph, morphlib.morphology.Morphology))
+
+    def test_returns_a_new_object_each_time(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        morph = self.cache.get('repo', self.sha1, 'foo.morph')
+        morph['name'] = 'bar'
+        self.assertEqual(
+            self.cache.get('repo', self.sha1, 'foo.morph')['name'], 'foo')
+
+    def test_keys_on_repo_sha1_and_filename(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        other_sha1 = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+        self.assertEqual(
+            self.cache.get('other', self.sha1, 'foo.morph'), None)
+        self.assertEqual(
+            self.cache.get('repo', other_sha1, 'foo.morph'), None)
+        self.assertEqual(
+            self.cache.get('repo', self.sha1, 'bar.morph'), None)
+
+    def test_keys_on_morph_version(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        cache = morphlib.morphologycache.MorphologyCache(
+            self.cachedir, 1024 * 1024, version='2')
+        self.assertEqual(cache.get('repo', self.sha1, 'foo.morph'), None)
+
+    def test_does_not_cache_named_refs(self):
+        self.cache.put('repo', 'master', 'foo.morph', self.morph)
+        self.assertEqual(
+            self.cache.get('repo', 'master', 'foo.morph'), None)
+
+    def test_does_not_cache_for_unreproducible_version(self):
+        cache = morphlib.morphologycache.MorphologyCache(
+            self.cachedir, 1024 * 1024, version='abc-unreproducible')
+        cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        self.assertEqual(cache.get('repo', self.sha1, 'foo.morph'), None)
+
+    def test_ignores_corrupt_entries(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), 'w') as f:
+                f.write('garbage')
+        self.assertEqual(
+            self.cache.get('repo', self.sha1, 'foo.morph'), None)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_evicts_least_recently_used_entries(self):
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        entry_size = os.path.getsize(
+            self.cache._path('repo', self.sha1, 'foo.morph'))
+        cache = morphlib.morphologycache.MorphologyCache(
+            self.cachedir, entry_size * 3, version='1')
+        for mtime, filename in enumerate(('foo.morph', 'a.morph', 'b.morph')):
+            cache.put('repo', self.sha1, filename, self.morph)
+            path = cache._path('repo', self.sha1, filename)
+            os.utime(path, (mtime, mtime))
+
+        cache.get('repo', self.sha1, 'a.morph')
+        cache.put('repo', self.sha1, 'c.morph', self.morph)
+
+        self.assertEqual(cache.get('repo', self.sha1, 'foo.morph'), None)
+        self.assertEqual(cache.get('repo', self.sha1, 'b.morph'), None)
+        self.assertNotEqual(cache.get('repo', self.sha1, 'a.morph'), None)
+        self.assertNotEqual(cache.get('repo', self.sha1, 'c.morph'), None)
+
+    def test_does_not_count_temporary_files_or_broken_entries(self):
+        os.makedirs(self.cachedir)
+        with open(os.path.join(self.cachedir, 'tmpabcdef'), 'w') as f:
+            f.write('x' * 2 * 1024 * 1024)
+        os.symlink('missing', os.path.join(self.cachedir, self.sha1))
+        self.cache.put('repo', self.sha1, 'foo.morph', self.morph)
+        self.assertNotEqual(
+            self.cache.get('repo', self.sha1, 'foo.morph'), None)
+
+    def test_ignores_entries_removed_by_another_process(self):
+        self.cache._remove(os.path.join(self.cachedir, self.sha1))
@@ -42,15 +42,31 @@ class MorphologyFactory(object):
     '''A way of creating morphologies which will provide a default'''
 
     def __init__(self, local_repo_cache, remote_repo_cache=None,
-                 status_cb=None):
+                 status_cb=None, morphology_cache=None):
         self._lrc = local_repo_cache
         self._rrc = remote_repo_cache
+        self._cache = morphology_cache
 
         null_status_function = lambda **kwargs: None
         self.status = status_cb or null_status_function
 
     def get_morphology(self, reponame, sha1, filename):
-        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        morph = self._get_cached(reponame, sha1, filename)
+        if morph is None:
+            morph = self._load_morphology(reponame, sha1, filename)
+            self._put_cached(reponame, sha1, filename, morph)
+        return morph
+
+    def _get_cached(self, reponame, sha1, filename):
+        if self._cache is None:
+            return None
+        return self._cache.get(reponame, sha1, filename)
+
+    def _put_cached(self, reponame, sha1, filename, morph):
+        if self._cache is not None:
+            self._cache.put(reponame, sha1, filename, morph)
+
+    def _load_morphology(self, reponame, sha1, filename):
         loader = morphlib.morphloader.MorphologyLoader()
         if self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
@@ -77,14 +93,68 @@ class MorphologyFactory(object):
             raise NotcachedError(reponame)
 
         if morph is None:
-            self.status(msg="File %s doesn't exist: attempting to infer "
-                            "chunk morph from repo's build system"
-                        % filename, chatty=True)
-            bs = morphlib.buildsystem.detect_build_system(file_list)
-            if bs is None:
-                raise MorphologyNotFoundError(filename)
-            morph = bs.get_morphology(morph_name)
-            loader.validate(morph)
-            loader.set_commands(morph)
-            loader.set_defaults(morph)
+            morph = self._infer_morphology(filename, file_list)
+        return morph
+
+    def get_morphologies(self, keys):
+        '''Load many morphologies, batching the remote git cache reads.
+
+        `keys` is a sequence of (reponame, sha1, filename) triples. Files
+        in repos that are not cached locally are requested from the remote
+        git cache all at once, rather than one request per file.
+
+        Returns a dict mapping each triple to its morphology.
+
+        '''
+        morphologies = {}
+        uncached_keys = []
+        for key in keys:
+            if key not in morphologies:
+                morphologies[key] = self._get_cached(*key)
+                if morphologies[key] is None:
+                    uncached_keys.append(key)
+        keys = uncached_keys
+
+        remote_keys = set()
+        if self._rrc is not None:
+            remote_keys = set(key for key in keys
+                              if not self._lrc.has_repo(key[0]))
+
+        texts = None
+        if remote_keys:
+            self.status(msg="Retrieving %(count)d morphologies from the "
+                        "remote git cache.", count=len(remote_keys),
+                        chatty=True)
+            try:
+                texts = self._rrc.cat_files_many(sorted(remote_keys))
+            except morphlib.remoterepocache.BatchRequestError:
+                texts = None
+
+        loader = morphlib.morphloader.MorphologyLoader()
+        for key in keys:
+            reponame, sha1, filename = key
+            if texts is None or key not in remote_keys:
+                morph = self._load_morphology(reponame, sha1, filename)
+            elif key in texts:
+                morph = loader.load_from_string(texts[key])
+            else:
+                file_list = self._rrc.ls_tree(reponame, sha1)
+                morph = self._infer_morphology(filename, file_list)
+            self._put_cached(reponame, sha1, filename, morph)
+            morphologies[key] = morph
+        return morphologies
+
+    def _infer_morphology(self, filename, file_list):
+        morph_name = os.path.splitext(os.path.basename(filename))[0]
+        self.status(msg="File %s doesn't exist: attempting to infer "
+                        "chunk morph from repo's build system"
+                    % filename, chatty=True)
+        bs = morphlib.buildsystem.detect_build_system(file_list)
+        if bs is None:
+            raise MorphologyNotFoundError(filename)
+        morph = bs.get_morphology(morph_name)
+        loader = morphlib.morphloader.MorphologyLoader()
+        loader.validate(morph)
+        loader.set_commands(morph)
+        loader.set_defaults(morph)
         return morph
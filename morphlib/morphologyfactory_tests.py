@@ -25,6 +25,9 @@ from morphlib.remoterepocache import CatFileError
 
 class FakeRemoteRepoCache(object):
 
+    def __init__(self):
+        self.requests = []
+
     def cat_file(self, reponame, sha1, filename):
         if filename.endswith('.morph'):
             return '''{
@@ -34,10 +37,33 @@ class FakeRemoteRepoCache(object):
              }''' % filename[:-len('.morph')]
         return 'text'
 
+    def cat_files_many(self, triples):
+        self.requests.append(triples)
+        contents = {}
+        for reponame, sha1, filename in triples:
+            try:
+                contents[reponame, sha1, filename] = self.cat_file(
+                    reponame, sha1, filename)
+            except CatFileError:
+                pass
+        return contents
+
     def ls_tree(self, reponame, sha1):
         return []
 
 
+class FakeMorphologyCache(object):
+
+    def __init__(self):
+        self.morphologies = {}
+
+    def get(self, reponame, sha1, filename):
+        return self.morphologies.get((reponame, sha1, filename))
+
+    def put(self, reponame, sha1, filename, morphology):
+        self.morphologies[reponame, sha1, filename] = morphology
+
+
 class FakeLocalRepo(object):
 
     morphologies = {
@@ -211,6 +237,59 @@ class MorphologyFactoryTests(unittest.TestCase):
                                        'assumed-remote.morph')
         self.assertEqual('assumed-remote', morph['name'])
 
+    def test_gets_many_remote_morphs_in_one_request(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        keys = [('reponame', 'sha1', 'foo.morph'),
+                ('reponame', 'sha1', 'bar.morph'),
+                ('reponame', 'sha1', 'foo.morph')]
+        morphs = self.mf.get_morphologies(keys)
+        self.assertEqual(len(self.rrc.requests), 1)
+        self.assertEqual(sorted(self.rrc.requests[0]), sorted(set(keys)))
+        self.assertEqual(morphs[keys[0]]['name'], 'foo')
+        self.assertEqual(morphs[keys[1]]['name'], 'bar')
+
+    def test_falls_back_to_single_reads_when_batch_request_fails(self):
+        def fail(triples):
+            raise morphlib.remoterepocache.BatchRequestError('files',
+                                                             len(triples))
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_files_many = fail
+        key = ('reponame', 'sha1', 'foo.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(morphs[key]['name'], 'foo')
+
+    def test_autodetects_many_remote_morphs(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_file = self.noremotemorph
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        key = ('reponame', 'sha1', 'assumed-remote.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(morphs[key]['name'], 'assumed-remote')
+
+    def test_gets_many_local_morphs_without_remote_request(self):
+        key = ('reponame', 'sha1', 'chunk.morph')
+        morphs = self.mf.get_morphologies([key])
+        self.assertEqual(self.rrc.requests, [])
+        self.assertEqual(morphs[key]['name'], 'chunk')
+
+    def test_stores_loaded_morph_in_cache(self):
+        cache = FakeMorphologyCache()
+        mf = MorphologyFactory(self.lrc, self.rrc, morphology_cache=cache)
+        morph = mf.get_morphology('reponame', 'sha1', 'chunk.morph')
+        self.assertEqual(cache.get('reponame', 'sha1', 'chunk.morph'), morph)
+
+    def test_uses_cached_morph_without_reading_file(self):
+        cache = FakeMorphologyCache()
+        cached = morphlib.morphology.Morphology({'name': 'cached'})
+        cache.put('reponame', 'sha1', 'chunk.morph', cached)
+        self.lr.read_file = self.nolocalfile
+        mf = MorphologyFactory(self.lrc, self.rrc, morphology_cache=cache)
+        self.assertEqual(
+            mf.get_morphology('reponame', 'sha1', 'chunk.morph'), cached)
+        self.assertEqual(
+            mf.get_morphologies([('reponame', 'sha1', 'chunk.morph')]),
+            {('reponame', 'sha1', 'chunk.morph'): cached})
+
     def test_raises_error_when_no_local_morph(self):
         self.lr.read_file = self.nolocalfile
         self.assertRaises(MorphologyNotFoundError, self.mf.get_morphology,
@@ -0,0 +1,73 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+class OrderedSet(object):
+
+    '''A set that remembers the order items were added in.
+
+    This is used for the edges of the build graph, which are added one at a
+    time, checking each time that the edge is not already there, and are
+    then iterated in the order they were added. Membership tests take
+    constant time, unlike with a list.
+
+    Comparing with a list or another OrderedSet compares the items in
+    order, so an OrderedSet can be used where a list was before.
+
+    '''
+
+    __slots__ = ('_items', '_set')
+
+    def __init__(self, iterable=()):
+        self._items = []
+        self._set = set()
+        for item in iterable:
+            self.add(item)
+
+    def add(self, item):
+        '''Add an item at the end, unless it is already in the set.'''
+        if item not in self._set:
+            self._set.add(item)
+            self._items.append(item)
+
+    def __contains__(self, item):
+        return item in self._set
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __eq__(self, other):
+        if isinstance(other, OrderedSet):
+            return self._items == other._items
+        if isinstance(other, list):
+            return self._items == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'OrderedSet(%r)' % self._items
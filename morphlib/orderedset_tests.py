@@ -0,0 +1,68 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import morphlib
+
+
+class OrderedSetTests(unittest.TestCase):
+
+    def test_is_empty_initially(self):
+        s = morphlib.orderedset.OrderedSet()
+        self.assertEqual(len(s), 0)
+        self.assertEqual(list(s), [])
+
+    def test_iterates_in_insertion_order(self):
+        s = morphlib.orderedset.OrderedSet(['c', 'a', 'b'])
+        self.assertEqual(list(s), ['c', 'a', 'b'])
+
+    def test_ignores_duplicates(self):
+        s = morphlib.orderedset.OrderedSet(['a', 'b'])
+        s.add('a')
+        self.assertEqual(list(s), ['a', 'b'])
+        self.assertEqual(len(s), 2)
+
+    def test_has_membership(self):
+        s = morphlib.orderedset.OrderedSet(['a'])
+        self.assertTrue('a' in s)
+        self.assertFalse('b' in s)
+
+    def test_compares_with_lists_in_order(self):
+        s = morphlib.orderedset.OrderedSet(['a', 'b'])
+        self.assertEqual(s, ['a', 'b'])
+        self.assertNotEqual(s, ['b', 'a'])
+        self.assertEqual(s, morphlib.orderedset.OrderedSet(['a', 'b']))
+        self.assertEqual(morphlib.orderedset.OrderedSet(), [])
+
+    def test_indexes_in_insertion_order(self):
+        s = morphlib.orderedset.OrderedSet(['c', 'a'])
+        self.assertEqual(s[0], 'c')
+        self.assertEqual(s[-1], 'a')
+
+    def test_is_not_equal_to_other_types(self):
+        s = morphlib.orderedset.OrderedSet(['a'])
+        self.assertFalse(s == ('a',))
+        self.assertTrue(s != ('a',))
+        self.assertTrue(s != set(['a']))
+
+    def test_is_unhashable(self):
+        s = morphlib.orderedset.OrderedSet(['a'])
+        self.assertRaises(TypeError, hash, s)
+
+    def test_shows_items_in_repr(self):
+        s = morphlib.orderedset.OrderedSet(['a', 'b'])
+        self.assertEqual(repr(s), "OrderedSet(['a', 'b'])")
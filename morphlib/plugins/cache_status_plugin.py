@@ -0,0 +1,77 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+
+import morphlib
+
+
+class CacheStatusPlugin(cliapp.Plugin):
+
+    def enable(self):
+        self.app.add_subcommand('cache-status', self.cache_status,
+                                arg_synopsis='SYSTEM')
+
+    def disable(self):
+        pass
+
+    def cache_status(self, args):
+        '''Show which artifacts of a system are cached.
+
+        Command line arguments:
+
+        * `SYSTEM` is the name of the system, in the root repository of
+          the current system branch, as for `morph build`.
+
+        Every artifact in the build graph of the system is listed with
+        whether it is in the local artifact cache (`local`), only in the
+        remote artifact cache (`remote`), or in neither, so would be built
+        by `morph build` (`missing`). The remote cache is asked about all
+        of them in a single request.
+
+        Like `morph build`, this uses the commit checked out in the root
+        repository and ignores uncommitted changes.
+
+        Example:
+
+            morph cache-status devel-system-x86_64-generic.morph
+
+        '''
+
+        if len(args) != 1:
+            raise cliapp.AppException('morph cache-status expects exactly '
+                                      'one parameter: the system to check')
+
+        morphlib.workspace.open('.')
+        sb = morphlib.sysbranchdir.open_from_within('.')
+        system_filename = morphlib.util.sanitise_morphology_path(args[0])
+        system_filename = sb.relative_to_root_repo(system_filename)
+
+        root_repo_url = sb.get_config('branch.root')
+        ref = sb.get_config('branch.name')
+        definitions_repo = morphlib.gitdir.GitDirectory(
+            sb.get_git_directory_name(root_repo_url))
+        commit = definitions_repo.resolve_ref_to_commit(ref)
+
+        build_command = morphlib.buildcommand.BuildCommand(self.app)
+        root_artifact = build_command.get_root_artifact(
+            root_repo_url, commit, system_filename, original_ref=ref)
+        states = build_command.get_cache_states(root_artifact.walk())
+
+        for artifact in root_artifact.walk():
+            self.app.output.write('%-7s %s\n' % (states[artifact],
+                                                 artifact.basename()))
+        build_command.report_cache_states(states)
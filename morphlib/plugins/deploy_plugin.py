@@ -442,9 +442,7 @@ class DeployPlugin(cliapp.Plugin):
         try:
             # Find the artifact to build
             morph = morphlib.util.sanitise_morphology_path(system['morph'])
-            srcpool = build_command.create_source_pool(build_repo, ref, morph)
-
-            artifact = build_command.resolve_artifacts(srcpool)
+            artifact = build_command.get_root_artifact(build_repo, ref, morph)
 
             deploy_defaults = system.get('deploy-defaults', {})
             for system_id, deploy_params in system['deploy'].iteritems():
@@ -547,16 +545,21 @@ class DeployPlugin(cliapp.Plugin):
             # Unpack the artifact (tarball) to a temporary directory.
             self.app.status(msg='Unpacking system for configuration')
 
-            if build_command.lac.has(artifact):
+            state = build_command.get_cache_states([artifact])[artifact]
+            if state == 'local':
                 f = build_command.lac.get(artifact)
-            elif build_command.rac.has(artifact):
+            elif state == 'remote':
                 build_command.cache_artifacts_locally([artifact])
                 f = build_command.lac.get(artifact)
             else:
+                states = build_command.get_cache_states(artifact.walk())
+                missing = states.values().count('missing')
                 raise cliapp.AppException('Deployment failed as system is'
-                                          ' not yet built.\nPlease ensure'
-                                          ' the system is built before'
-                                          ' deployment.')
+                                          ' not yet built (%d of its %d'
+                                          ' artifacts are not cached).\n'
+                                          'Please ensure the system is built'
+                                          ' before deployment.' %
+                                          (missing, len(states)))
             tf = tarfile.open(fileobj=f)
             tf.extractall(path=system_tree)
 
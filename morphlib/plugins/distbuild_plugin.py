@@ -18,7 +18,7 @@
 
 import cliapp
 import logging
-import re
+import os
 import sys
 
 import morphlib
@@ -27,6 +27,17 @@ import distbuild
 
 group_distbuild = 'Distributed Build Options'
 
+
+def worker_jobserver_path(settings):
+    '''Return where a worker daemon keeps its make jobserver's FIFO.
+
+    worker-build is run by the helper rather than by the worker daemon,
+    so it finds the jobserver here instead of inheriting it.
+
+    '''
+
+    return os.path.join(settings['tempdir'], 'worker-jobserver', 'fifo')
+
 class DistbuildOptionsPlugin(cliapp.Plugin):
 
     def enable(self):
@@ -69,9 +80,8 @@ class SerialiseArtifactPlugin(cliapp.Plugin):
 
         filename = morphlib.util.sanitise_morphology_path(morph_name)
         build_command = morphlib.buildcommand.BuildCommand(self.app)
-        srcpool = build_command.create_source_pool(
+        artifact = build_command.get_root_artifact(
             repo_name, ref, filename, original_ref=original_ref)
-        artifact = build_command.resolve_artifacts(srcpool)
         self.app.output.write(distbuild.serialise_artifact(artifact))
         self.app.output.write('\n')
 
@@ -112,10 +122,16 @@ class WorkerBuild(cliapp.Plugin):
         self.app.subcommands['gc']([])
 
         arch = artifact.arch
-        bc.build_source(artifact.source, bc.new_build_env(arch))
+        # Share the make jobs with the other builds on this worker.
+        bc.attach_jobserver(worker_jobserver_path(self.app.settings))
+        try:
+            bc.build_source(artifact.source, bc.new_build_env(arch))
+        finally:
+            bc.stop_jobserver()
 
     def is_system_artifact(self, filename):
-        return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
+        # list_contents gives the file names without the cache key.
+        return filename.startswith('system.')
 
 class WorkerDaemon(cliapp.Plugin):
 
@@ -155,7 +171,30 @@ class WorkerDaemon(cliapp.Plugin):
                                         port_file=port_file)
         loop = distbuild.MainLoop()
         loop.add_state_machine(router)
-        loop.run()
+        jobserver = self.start_jobserver()
+        try:
+            loop.run()
+        finally:
+            if jobserver is not None:
+                jobserver.close()
+
+    def start_jobserver(self):
+        '''Start one make jobserver for all the builds on this worker.
+
+        Every make can run one job without taking a token, so there is one
+        token fewer than max-jobs. Several builds running at once then
+        share the jobs, instead of each running max-jobs of its own.
+
+        '''
+
+        settings = self.app.settings
+        if settings['no-jobserver']:
+            return None
+        path = worker_jobserver_path(settings)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return morphlib.jobserver.JobServer(
+            path, max(0, settings['max-jobs'] - 1))
 
 
 class ControllerDaemon(cliapp.Plugin):
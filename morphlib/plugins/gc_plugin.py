@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2015  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,7 +19,6 @@ import os
 import shutil
 import time
 
-import fs.osfs
 import cliapp
 
 import morphlib
@@ -42,6 +41,34 @@ class GCPlugin(cliapp.Plugin):
                                   metavar='PERIOD',
                                   group="Storage Options",
                                   default=(60*60*24))
+        self.app.settings.bytesize(['cachedir-artifact-max-size'],
+                                   'remove the least recently used '
+                                   'artifacts, keeping those of recently '
+                                   'used strata and systems, until the '
+                                   'artifact cache is no bigger than SIZE; '
+                                   '0 cleans up by free space and age '
+                                   'instead (default: %default)',
+                                   metavar='SIZE',
+                                   group="Storage Options",
+                                   default='0')
+        self.app.settings.integer(['cachedir-gc-max-removals'],
+                                  'with cachedir-artifact-max-size, remove '
+                                  'at most N sources each time; 0 for no '
+                                  'limit (default: %default)',
+                                  metavar='N',
+                                  group="Storage Options",
+                                  default=0)
+        self.app.settings.integer(['cachedir-gc-max-reads'],
+                                  'with cachedir-artifact-max-size, read what '
+                                  'at most N strata and systems refer to each '
+                                  'time; 0 for no limit (default: %default)',
+                                  metavar='N',
+                                  group="Storage Options",
+                                  default=0)
+        self.app.settings.boolean(['gc-dry-run'],
+                                  'only report what `morph gc` would remove '
+                                  'from the artifact cache',
+                                  group="Storage Options")
 
     def disable(self):
         pass
@@ -66,6 +93,20 @@ class GCPlugin(cliapp.Plugin):
            won't be e.g. if morph gets a SIGKILL or the machine running
            morph loses power.
 
+           If --cachedir-artifact-max-size is set, the artifact cache is
+           instead kept within that size, whatever the free space. The
+           least recently used sources are removed first, but the chunks
+           and strata of a stratum or system count as used whenever it
+           was, so whole systems are kept or removed together. Nothing
+           used more recently than --cachedir-artifact-keep-younger-than
+           is removed. --cachedir-gc-max-removals and
+           --cachedir-gc-max-reads bound the work done by each run, so
+           that it can be run often, cleaning up a little each time.
+
+           With --gc-dry-run, which needs --cachedir-artifact-max-size,
+           nothing is removed, and the sources that would be removed from
+           the artifact cache are listed instead.
+
         '''
 
         tempdir = self.app.settings['tempdir']
@@ -75,15 +116,28 @@ class GCPlugin(cliapp.Plugin):
                 tempdir, self.app.settings['tempdir-min-space'],
                 cachedir, self.app.settings['cachedir-min-space'])
 
+        max_size = self.app.settings['cachedir-artifact-max-size']
+        if self.app.settings['gc-dry-run']:
+            if max_size <= 0:
+                raise cliapp.AppException(
+                    '--gc-dry-run needs --cachedir-artifact-max-size, as '
+                    'otherwise what is removed depends on the free space '
+                    'left after each removal')
+            self.cleanup_cachedir_to_size(cachedir, max_size, dry_run=True)
+            return
+
         self.cleanup_tempdir(tempdir, tempdir_min_space)
-        self.cleanup_cachedir(cachedir, cachedir_min_space)
-        
+        if max_size > 0:
+            self.cleanup_cachedir_to_size(cachedir, max_size)
+        else:
+            self.cleanup_cachedir(cachedir, cachedir_min_space)
+
     def cleanup_tempdir(self, temp_path, min_space):
         # The subdirectories in tempdir are created at Morph startup time. Code
         # assumes that they exist in various places.
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
+        for subdir in ('deployments', 'failed', 'chunks', 'sources'):
             if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
@@ -93,6 +147,16 @@ class GCPlugin(cliapp.Plugin):
             self.app.status(msg='Removing temp subdirectory: %(subdir)s',
                             subdir=subdir)
             path = os.path.join(temp_path, subdir)
+            if subdir == 'chunks' and os.path.exists(path):
+                # Staging areas being set up may be using unpacked chunks.
+                chunk_cache = morphlib.util.new_unpacked_chunk_cache(
+                    self.app.settings)
+                chunk_cache.evict(0)
+                continue
+            if subdir == 'sources' and os.path.exists(path):
+                # Builds may be copying sources out of the cache.
+                morphlib.sourcetreecache.SourceTreeCache(path).evict(0)
+                continue
             if os.path.exists(path):
                 shutil.rmtree(path)
             os.mkdir(path)
@@ -126,8 +190,7 @@ class GCPlugin(cliapp.Plugin):
                                 'sufficient space already cleared',
                             chatty=True)
             return
-        lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')))
+        lac = morphlib.util.new_local_artifact_cache(cache_path)
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
@@ -170,3 +233,42 @@ class GCPlugin(cliapp.Plugin):
                             'or reduce cachedir-min-space.',
                         cache_path=cache_path, removed=removed,
                         error=True)
+
+    def cleanup_cachedir_to_size(self, cache_path, max_size, dry_run=False):
+        settings = self.app.settings
+        lac = morphlib.util.new_local_artifact_cache(cache_path)
+        collector = morphlib.artifactcachecollector.ArtifactCacheCollector(lac)
+        removals, remaining = collector.plan(
+            max_size,
+            keep_younger_than=settings['cachedir-artifact-keep-younger-than'],
+            max_removals=settings['cachedir-gc-max-removals'],
+            max_reads=settings['cachedir-gc-max-reads'])
+        freed = sum(source.size for source in removals)
+
+        if dry_run:
+            for source in removals:
+                self.app.output.write('%s %10d %s\n' % (
+                    source.cachekey, source.size,
+                    time.strftime('%Y-%m-%d %H:%M:%S',
+                                  time.localtime(source.last_used))))
+            self.app.status(msg='Would remove %(sources)d sources, freeing '
+                                '%(freed)d bytes and leaving %(remaining)d',
+                            sources=len(removals), freed=freed,
+                            remaining=remaining)
+            return
+
+        for source in removals:
+            self.app.status(msg='Removing source %(cachekey)s',
+                            cachekey=source.cachekey, chatty=True)
+            lac.remove(source.cachekey)
+        self.app.status(msg='Removed %(sources)d sources, freeing '
+                            '%(freed)d bytes and leaving %(remaining)d',
+                        sources=len(removals), freed=freed,
+                        remaining=remaining, chatty=not removals)
+        if remaining > max_size:
+            self.app.status(msg='The artifact cache in %(cache_path)s is '
+                                'still bigger than %(max_size)d bytes, '
+                                'as the rest was used too recently or is '
+                                'left for later runs',
+                            cache_path=cache_path, max_size=max_size,
+                            chatty=True)
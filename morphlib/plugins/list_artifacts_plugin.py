@@ -59,59 +59,30 @@ class ListArtifactsPlugin(cliapp.Plugin):
                                args[2:])
 
         self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
+        self.morphology_cache = morphlib.util.new_morphology_cache(
+            self.app.settings)
+        self.ref_cache = morphlib.util.new_ref_cache(self.app.settings)
+        self.source_pool_snapshot = morphlib.util.new_source_pool_snapshot(
+            self.app.settings)
+        self.build_graph_cache = morphlib.util.new_build_graph_cache(
+            self.app.settings)
         self.resolver = morphlib.artifactresolver.ArtifactResolver()
 
+        system_artifacts = self.get_system_artifacts(
+            repo, ref, system_filenames)
+
         artifact_files = set()
         for system_filename in system_filenames:
             system_artifact_files = self.list_artifacts_for_system(
-                repo, ref, system_filename)
+                system_artifacts[system_filename])
             artifact_files.update(system_artifact_files)
 
         for artifact_file in sorted(artifact_files):
             print artifact_file
 
-    def list_artifacts_for_system(self, repo, ref, system_filename):
+    def list_artifacts_for_system(self, system_artifact):
         '''List all artifact files in the build graph of a single system.'''
 
-        # Sadly, we must use a fresh source pool and a fresh list of artifacts
-        # for each system. Creating a source pool is slow (queries every Git
-        # repo involved in the build) and resolving artifacts isn't so quick
-        # either. Unfortunately, each Source object can only have one set of
-        # Artifact objects associated, which means the source pool cannot mix
-        # sources that are being built for multiple architectures: the build
-        # graph representation does not distinguish chunks or strata of
-        # different architectures right now.
-
-        self.app.status(
-            msg='Creating source pool for %s' % system_filename, chatty=True)
-        source_pool = morphlib.sourceresolver.create_source_pool(
-            self.lrc, self.rrc, repo, ref, system_filename,
-            update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
-
-        self.app.status(
-            msg='Resolving artifacts for %s' % system_filename, chatty=True)
-        root_artifacts = self.resolver.resolve_root_artifacts(source_pool)
-
-        def find_artifact_by_name(artifacts_list, filename):
-            for a in artifacts_list:
-                if a.source.filename == filename:
-                    return a
-            raise ValueError
-
-        system_artifact = find_artifact_by_name(root_artifacts,
-                                                system_filename)
-
-        self.app.status(
-            msg='Computing cache keys for %s' % system_filename, chatty=True)
-        build_env = morphlib.buildenvironment.BuildEnvironment(
-            self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
-
-        for source in set(a.source for a in system_artifact.walk()):
-            source.cache_key = ckc.compute_key(source)
-            source.cache_id = ckc.get_cache_id(source)
-
         artifact_files = set()
         for artifact in system_artifact.walk():
 
@@ -128,3 +99,89 @@ class ListArtifactsPlugin(cliapp.Plugin):
                 artifact_files.add('%s.build-log' % artifact.source.cache_key)
 
         return artifact_files
+
+    def get_system_artifacts(self, repo, ref, system_filenames):
+        '''Return a dict of system artifacts, with cache keys computed.
+
+        A build graph cached by an earlier run is used if it is still
+        valid. The sources are not validated here, as they are by `build`,
+        so graphs stored by this command are marked as such.
+
+        '''
+
+        def new_build_env(arch):
+            return morphlib.buildenvironment.BuildEnvironment(
+                self.app.settings, arch)
+
+        source_resolver = morphlib.sourceresolver.SourceResolver(
+            self.lrc, self.rrc, not self.app.settings['no-git-update'],
+            self.app.status, self.app.settings['resolve-jobs'],
+            self.morphology_cache, self.ref_cache)
+        commit, tree = source_resolver.resolve_ref(repo, ref)
+
+        system_artifacts = {}
+        for system_filename in system_filenames:
+            system_artifact = self.build_graph_cache.get(
+                repo, ref, commit, system_filename, new_build_env,
+                source_resolver.resolve_refs, validated=False)
+            if system_artifact is not None:
+                self.app.status(
+                    msg='Reusing cached build graph for %s' % system_filename,
+                    chatty=True)
+                system_artifacts[system_filename] = system_artifact
+        self.ref_cache.save()
+
+        missing = [system_filename for system_filename in system_filenames
+                   if system_filename not in system_artifacts]
+        if not missing:
+            return system_artifacts
+
+        # All the systems go in one source pool, so the strata and chunks
+        # they share are only resolved once, and for each architecture
+        # only get their cache keys computed once.
+        self.app.status(
+            msg='Creating source pool for %s' % ', '.join(missing),
+            chatty=True)
+        source_pool = morphlib.sourceresolver.create_multi_arch_source_pool(
+            self.lrc, self.rrc, repo, ref, missing,
+            update_repos = not self.app.settings['no-git-update'],
+            status_cb=self.app.status,
+            resolve_jobs=self.app.settings['resolve-jobs'],
+            morphology_cache=self.morphology_cache,
+            ref_cache=self.ref_cache,
+            snapshot=self.source_pool_snapshot)
+
+        self.app.status(msg='Resolving artifacts', chatty=True)
+        root_artifacts = self.resolver.resolve_root_artifacts(source_pool)
+
+        def find_artifact_by_name(artifacts_list, filename):
+            for a in artifacts_list:
+                if a.source.filename == filename:
+                    return a
+            raise ValueError
+
+        build_envs = {}
+        cache_key_computers = {}
+        for system_filename in missing:
+            system_artifact = find_artifact_by_name(root_artifacts,
+                                                    system_filename)
+            arch = system_artifact.source.morphology['arch']
+            if arch not in build_envs:
+                self.app.status(
+                    msg='Computing cache keys for %s' % arch, chatty=True)
+                build_envs[arch] = new_build_env(arch)
+                cache_key_computers[arch] = \
+                    morphlib.cachekeycomputer.CacheKeyComputer(
+                        build_envs[arch])
+            ckc = cache_key_computers[arch]
+
+            for source in set(a.source for a in system_artifact.walk()):
+                source.cache_key = ckc.compute_key(source)
+                source.cache_id = ckc.get_cache_id(source)
+            system_artifact.build_env = build_envs[arch]
+
+            self.build_graph_cache.put(repo, ref, commit, system_filename,
+                                       system_artifact, validated=False)
+            system_artifacts[system_filename] = system_artifact
+
+        return system_artifacts
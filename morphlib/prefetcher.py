@@ -0,0 +1,110 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import multiprocessing.pool
+import sys
+import threading
+import time
+import traceback
+
+
+class Prefetcher(object):
+
+    '''Fetch what upcoming items need in background threads.
+
+    The caller handles `items` one at a time, in order, and calls
+    wait_for() with the index of each item before handling it. That starts
+    calling `fetch` on the next `lookahead` items, on at most `max_workers`
+    threads, and waits for any fetch of the item itself to finish.
+
+    The first item is not fetched in the background, as the caller needs
+    it straight away. Errors from `fetch` are logged and otherwise ignored:
+    the caller still fetches whatever is missing itself, and reports any
+    errors then.
+
+    '''
+
+    def __init__(self, items, fetch, lookahead, max_workers):
+        self._items = list(items)
+        self._fetch = fetch
+        self._lookahead = lookahead
+        self._results = {}
+        self._queued = 1
+        if lookahead > 0 and max_workers > 0:
+            self._pool = multiprocessing.pool.ThreadPool(max_workers)
+        else:
+            self._pool = None
+
+    def _call(self, item):
+        try:
+            self._fetch(item)
+        except Exception:
+            logging.warning('Prefetching %s failed:\n%s' %
+                            (item, traceback.format_exc()))
+
+    def wait_for(self, index):
+        '''Fetch ahead of an item, and wait until it is fetched.'''
+
+        if self._pool is None:
+            return
+        end = min(len(self._items), index + 1 + self._lookahead)
+        for i in xrange(max(self._queued, index + 1), end):
+            self._results[i] = self._pool.apply_async(
+                self._call, (self._items[i],))
+        self._queued = max(self._queued, end)
+
+        result = self._results.pop(index, None)
+        if result is not None:
+            # A timeout is given so that the wait can be interrupted with ^C.
+            result.get(sys.maxint)
+
+    def close(self):
+        '''Drop the fetches not yet started and wait for the others.'''
+
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._results.clear()
+
+
+class BandwidthLimit(object):
+
+    '''Keep the combined download rate of several threads below a limit.
+
+    Every block of data takes up its share of time at `rate` bytes per
+    second, one block after another, and the thread that copied it sleeps
+    until its share is over.
+
+    '''
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def consume(self, size):
+        '''Account for `size` bytes, sleeping if they came too fast.'''
+
+        with self._lock:
+            now = self._clock()
+            self._next = max(self._next, now) + float(size) / self.rate
+            delay = self._next - now
+        if delay > 0:
+            self._sleep(delay)
@@ -0,0 +1,117 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import StringIO
+import threading
+import unittest
+
+import morphlib
+
+
+class PrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def fetch(self, item):
+        with self.lock:
+            self.fetched.append(item)
+
+    def test_fetches_items_ahead_but_not_first(self):
+        prefetcher = morphlib.prefetcher.Prefetcher(
+            'abcde', self.fetch, 2, 2)
+        try:
+            prefetcher.wait_for(0)
+            prefetcher.wait_for(1)
+            prefetcher.wait_for(2)
+            self.assertTrue('a' not in self.fetched)
+            self.assertTrue('b' in self.fetched)
+            self.assertTrue('c' in self.fetched)
+        finally:
+            prefetcher.close()
+
+    def test_does_not_fetch_beyond_lookahead(self):
+        event = threading.Event()
+        prefetcher = morphlib.prefetcher.Prefetcher(
+            'abcde', lambda item: event.wait(), 2, 2)
+        try:
+            prefetcher.wait_for(0)
+            self.assertEqual(sorted(prefetcher._results), [1, 2])
+        finally:
+            event.set()
+            prefetcher.close()
+
+    def test_waits_for_item_being_fetched(self):
+        finished = []
+
+        def fetch(item):
+            finished.append(item)
+
+        prefetcher = morphlib.prefetcher.Prefetcher('abc', fetch, 1, 1)
+        try:
+            prefetcher.wait_for(0)
+            prefetcher.wait_for(1)
+            self.assertEqual(finished[:1], ['b'])
+        finally:
+            prefetcher.close()
+
+    def test_ignores_fetch_errors(self):
+        def fetch(item):
+            raise Exception('network down')
+
+        logger = logging.getLogger()
+        handlers = logger.handlers
+        logger.handlers = [logging.StreamHandler(StringIO.StringIO())]
+        prefetcher = morphlib.prefetcher.Prefetcher('ab', fetch, 1, 1)
+        try:
+            prefetcher.wait_for(0)
+            prefetcher.wait_for(1)
+        finally:
+            prefetcher.close()
+            logger.handlers = handlers
+
+    def test_does_nothing_without_lookahead(self):
+        prefetcher = morphlib.prefetcher.Prefetcher('abc', self.fetch, 0, 2)
+        for i in range(3):
+            prefetcher.wait_for(i)
+        prefetcher.close()
+        self.assertEqual(self.fetched, [])
+
+
+class BandwidthLimitTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.sleeps = []
+        self.limit = morphlib.prefetcher.BandwidthLimit(
+            1000, clock=lambda: self.now, sleep=self.sleeps.append)
+
+    def test_sleeps_for_share_of_time(self):
+        self.limit.consume(500)
+        self.assertEqual(self.sleeps, [0.5])
+
+    def test_queues_blocks_copied_at_same_time(self):
+        self.limit.consume(1000)
+        self.limit.consume(1000)
+        self.assertEqual(self.sleeps, [1.0, 2.0])
+
+    def test_does_not_sleep_after_idle_time(self):
+        self.limit.consume(1000)
+        self.now += 10
+        self.limit.consume(1000)
+        self.assertEqual(self.sleeps, [1.0, 1.0])
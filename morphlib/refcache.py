@@ -0,0 +1,141 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import logging
+import os
+import threading
+import time
+
+import morphlib
+
+
+class RefCache(object):
+
+    '''Remember what named refs resolved to, for a limited time.
+
+    Resolving a named ref such as 'master' means updating the cached git
+    repository or asking the remote repo cache, because the ref may have
+    moved since it was last looked at. When the same refs are resolved
+    again a few seconds later, as when building several systems from one
+    definitions commit, that network traffic is wasted.
+
+    This table maps (repo, ref) to the commit and tree it resolved to, and
+    when that was. Entries younger than `ttl` seconds are used instead of
+    going to the network; a `ttl` of 0 disables the cache. Refs in the
+    repos listed in `refresh` are always resolved again. Refs that are
+    SHA1s are never stored, since resolving them does not need an update,
+    and neither are refs under any of `volatile_prefixes`, such as the
+    temporary build branches that `morph build` rewrites every time.
+
+    The table is kept in a JSON file, which is only written by save().
+
+    '''
+
+    def __init__(self, filename, ttl, refresh=(), volatile_prefixes=(),
+                 now=time.time):
+        self.filename = filename
+        self.ttl = ttl
+        self.refresh = set(refresh)
+        self.volatile_prefixes = tuple(prefix.strip('/') + '/'
+                                       for prefix in volatile_prefixes)
+        self._now = now
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    def _enabled(self, reponame, ref):
+        return (self.ttl > 0 and
+                reponame not in self.refresh and
+                not morphlib.git.is_valid_sha1(ref) and
+                not self._is_volatile(ref))
+
+    def _is_volatile(self, ref):
+        if ref.startswith('refs/heads/'):
+            ref = ref[len('refs/heads/'):]
+        return ref.startswith(self.volatile_prefixes)
+
+    def _is_fresh(self, entry):
+        age = self._now() - entry[2]
+        return 0 <= age < self.ttl
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            return dict(((reponame, ref), tuple(entry))
+                        for reponame, refs in data.iteritems()
+                        for ref, entry in refs.iteritems())
+        except IOError:
+            return {}
+        except (ValueError, TypeError, AttributeError), e:
+            logging.warning('Ignoring unreadable ref cache %s: %s' %
+                            (self.filename, e))
+            return {}
+
+    def _get_entries(self):
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def get(self, reponame, ref):
+        '''Return the (commit, tree) that ref resolved to recently, or None.'''
+
+        if not self._enabled(reponame, ref):
+            return None
+        with self._lock:
+            entry = self._get_entries().get((reponame, ref))
+        if entry is None or not self._is_fresh(entry):
+            return None
+        return entry[0], entry[1]
+
+    def put(self, reponame, ref, commit, tree):
+        '''Remember that ref resolved to commit and tree just now.'''
+
+        if not self._enabled(reponame, ref):
+            return
+        with self._lock:
+            self._get_entries()[reponame, ref] = (commit, tree, self._now())
+            self._dirty = True
+
+    def save(self):
+        '''Write the table to disk, if anything was added to it.
+
+        Other processes may have saved entries since the table was read,
+        so the newest entry for each ref is kept. Expired entries are
+        dropped.
+
+        '''
+
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = self._load()
+            for key, entry in self._entries.iteritems():
+                if key not in entries or entries[key][2] < entry[2]:
+                    entries[key] = entry
+            self._entries = entries
+            self._dirty = False
+
+            data = {}
+            for (reponame, ref), entry in entries.iteritems():
+                if self._is_fresh(entry):
+                    data.setdefault(reponame, {})[ref] = list(entry)
+            dirname = os.path.dirname(self.filename)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with morphlib.savefile.SaveFile(self.filename, 'w') as f:
+                json.dump(data, f, indent=4, sort_keys=True)
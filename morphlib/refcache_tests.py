@@ -0,0 +1,131 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class RefCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache', 'refs.json')
+        self.time = 1000.0
+        self.commit = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        self.tree = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self, ttl=60, **kwargs):
+        return morphlib.refcache.RefCache(self.filename, ttl,
+                                          now=lambda: self.time, **kwargs)
+
+    def test_returns_none_when_not_cached(self):
+        cache = self.new_cache()
+        self.assertEqual(cache.get('repo', 'master'), None)
+
+    def test_returns_recently_resolved_ref(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        self.time += 59
+        self.assertEqual(cache.get('repo', 'master'),
+                         (self.commit, self.tree))
+
+    def test_expires_entries(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        self.time += 60
+        self.assertEqual(cache.get('repo', 'master'), None)
+
+    def test_ignores_entries_from_the_future(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        self.time -= 1
+        self.assertEqual(cache.get('repo', 'master'), None)
+
+    def test_zero_ttl_disables_cache(self):
+        cache = self.new_cache(ttl=0)
+        cache.put('repo', 'master', self.commit, self.tree)
+        self.assertEqual(cache.get('repo', 'master'), None)
+
+    def test_does_not_cache_sha1s(self):
+        cache = self.new_cache()
+        cache.put('repo', self.commit, self.commit, self.tree)
+        self.assertEqual(cache.get('repo', self.commit), None)
+
+    def test_does_not_cache_volatile_refs(self):
+        cache = self.new_cache(volatile_prefixes=['baserock/builds'])
+        for ref in ('baserock/builds/123/456',
+                    'refs/heads/baserock/builds/123/456'):
+            cache.put('repo', ref, self.commit, self.tree)
+            self.assertEqual(cache.get('repo', ref), None)
+        cache.put('repo', 'baserock/builds-old', self.commit, self.tree)
+        self.assertEqual(cache.get('repo', 'baserock/builds-old'),
+                         (self.commit, self.tree))
+
+    def test_refreshes_requested_repos(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        cache.save()
+        cache = self.new_cache(refresh=['repo'])
+        self.assertEqual(cache.get('repo', 'master'), None)
+        cache.put('other', 'master', self.commit, self.tree)
+        self.assertEqual(cache.get('other', 'master'),
+                         (self.commit, self.tree))
+
+    def test_persists_entries(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        cache.save()
+        self.assertEqual(self.new_cache().get('repo', 'master'),
+                         (self.commit, self.tree))
+
+    def test_does_not_persist_without_save(self):
+        cache = self.new_cache()
+        cache.put('repo', 'master', self.commit, self.tree)
+        self.assertEqual(self.new_cache().get('repo', 'master'), None)
+
+    def test_save_merges_with_other_processes(self):
+        first = self.new_cache()
+        second = self.new_cache()
+        first.put('repo', 'master', self.commit, self.tree)
+        second.put('repo', 'other', self.commit, self.tree)
+        first.save()
+        second.save()
+        cache = self.new_cache()
+        self.assertNotEqual(cache.get('repo', 'master'), None)
+        self.assertNotEqual(cache.get('repo', 'other'), None)
+
+    def test_ignores_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('garbage')
+        cache = self.new_cache()
+        self.assertEqual(cache.get('repo', 'master'), None)
+        cache.put('repo', 'master', self.commit, self.tree)
+        cache.save()
+        self.assertEqual(self.new_cache().get('repo', 'master'),
+                         (self.commit, self.tree))
+
+    def test_save_without_changes_writes_nothing(self):
+        cache = self.new_cache()
+        cache.save()
+        self.assertFalse(os.path.exists(self.filename))
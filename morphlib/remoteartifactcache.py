@@ -15,11 +15,14 @@
 
 
 import cliapp
+import json
 import logging
 import urllib
 import urllib2
 import urlparse
 
+import morphlib
+
 
 class HeadRequest(urllib2.Request):  # pragma: no cover
 
@@ -27,6 +30,13 @@ class HeadRequest(urllib2.Request):  # pragma: no cover
         return 'HEAD'
 
 
+class UnreachableError(cliapp.AppException):
+
+    def __init__(self, cache, reason):
+        cliapp.AppException.__init__(
+            self, 'Cannot reach the artifact cache %s: %s' % (cache, reason))
+
+
 class GetError(cliapp.AppException):
 
     def __init__(self, cache, artifact):
@@ -56,8 +66,10 @@ class GetSourceMetadataError(GetError):
 
 class RemoteArtifactCache(object):
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, max_downloads=4):
         self.server_url = server_url
+        self.downloader = morphlib.downloadmanager.DownloadManager(
+            max_workers=max_downloads)
 
     def has(self, artifact):
         return self._has_file(artifact.basename())
@@ -69,6 +81,20 @@ class RemoteArtifactCache(object):
         filename = '%s.%s' % (cachekey, name)
         return self._has_file(filename)
 
+    def has_many(self, artifacts):
+        '''Return a dict saying whether the cache has each artifact.
+
+        The server is asked about all the artifacts in one request. If
+        that request fails, UnreachableError is raised.
+
+        '''
+
+        artifacts = list(artifacts)
+        if not artifacts:
+            return {}
+        present = self._has_files([a.basename() for a in artifacts])
+        return dict((a, bool(present.get(a.basename()))) for a in artifacts)
+
     def get(self, artifact, log=logging.error):
         try:
             return self._get_file(artifact.basename())
@@ -90,6 +116,47 @@ class RemoteArtifactCache(object):
         except urllib2.URLError:
             raise GetSourceMetadataError(self, source, cachekey, name)
 
+    def copy_to(self, lac, groups, log=logging.error, limit=None):
+        '''Download artifacts and their metadata into a local cache.
+
+        `groups` is a list of lists of (artifact, name) pairs, where `name`
+        is None for the artifact itself, or the name of its metadata. The
+        files are downloaded several at once, and each group is saved into
+        `lac` as a whole, or not at all.
+
+        Returns the number of bytes downloaded. If any group could not be
+        fetched, GetError or GetArtifactMetadataError is raised for the
+        first of them, once the other downloads are finished.
+
+        '''
+
+        def job(artifact, name):
+            if name is None:
+                return (self._request_url(artifact.basename()),
+                        lambda: lac.put(artifact))
+            return (self._request_url(artifact.metadata_basename(name)),
+                    lambda: lac.put_artifact_metadata(artifact, name))
+
+        jobs = [[job(artifact, name) for artifact, name in group]
+                for group in groups]
+        errors, size = self.downloader.fetch(jobs, limit=limit)
+
+        failed = []
+        for group, group_jobs, error in zip(groups, jobs, errors):
+            if error is None:
+                continue
+            log(str(error))
+            # Blame the file that failed, if it is known.
+            urls = [url for url, open_target in group_jobs]
+            url = getattr(error, 'url', None)
+            failed.append(group[urls.index(url)] if url in urls else group[0])
+        if failed:
+            artifact, name = failed[0]
+            if name is None:
+                raise GetError(self, artifact)
+            raise GetArtifactMetadataError(self, artifact, name)
+        return size
+
     def _has_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
@@ -100,6 +167,17 @@ class RemoteArtifactCache(object):
         except (urllib2.HTTPError, urllib2.URLError):
             return False
 
+    def _has_files(self, filenames):  # pragma: no cover
+        url = urlparse.urljoin(self.server_url, '/1.0/artifacts')
+        logging.debug('RemoteArtifactCache._has_files: %d files' %
+                      len(filenames))
+        request = urllib2.Request(url, json.dumps(filenames),
+                                  {'Content-Type': 'application/json'})
+        try:
+            return json.load(urllib2.urlopen(request))
+        except (urllib2.URLError, ValueError), e:
+            raise UnreachableError(self, e)
+
     def _get_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
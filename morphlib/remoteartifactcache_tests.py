@@ -68,11 +68,17 @@ class RemoteArtifactCacheTests(unittest.TestCase):
         self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(
             self.server_url)
         self.cache._has_file = self._has_file
+        self.cache._has_files = self._has_files
         self.cache._get_file = self._get_file
+        self.requested = []
 
     def _has_file(self, filename):
         return filename in self.existing_files
 
+    def _has_files(self, filenames):
+        self.requested.append(filenames)
+        return dict((f, f in self.existing_files) for f in filenames)
+
     def _get_file(self, filename):
         if filename in self.existing_files:
             return StringIO.StringIO('%s' % filename)
@@ -91,6 +97,32 @@ class RemoteArtifactCacheTests(unittest.TestCase):
     def test_does_not_have_a_non_existent_artifact(self):
         self.assertFalse(self.cache.has(self.doc_artifact))
 
+    def test_has_many_artifacts_in_one_request(self):
+        artifacts = [self.runtime_artifact, self.devel_artifact,
+                     self.doc_artifact]
+        self.assertEqual(self.cache.has_many(artifacts), {
+            self.runtime_artifact: True,
+            self.devel_artifact: True,
+            self.doc_artifact: False,
+        })
+        self.assertEqual(len(self.requested), 1)
+
+    def test_has_many_makes_no_request_for_no_artifacts(self):
+        self.assertEqual(self.cache.has_many([]), {})
+        self.assertEqual(self.requested, [])
+
+    def test_has_many_raises_unreachable_error_once(self):
+        def fail(filenames):
+            self.requested.append(filenames)
+            raise morphlib.remoteartifactcache.UnreachableError(
+                self.cache, 'connection refused')
+        self.cache._has_files = fail
+        self.cache._has_file = lambda filename: self.fail('HEAD request')
+        self.assertRaises(
+            morphlib.remoteartifactcache.UnreachableError,
+            self.cache.has_many, [self.runtime_artifact, self.doc_artifact])
+        self.assertEqual(len(self.requested), 1)
+
     def test_has_existing_artifact_metadata(self):
         self.assertTrue(self.cache.has_artifact_metadata(
             self.runtime_artifact, 'meta'))
@@ -158,6 +190,56 @@ class RemoteArtifactCacheTests(unittest.TestCase):
             self.runtime_artifact.cache_key,
             'non-existent-meta')
 
+    def test_copies_groups_of_files_to_local_cache(self):
+        fetched = []
+
+        def fetch(groups, limit=None):
+            fetched.extend([url for url, open_target in group]
+                           for group in groups)
+            return [None] * len(groups), 10
+
+        self.cache.downloader.fetch = fetch
+        size = self.cache.copy_to(
+            None, [[(self.runtime_artifact, None),
+                    (self.runtime_artifact, 'meta')],
+                   [(self.devel_artifact, None)]])
+        self.assertEqual(size, 10)
+        self.assertEqual(fetched, [
+            [self.cache._request_url(self.runtime_artifact.basename()),
+             self.cache._request_url(
+                self.runtime_artifact.metadata_basename('meta'))],
+            [self.cache._request_url(self.devel_artifact.basename())],
+        ])
+
+    def test_copy_to_blames_file_that_failed(self):
+        url = self.cache._request_url(
+            self.runtime_artifact.metadata_basename('meta'))
+
+        def fetch(groups, limit=None):
+            error = morphlib.downloadmanager.DownloadError(url, '404')
+            return [error], 0
+
+        self.cache.downloader.fetch = fetch
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            self.cache.copy_to, None,
+            [[(self.runtime_artifact, None),
+              (self.runtime_artifact, 'meta')]],
+            log=lambda *args: None)
+
+    def test_copy_to_blames_first_file_if_failure_is_unknown(self):
+        def fetch(groups, limit=None):
+            error = morphlib.downloadmanager.DownloadError('other', '404')
+            return [error], 0
+
+        self.cache.downloader.fetch = fetch
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetError,
+            self.cache.copy_to, None,
+            [[(self.runtime_artifact, None),
+              (self.runtime_artifact, 'meta')]],
+            log=lambda *args: None)
+
     def test_escapes_pluses_in_request_urls(self):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
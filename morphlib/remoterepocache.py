@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
 import json
 import logging
@@ -45,6 +46,14 @@ class LsTreeError(cliapp.AppException):
             (ref, repo_name))
 
 
+class BatchRequestError(cliapp.AppException):
+
+    def __init__(self, what, count):
+        cliapp.AppException.__init__(
+            self, 'Failed to request %d %s from the remote repo cache' %
+            (count, what))
+
+
 class RemoteRepoCache(object):
 
     def __init__(self, server_url, resolver):
@@ -59,6 +68,38 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise ResolveRefError(repo_name, ref)
 
+    def resolve_refs_many(self, pairs):
+        '''Resolve many (repo_name, ref) pairs with a single request.
+
+        Returns a dict mapping each pair that the server could resolve to
+        a (commit sha1, tree sha1) tuple. Pairs it could not resolve are
+        left out, so the caller can decide how to deal with them.
+
+        '''
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        request = [{'repo': self._resolver.pull_url(repo_name), 'ref': ref}
+                   for repo_name, ref in pairs]
+        try:
+            results = json.loads(self._resolve_refs_for_repo_urls(request))
+        except BaseException, e:
+            logging.error('Caught exception: %s' % str(e))
+            raise BatchRequestError('refs', len(pairs))
+
+        resolved = {}
+        for pair, wanted, result in zip(pairs, request, results):
+            if (result.get('repo') != wanted['repo'] or
+                    result.get('ref') != wanted['ref']):
+                logging.warning('Unexpected result %r for %r' %
+                                (result, wanted))
+            elif 'error' in result:
+                logging.debug('Failed to resolve %s %s: %s' %
+                              (pair[0], pair[1], result['error']))
+            else:
+                resolved[pair] = (result['sha1'], result['tree'])
+        return resolved
+
     def cat_file(self, repo_name, ref, filename):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -69,6 +110,41 @@ class RemoteRepoCache(object):
                 raise CatFileError(repo_name, ref, filename)
             raise # pragma: no cover
 
+    def cat_files_many(self, triples):
+        '''Read many (repo_name, ref, filename) triples with one request.
+
+        Returns a dict mapping each triple that the server could read to
+        the contents of the file. Files that it could not read are left
+        out.
+
+        '''
+        triples = list(triples)
+        if not triples:
+            return {}
+        request = [{'repo': self._resolver.pull_url(repo_name), 'ref': ref,
+                    'filename': filename}
+                   for repo_name, ref, filename in triples]
+        try:
+            results = json.loads(self._cat_files_for_repo_urls(request))
+        except BaseException, e:
+            logging.error('Caught exception: %s' % str(e))
+            raise BatchRequestError('files', len(triples))
+
+        contents = {}
+        for triple, wanted, result in zip(triples, request, results):
+            if (result.get('repo') != wanted['repo'] or
+                    result.get('ref') != wanted['ref'] or
+                    result.get('filename') != wanted['filename']):
+                logging.warning('Unexpected result %r for %r' %
+                                (result, wanted))
+            elif 'error' in result:
+                logging.debug('Failed to cat %s in %s %s: %s' %
+                              (triple[2], triple[0], triple[1],
+                               result['error']))
+            else:
+                contents[triple] = base64.b64decode(result['data'])
+        return contents
+
     def ls_tree(self, repo_name, ref):
         repo_url = self._resolver.pull_url(repo_name)
         try:
@@ -84,6 +160,12 @@ class RemoteRepoCache(object):
         info = json.loads(data)
         return info['sha1'], info['tree']
 
+    def _resolve_refs_for_repo_urls(self, request):  # pragma: no cover
+        return self._make_post_request('sha1s', request)
+
+    def _cat_files_for_repo_urls(self, request):  # pragma: no cover
+        return self._make_post_request('files', request)
+
     def _cat_file_for_repo_url(self, repo_url, ref,
                                filename):  # pragma: no cover
         return self._make_request(
@@ -97,10 +179,18 @@ class RemoteRepoCache(object):
     def _quote_strings(self, *args):  # pragma: no cover
         return tuple(urllib.quote(string) for string in args)
 
-    def _make_request(self, path):  # pragma: no cover
+    def _request_url(self, path):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
-        url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
+        return urlparse.urljoin(server_url, '/1.0/%s' % path)
+
+    def _make_request(self, path):  # pragma: no cover
+        handle = urllib2.urlopen(self._request_url(path))
+        return handle.read()
+
+    def _make_post_request(self, path, data):  # pragma: no cover
+        request = urllib2.Request(self._request_url(path), json.dumps(data),
+                                  {'Content-Type': 'application/json'})
+        handle = urllib2.urlopen(request)
         return handle.read()
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -33,6 +34,27 @@ class RemoteRepoCacheTests(unittest.TestCase):
             raise urllib2.HTTPError(url='', code=404, msg='Not found',
                                     hdrs={}, fp=None)
 
+    def _resolve_refs_for_repo_urls(self, request):
+        result = []
+        for item in request:
+            try:
+                sha1 = self.sha1s[item['repo']][item['ref']]
+                result.append(dict(item, sha1=sha1, tree='tree-' + sha1))
+            except KeyError:
+                result.append(dict(item, error='not found'))
+        return json.dumps(result)
+
+    def _cat_files_for_repo_urls(self, request):
+        result = []
+        for item in request:
+            try:
+                content = self.files[item['repo']][item['ref']][
+                    item['filename']]
+                result.append(dict(item, data=base64.b64encode(content)))
+            except KeyError:
+                result.append(dict(item, error='not found'))
+        return json.dumps(result)
+
     def _ls_tree_for_repo_url(self, repo_url, sha1):
         return json.dumps({
             'repo': repo_url,
@@ -64,6 +86,9 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
 
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
@@ -89,6 +114,71 @@ class RemoteRepoCacheTests(unittest.TestCase):
                           self.cache.resolve_ref, 'non-existent-repo',
                           'non-existent-ref')
 
+    def test_resolve_refs_many_returns_resolved_pairs(self):
+        sha1 = self.sha1s['git://gitorious.org/baserock/morph']['master']
+        resolved = self.cache.resolve_refs_many(
+            [('baserock:morph', 'master'),
+             ('baserock:morph', 'non-existent-ref'),
+             ('non-existent-repo', 'master')])
+        self.assertEqual(resolved, {
+            ('baserock:morph', 'master'): (sha1, 'tree-' + sha1),
+        })
+
+    def test_resolve_refs_many_ignores_mismatched_results(self):
+        def mismatched(request):
+            return json.dumps([dict(item, ref='other', sha1='x', tree='y')
+                               for item in request])
+        self.cache._resolve_refs_for_repo_urls = mismatched
+        self.assertEqual(
+            self.cache.resolve_refs_many([('baserock:morph', 'master')]), {})
+
+    def test_resolve_refs_many_without_pairs_makes_no_request(self):
+        def fail(request):
+            raise AssertionError('request made')
+        self.cache._resolve_refs_for_repo_urls = fail
+        self.assertEqual(self.cache.resolve_refs_many([]), {})
+
+    def test_fail_resolve_refs_many_when_request_fails(self):
+        def fail(request):
+            raise urllib2.URLError('connection refused')
+        self.cache._resolve_refs_for_repo_urls = fail
+        self.assertRaises(morphlib.remoterepocache.BatchRequestError,
+                          self.cache.resolve_refs_many,
+                          [('baserock:morph', 'master')])
+
+    def test_cat_files_many_returns_existing_files(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        contents = self.cache.cat_files_many(
+            [('upstream:linux', sha1, 'linux.morph'),
+             ('upstream:linux', sha1, 'non-existent-file'),
+             ('non-existent-repo', sha1, 'linux.morph')])
+        self.assertEqual(contents, {
+            ('upstream:linux', sha1, 'linux.morph'): 'linux morphology',
+        })
+
+    def test_cat_files_many_without_triples_makes_no_request(self):
+        def fail(request):
+            raise AssertionError('request made')
+        self.cache._cat_files_for_repo_urls = fail
+        self.assertEqual(self.cache.cat_files_many([]), {})
+
+    def test_cat_files_many_ignores_mismatched_results(self):
+        def mismatched(request):
+            return json.dumps([dict(item, filename='other', data='')
+                               for item in request])
+        self.cache._cat_files_for_repo_urls = mismatched
+        self.assertEqual(
+            self.cache.cat_files_many(
+                [('upstream:linux', 'master', 'linux.morph')]), {})
+
+    def test_fail_cat_files_many_when_request_fails(self):
+        def fail(request):
+            raise urllib2.URLError('connection refused')
+        self.cache._cat_files_for_repo_urls = fail
+        self.assertRaises(morphlib.remoterepocache.BatchRequestError,
+                          self.cache.cat_files_many,
+                          [('upstream:linux', 'master', 'linux.morph')])
+
     def test_cat_existing_file_in_existing_repo_and_ref(self):
         content = self.cache.cat_file(
             'upstream:linux', 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9',
@@ -17,6 +17,14 @@
 import morphlib
 
 
+def _intern(value):
+    # Only plain strings can be interned; names read from JSON or YAML may
+    # be unicode.
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
 class Source(object):
 
     '''Represent the source to be built.
@@ -32,28 +40,42 @@ class Source(object):
     * ``filename`` -- basename of the morphology filename
     * ``cache_id`` -- a dict describing the components of the cache key
     * ``cache_key`` -- a cache key to uniquely identify the artifact
-    * ``dependencies`` -- list of Artifacts that need to be built beforehand
+    * ``dependencies`` -- OrderedSet of Artifacts that need to be built
+      beforehand
     * ``split_rules`` -- rules for splitting the source's produced artifacts
     * ``artifacts`` -- the set of artifacts this source produces.
+    * ``arch`` -- the architecture this source is built for, or None if
+      the source pool only has sources for one architecture
+
+    A build graph has a Source for every chunk and stratum of a system, so
+    attributes are kept in slots rather than a dict, and the names and refs
+    that many sources share are interned. Attributes that other parts of
+    Morph attach go in a dict, which is only created when it is needed.
 
     '''
 
+    __slots__ = ('name', 'repo', 'repo_name', 'original_ref', 'sha1', 'tree',
+                 'morphology', 'filename', 'cache_id', 'cache_key',
+                 'dependencies', 'split_rules', 'artifacts', 'arch',
+                 'build_mode', 'prefix', '__dict__')
+
     def __init__(self, name, repo_name, original_ref, sha1, tree, morphology,
-            filename, split_rules):
-        self.name = name
+            filename, split_rules, arch=None):
+        self.name = _intern(name)
         self.repo = None
-        self.repo_name = repo_name
-        self.original_ref = original_ref
-        self.sha1 = sha1
-        self.tree = tree
+        self.repo_name = _intern(repo_name)
+        self.original_ref = _intern(original_ref)
+        self.sha1 = _intern(sha1)
+        self.tree = _intern(tree)
         self.morphology = morphology
-        self.filename = filename
+        self.filename = _intern(filename)
         self.cache_id = None
         self.cache_key = None
-        self.dependencies = []
+        self.dependencies = morphlib.orderedset.OrderedSet()
 
         self.split_rules = split_rules
         self.artifacts = None
+        self.arch = arch
 
     def __str__(self):  # pragma: no cover
         return '%s|%s|%s|%s' % (self.repo_name,
@@ -68,17 +90,16 @@ class Source(object):
         return '%s.%s' % (self.cache_key, str(self.morphology['kind']))
 
     def add_dependency(self, artifact): # pragma: no cover
-        if artifact not in self.dependencies:
-            self.dependencies.append(artifact)
-        if self not in artifact.dependents:
-            artifact.dependents.append(self)
+        self.dependencies.add(artifact)
+        artifact.dependents.add(self)
 
     def depends_on(self, artifact): # pragma: no cover
         '''Do we depend on ``artifact``?'''
         return artifact in self.dependencies
 
 
-def make_sources(reponame, ref, filename, absref, tree, morphology):
+def make_sources(reponame, ref, filename, absref, tree, morphology,
+                 arch=None):
     kind = morphology['kind']
     if kind in ('system', 'chunk'):
         unifier = getattr(morphlib.artifactsplitrule,
@@ -88,7 +109,7 @@ def make_sources(reponame, ref, filename, absref, tree, morphology):
         source_name = morphology['name']
         source = morphlib.source.Source(source_name, reponame, ref,
                                         absref, tree, morphology,
-                                        filename, split_rules)
+                                        filename, split_rules, arch)
         source.artifacts = {name: morphlib.artifact.Artifact(source, name)
                      for name in split_rules.artifacts}
         yield source
@@ -102,7 +123,7 @@ def make_sources(reponame, ref, filename, absref, tree, morphology):
                 # stratum sources need to match the unified
                 # split rules, so they know to yield the match
                 # to a different source
-                split_rules)
+                split_rules, arch)
             source.artifacts = {name: morphlib.artifact.Artifact(source, name)}
             yield source
     else:
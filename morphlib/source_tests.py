@@ -57,3 +57,18 @@ class SourceTests(unittest.TestCase):
 
     def test_sets_filename(self):
         self.assertEqual(self.source.filename, self.filename)
+
+    def test_interns_plain_strings(self):
+        sha1 = ''.join(['CAFE', 'F00D'])
+        source, = morphlib.source.make_sources(self.repo_name,
+                                               self.original_ref,
+                                               self.filename, sha1,
+                                               self.tree, self.morphology)
+        self.assertTrue(source.sha1 is intern('CAFEF00D'))
+
+    def test_keeps_unicode_strings(self):
+        source, = morphlib.source.make_sources(u'foo.repo', u'original/ref',
+                                               self.filename, self.sha1,
+                                               self.tree, self.morphology)
+        self.assertEqual(source.repo_name, u'foo.repo')
+        self.assertEqual(type(source.original_ref), unicode)
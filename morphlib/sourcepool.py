@@ -19,32 +19,38 @@ import collections
 
 class SourcePool(object):
 
-    '''Manage a collection of Source objects.'''
+    '''Manage a collection of Source objects.
+
+    The same morphology may be built for several architectures, in which
+    case there is a Source for each, told apart by its `arch`.
+
+    '''
 
     def __init__(self):
         self._sources = collections.defaultdict(dict)
         self._order = []
 
-    def _key(self, repo_name, original_ref, filename):
-        return (repo_name, original_ref, filename)
+    def _key(self, repo_name, original_ref, filename, arch):
+        return (repo_name, original_ref, filename, arch)
 
     def add(self, source):
         '''Add a source to the pool.'''
         key = self._key(source.repo_name,
                         source.original_ref,
-                        source.filename)
+                        source.filename,
+                        source.arch)
         if key not in self._sources or source.name not in self._sources[key]:
             self._sources[key][source.name] = source
             self._order.append(source)
 
-    def lookup(self, repo_name, original_ref, filename):
+    def lookup(self, repo_name, original_ref, filename, arch=None):
         '''Find a source in the pool.
 
         Raise KeyError if it is not found.
 
         '''
 
-        key = self._key(repo_name, original_ref, filename)
+        key = self._key(repo_name, original_ref, filename, arch)
         return self._sources[key].values()
 
     def __iter__(self):
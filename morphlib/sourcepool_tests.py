@@ -30,6 +30,7 @@ class DummySource(object):
         self.morphology = {}
         self.dependencies = []
         self.dependents = []
+        self.arch = None
 
 
 class SourcePoolTests(unittest.TestCase):
@@ -61,3 +62,14 @@ class SourcePoolTests(unittest.TestCase):
             self.pool.add(source)
             sources.append(source)
         self.assertEqual(list(self.pool), sources)
+
+    def test_looks_up_source_by_arch(self):
+        other = DummySource()
+        other.arch = 'armv7lhf'
+        self.source.arch = 'x86_64'
+        self.pool.add(self.source)
+        self.pool.add(other)
+        result = self.pool.lookup(self.source.repo_name,
+                                  self.source.original_ref,
+                                  self.source.filename, 'armv7lhf')
+        self.assertEqual(result, [other])
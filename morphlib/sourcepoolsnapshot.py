@@ -0,0 +1,178 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import hashlib
+import logging
+import os
+
+import morphlib
+
+
+class SourcePoolSnapshot(object):
+
+    '''Remember what went into the last source pool built from a repo.
+
+    Most changes to a definitions repository touch a handful of files, but
+    creating a source pool loads every morphology in it and resolves every
+    chunk ref again. This keeps, for each definitions repository, the tree
+    the last source pool was created from, the object SHA1 of each of its
+    files, the morphologies loaded from them and the chunk refs that were
+    resolved.
+
+    When the next source pool is created, open() is given the new tree.
+    If it is the same tree, everything is reused. Otherwise the new tree
+    is listed, and only the morphologies whose files have a different
+    object SHA1 are loaded again. Chunk refs that are SHA1s always resolve
+    to the same commit and tree, so those are reused whatever the tree.
+
+    Snapshots are keyed by the version of Morph as well, like the parsed
+    morphology cache, and nothing is kept when that does not identify the
+    code.
+
+    '''
+
+    # Resolved SHA1 refs are kept from one snapshot to the next, so that
+    # going back to an older definitions commit is cheap too, but only up
+    # to this many of them.
+    max_refs = 10000
+
+    def __init__(self, cachedir, version=None):
+        self.cachedir = cachedir
+        self.version = version or morphlib.__version__
+        self._reset()
+
+    def _reset(self):
+        self.reponame = None
+        self.tree = None
+        self._file_sha1s = None
+        self._morphologies = {}
+        self._refs = {}
+        self._old = {'tree': None, 'files': {}, 'morphologies': {},
+                     'refs': {}}
+
+    def _enabled(self):
+        return not self.version.endswith('-unreproducible')
+
+    def _path(self, reponame):
+        key = '\0'.join((self.version, reponame))
+        return os.path.join(self.cachedir, hashlib.sha1(key).hexdigest())
+
+    def open(self, reponame, tree, list_file_sha1s):
+        '''Start using the snapshot of a definitions repository.
+
+        `tree` is the tree the new source pool is created from. If it is
+        not the tree of the snapshot, `list_file_sha1s` is called to get a
+        dict of the object SHA1 of each file in it. It may return None if
+        that cannot be done, in which case no morphologies are reused.
+
+        '''
+
+        self._reset()
+        if not self._enabled():
+            return
+        self.reponame = reponame
+        self.tree = tree
+        path = self._path(reponame)
+        try:
+            with open(path, 'rb') as f:
+                old = cPickle.load(f)
+            if sorted(old.keys()) != sorted(self._old.keys()):
+                raise ValueError('unexpected contents')
+            self._old = old
+        except IOError:
+            pass
+        except Exception, e:
+            logging.warning('Ignoring unreadable source pool snapshot %s: %s'
+                            % (path, e))
+
+        if self._old['tree'] == tree:
+            self._file_sha1s = self._old['files']
+        else:
+            self._file_sha1s = list_file_sha1s()
+
+    def get_morphology(self, filename):
+        '''Return the morphology of an unchanged file, or None.'''
+
+        if self._file_sha1s is None:
+            return None
+        sha1 = self._file_sha1s.get(filename)
+        if sha1 is None or self._old['files'].get(filename) != sha1:
+            return None
+        if filename not in self._old['morphologies']:
+            return None
+        data, morph_filename = self._old['morphologies'][filename]
+        morphology = morphlib.morphology.Morphology(data)
+        morphology.filename = morph_filename
+        self._morphologies[filename] = (data, morph_filename)
+        return morphology
+
+    def put_morphology(self, filename, morphology):
+        '''Remember the morphology loaded from a file of the new tree.'''
+
+        if self._file_sha1s is not None and filename in self._file_sha1s:
+            self._morphologies[filename] = (morphology.data,
+                                            morphology.filename)
+
+    def get_ref(self, reponame, ref):
+        '''Return the (commit, tree) a SHA1 ref resolved to, or None.'''
+
+        result = self._old['refs'].get((reponame, ref))
+        if result is not None:
+            self._refs[reponame, ref] = result
+        return result
+
+    def put_ref(self, reponame, ref, commit, tree):
+        '''Remember what a ref resolved to, if it can never change.'''
+
+        if morphlib.git.is_valid_sha1(ref):
+            self._refs[reponame, ref] = (commit, tree)
+
+    def save(self):
+        '''Store the snapshot for the tree given to open().
+
+        Morphologies of files that are unchanged in the new tree are kept
+        even if they were not used this time, since another system in the
+        same repository may need them. If the new tree could not be
+        listed, the old tree and its morphologies are kept instead.
+
+        '''
+
+        if self.reponame is None:
+            return
+        if self._file_sha1s is None:
+            tree, files = self._old['tree'], self._old['files']
+        else:
+            tree, files = self.tree, self._file_sha1s
+        morphologies = dict(
+            (filename, morph)
+            for filename, morph in self._old['morphologies'].iteritems()
+            if self._old['files'].get(filename) == files.get(filename))
+        morphologies.update(self._morphologies)
+        refs = dict(self._old['refs'])
+        refs.update(self._refs)
+        if len(refs) > self.max_refs:
+            refs = self._refs
+        snapshot = {
+            'tree': tree,
+            'files': files,
+            'morphologies': morphologies,
+            'refs': refs,
+        }
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+        with morphlib.savefile.SaveFile(self._path(self.reponame), 'wb') as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,168 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class SourcePoolSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'source-pools')
+        self.snapshot = morphlib.sourcepoolsnapshot.SourcePoolSnapshot(
+            self.cachedir, version='1')
+        self.files = {
+            'systems/foo.morph': '1' * 40,
+            'strata/bar.morph': '2' * 40,
+        }
+        self.listed = []
+        self.sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        self.tree = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def list_file_sha1s(self):
+        self.listed.append(True)
+        return dict(self.files)
+
+    def morphology(self, name):
+        morph = morphlib.morphology.Morphology({'name': name,
+                                                'kind': 'stratum'})
+        morph.filename = '%s.morph' % name
+        return morph
+
+    def take_snapshot(self, tree='tree1'):
+        self.snapshot.open('definitions', tree, self.list_file_sha1s)
+        self.snapshot.put_morphology('systems/foo.morph',
+                                     self.morphology('foo'))
+        self.snapshot.put_morphology('strata/bar.morph',
+                                     self.morphology('bar'))
+        self.snapshot.put_ref('repo', self.sha1, self.sha1, self.tree)
+        self.snapshot.put_ref('repo', 'master', self.sha1, self.tree)
+        self.snapshot.save()
+
+    def test_has_nothing_without_snapshot(self):
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(self.snapshot.get_morphology('strata/bar.morph'),
+                         None)
+        self.assertEqual(self.snapshot.get_ref('repo', self.sha1), None)
+
+    def test_reuses_everything_for_same_tree(self):
+        self.take_snapshot()
+        self.listed = []
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(self.listed, [])
+        morph = self.snapshot.get_morphology('strata/bar.morph')
+        self.assertEqual(morph['name'], 'bar')
+        self.assertEqual(morph.filename, 'bar.morph')
+
+    def test_reloads_only_changed_files(self):
+        self.take_snapshot()
+        self.files['strata/bar.morph'] = '3' * 40
+        self.snapshot.open('definitions', 'tree2', self.list_file_sha1s)
+        self.assertEqual(self.listed, [True, True])
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph')['name'], 'foo')
+        self.assertEqual(self.snapshot.get_morphology('strata/bar.morph'),
+                         None)
+
+    def test_reuses_nothing_if_tree_cannot_be_listed(self):
+        self.take_snapshot()
+        self.snapshot.open('definitions', 'tree2', lambda: None)
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph'), None)
+        self.snapshot.save()
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph')['name'], 'foo')
+
+    def test_reuses_only_sha1_refs(self):
+        self.take_snapshot()
+        self.snapshot.open('definitions', 'tree2', self.list_file_sha1s)
+        self.assertEqual(self.snapshot.get_ref('repo', self.sha1),
+                         (self.sha1, self.tree))
+        self.assertEqual(self.snapshot.get_ref('repo', 'master'), None)
+
+    def test_keeps_unused_morphologies_of_unchanged_files(self):
+        self.take_snapshot()
+        self.snapshot.open('definitions', 'tree2', self.list_file_sha1s)
+        self.snapshot.save()
+        self.snapshot.open('definitions', 'tree2', self.list_file_sha1s)
+        self.assertNotEqual(
+            self.snapshot.get_morphology('strata/bar.morph'), None)
+
+    def test_keys_on_repo_and_version(self):
+        self.take_snapshot()
+        self.snapshot.open('other', 'tree1', self.list_file_sha1s)
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph'), None)
+        snapshot = morphlib.sourcepoolsnapshot.SourcePoolSnapshot(
+            self.cachedir, version='2')
+        snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(snapshot.get_morphology('systems/foo.morph'), None)
+
+    def test_does_nothing_for_unreproducible_version(self):
+        snapshot = morphlib.sourcepoolsnapshot.SourcePoolSnapshot(
+            self.cachedir, version='1-unreproducible')
+        snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        snapshot.put_morphology('systems/foo.morph', self.morphology('foo'))
+        snapshot.save()
+        self.assertFalse(os.path.exists(self.cachedir))
+
+    def test_ignores_corrupt_snapshot(self):
+        self.take_snapshot()
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), 'w') as f:
+                f.write('garbage')
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph'), None)
+
+    def test_ignores_snapshot_with_unexpected_contents(self):
+        self.take_snapshot()
+        for name in os.listdir(self.cachedir):
+            with open(os.path.join(self.cachedir, name), 'wb') as f:
+                cPickle.dump({'tree': 'tree1'}, f)
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(self.listed, [True, True])
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph'), None)
+
+    def test_has_no_morphology_for_file_not_loaded_before(self):
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.snapshot.save()
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(
+            self.snapshot.get_morphology('systems/foo.morph'), None)
+
+    def test_keeps_only_refs_of_last_pool_beyond_limit(self):
+        self.snapshot.max_refs = 1
+        self.take_snapshot()
+        other = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.snapshot.put_ref('repo', other, other, self.tree)
+        self.snapshot.save()
+        self.snapshot.open('definitions', 'tree1', self.list_file_sha1s)
+        self.assertEqual(self.snapshot.get_ref('repo', self.sha1), None)
+        self.assertEqual(self.snapshot.get_ref('repo', other),
+                         (other, self.tree))
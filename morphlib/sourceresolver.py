@@ -47,11 +47,16 @@ class SourceResolver(object):
     '''
 
     def __init__(self, local_repo_cache, remote_repo_cache, update_repos,
-                 status_cb=None):
+                 status_cb=None, resolve_jobs=1, morphology_cache=None,
+                 ref_cache=None, snapshot=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
+        self.morphology_cache = morphology_cache
+        self.ref_cache = ref_cache
+        self.snapshot = snapshot
 
         self.update = update_repos
+        self.resolve_jobs = resolve_jobs
 
         self.status = status_cb
 
@@ -59,20 +64,37 @@ class SourceResolver(object):
         '''Resolves commit and tree sha1s of the ref in a repo and returns it.
 
         If update is True then this has the side-effect of updating
-        or cloning the repository into the local repo cache.
+        or cloning the repository into the local repo cache, unless the ref
+        was resolved recently enough to be found in the ref cache.
         '''
+        result = self._get_recently_resolved(reponame, ref)
+        if result is None:
+            result = self._resolve_ref(reponame, ref)
+            self._put_recently_resolved(reponame, ref, result)
+        return result
+
+    def _get_recently_resolved(self, reponame, ref):
+        if self.ref_cache is None or not self.update:
+            return None
+        # The morphologies must still be readable from somewhere.
+        if self.rrc is None and not self.lrc.has_repo(reponame):
+            return None
+        result = self.ref_cache.get(reponame, ref)
+        if result is not None:
+            self.status(msg='Using recently resolved %(reponame)s %(ref)s',
+                        reponame=reponame, ref=ref, chatty=True)
+        return result
+
+    def _put_recently_resolved(self, reponame, ref, result):
+        if self.ref_cache is not None and self.update:
+            absref, tree = result
+            self.ref_cache.put(reponame, ref, absref, tree)
+
+    def _resolve_ref(self, reponame, ref):
         absref = None
 
         if self.lrc.has_repo(reponame):
-            repo = self.lrc.get_repo(reponame)
-            if self.update and repo.requires_update_for_ref(ref):
-                self.status(msg='Updating cached git repository %(reponame)s '
-                            'for ref %(ref)s', reponame=reponame, ref=ref)
-                repo.update()
-            # If the user passed --no-git-update, and the ref is a SHA1 not
-            # available locally, this call will raise an exception.
-            absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+            return self._resolve_ref_in_cached_repo(reponame, ref)
         elif self.rrc is not None:
             try:
                 absref, tree = self.rrc.resolve_ref(reponame, ref)
@@ -85,15 +107,90 @@ class SourceResolver(object):
             except BaseException, e:
                 logging.warning('Caught (and ignored) exception: %s' % str(e))
         if absref is None:
-            if self.update:
-                self.status(msg='Caching git repository %(reponame)s',
-                            reponame=reponame)
-                repo = self.lrc.cache_repo(reponame)
-                repo.update()
+            absref, tree = self._cache_repo_and_resolve_ref(reponame, ref)
+        return absref, tree
+
+    def resolve_refs(self, pairs):
+        '''Resolves many (repo, ref) pairs and returns a dict of results.
+
+        Pairs in repos that are not cached locally are sent to the remote
+        repo cache in a single request. Anything it cannot resolve is dealt
+        with as in resolve_ref(). Pairs found in the ref cache are not
+        resolved again.
+
+        Up to `resolve_jobs` repos are updated and resolved concurrently.
+        All the refs of one repo are resolved by the same worker, in order,
+        so each cached repo is only ever used by one thread at a time.
+        '''
+        resolved = {}
+        local = collections.OrderedDict()
+        remote = []
+        for pair in pairs:
+            if pair in resolved:
+                continue
+            reponame, ref = pair
+            resolved[pair] = self._get_recently_resolved(reponame, ref)
+            if resolved[pair] is not None:
+                continue
+            if self.rrc is None or self.lrc.has_repo(reponame):
+                local.setdefault(reponame, []).append(ref)
             else:
-                repo = self.lrc.get_repo(reponame)
-            absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+                remote.append(pair)
+
+        uncached = collections.OrderedDict()
+        if remote:
+            try:
+                remote_resolved = self.rrc.resolve_refs_many(remote)
+                resolved.update(remote_resolved)
+                for (reponame, ref), result in remote_resolved.iteritems():
+                    self._put_recently_resolved(reponame, ref, result)
+                self.status(msg='Resolved %(count)d refs via remote repo '
+                            'cache', count=len(remote_resolved), chatty=True)
+            except BaseException, e:
+                logging.warning('Caught (and ignored) exception: %s' % str(e))
+            for reponame, ref in remote:
+                if resolved[reponame, ref] is None:
+                    uncached.setdefault(reponame, []).append(ref)
+
+        tasks = ([(reponame, refs, self._resolve_ref)
+                  for reponame, refs in local.iteritems()] +
+                 [(reponame, refs, self._cache_repo_and_resolve_ref)
+                  for reponame, refs in uncached.iteritems()])
+
+        def resolve_task(task):
+            reponame, refs, resolve = task
+            return [((reponame, ref), resolve(reponame, ref))
+                    for ref in refs]
+
+        for results in morphlib.util.map_concurrently(
+                resolve_task, tasks, self.resolve_jobs):
+            for (reponame, ref), result in results:
+                self._put_recently_resolved(reponame, ref, result)
+            resolved.update(results)
+        return resolved
+
+    def _resolve_ref_in_cached_repo(self, reponame, ref):
+        repo = self.lrc.get_repo(reponame)
+        if self.update and repo.requires_update_for_ref(ref):
+            self.status(msg='Updating cached git repository %(reponame)s '
+                        'for ref %(ref)s', reponame=reponame, ref=ref)
+            repo.update()
+        # If the user passed --no-git-update, and the ref is a SHA1 not
+        # available locally, this call will raise an exception.
+        absref = repo.resolve_ref_to_commit(ref)
+        tree = repo.resolve_ref_to_tree(absref)
+        return absref, tree
+
+    def _cache_repo_and_resolve_ref(self, reponame, ref):
+        if self.update:
+            self.status(msg='Caching git repository %(reponame)s',
+                        reponame=reponame)
+            repo = self.lrc.cache_repo(reponame)
+            repo.update()
+        else:
+            repo = self.lrc.get_repo(reponame)
+        absref = repo.resolve_ref_to_commit(ref)
+        tree = repo.resolve_ref_to_tree(absref)
         return absref, tree
 
     def traverse_morphs(self, definitions_repo, definitions_ref,
@@ -101,15 +198,20 @@ class SourceResolver(object):
                         visit=lambda rn, rf, fn, arf, m: None,
                         definitions_original_ref=None):
         morph_factory = morphlib.morphologyfactory.MorphologyFactory(
-            self.lrc, self.rrc, self.status)
-        definitions_queue = collections.deque(system_filenames)
+            self.lrc, self.rrc, self.status, self.morphology_cache)
+        definitions_queue = list(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
 
-        resolved_commits = {}
-        resolved_trees = {}
         resolved_morphologies = {}
 
+        def get_morphologies(keys):
+            missing = [key for key in keys
+                       if key not in resolved_morphologies]
+            if missing:
+                resolved_morphologies.update(
+                    morph_factory.get_morphologies(missing))
+
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
         definitions_absref, definitions_tree = self.resolve_ref(
             definitions_repo, definitions_ref)
@@ -117,68 +219,111 @@ class SourceResolver(object):
         if definitions_original_ref:
             definitions_ref = definitions_original_ref
 
+        snapshot = self.snapshot
+        if snapshot is not None:
+            def list_definitions_file_sha1s():
+                if not self.lrc.has_repo(definitions_repo):
+                    return None
+                repo = self.lrc.get_repo(definitions_repo)
+                return repo.list_file_sha1s(definitions_absref)
+            snapshot.open(definitions_repo, definitions_tree,
+                          list_definitions_file_sha1s)
+
+        def get_definitions_morphologies(filenames):
+            # Morphologies of files that did not change since the snapshot
+            # was taken are not loaded again.
+            keys = []
+            for filename in filenames:
+                key = (definitions_repo, definitions_absref, filename)
+                keys.append(key)
+                if snapshot is not None and key not in resolved_morphologies:
+                    morphology = snapshot.get_morphology(filename)
+                    if morphology is not None:
+                        resolved_morphologies[key] = morphology
+            get_morphologies(keys)
+            if snapshot is not None:
+                for key in keys:
+                    snapshot.put_morphology(key[2], resolved_morphologies[key])
+
+        # The definitions are traversed breadth first, one level at a time,
+        # so that all the morphologies of a level can be fetched in one go.
         while definitions_queue:
-            filename = definitions_queue.popleft()
-
-            key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-
-            visit(definitions_repo, definitions_ref, filename,
-                  definitions_absref, definitions_tree, morphology)
-            if morphology['kind'] == 'cluster':
-                raise cliapp.AppException(
-                    "Cannot build a morphology of type 'cluster'.")
-            elif morphology['kind'] == 'system':
-                definitions_queue.extend(
-                    morphlib.util.sanitise_morphology_path(s['morph'])
-                    for s in morphology['strata'])
-            elif morphology['kind'] == 'stratum':
-                if morphology['build-depends']:
+            level = definitions_queue
+            definitions_queue = []
+            get_definitions_morphologies(level)
+
+            for filename in level:
+                key = (definitions_repo, definitions_absref, filename)
+                morphology = resolved_morphologies[key]
+
+                visit(definitions_repo, definitions_ref, filename,
+                      definitions_absref, definitions_tree, morphology)
+                if morphology['kind'] == 'cluster':
+                    raise cliapp.AppException(
+                        "Cannot build a morphology of type 'cluster'.")
+                elif morphology['kind'] == 'system':
                     definitions_queue.extend(
                         morphlib.util.sanitise_morphology_path(s['morph'])
-                        for s in morphology['build-depends'])
-                for c in morphology['chunks']:
-                    if 'morph' not in c:
-                        path = morphlib.util.sanitise_morphology_path(
-                            c.get('morph', c['name']))
-                        chunk_in_source_repo_queue.append(
-                            (c['repo'], c['ref'], path))
-                        continue
-                    chunk_in_definitions_repo_queue.append(
-                        (c['repo'], c['ref'], c['morph']))
-
+                        for s in morphology['strata'])
+                elif morphology['kind'] == 'stratum':
+                    if morphology['build-depends']:
+                        definitions_queue.extend(
+                            morphlib.util.sanitise_morphology_path(s['morph'])
+                            for s in morphology['build-depends'])
+                    for c in morphology['chunks']:
+                        if 'morph' not in c:
+                            path = morphlib.util.sanitise_morphology_path(
+                                c.get('morph', c['name']))
+                            chunk_in_source_repo_queue.append(
+                                (c['repo'], c['ref'], path))
+                            continue
+                        chunk_in_definitions_repo_queue.append(
+                            (c['repo'], c['ref'], c['morph']))
+
+        chunk_refs = [(repo, ref) for repo, ref, filename in
+                      chunk_in_definitions_repo_queue +
+                      chunk_in_source_repo_queue]
+        resolved_refs = {}
+        if snapshot is not None:
+            for repo, ref in chunk_refs:
+                result = snapshot.get_ref(repo, ref)
+                if result is not None:
+                    resolved_refs[repo, ref] = result
+        resolved_refs.update(self.resolve_refs(
+            pair for pair in chunk_refs if pair not in resolved_refs))
+        if snapshot is not None:
+            for (repo, ref), (absref, tree) in resolved_refs.iteritems():
+                snapshot.put_ref(repo, ref, absref, tree)
+
+        get_definitions_morphologies(
+            filename for repo, ref, filename
+            in chunk_in_definitions_repo_queue)
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved_refs[repo, ref]
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
+        get_morphologies((repo, resolved_refs[repo, ref][0], filename)
+                         for repo, ref, filename
+                         in chunk_in_source_repo_queue)
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved_refs[repo, ref]
             key = (repo, absref, filename)
-            if key not in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
             morphology = resolved_morphologies[key]
             visit(repo, ref, filename, absref, tree, morphology)
 
+        if self.ref_cache is not None:
+            self.ref_cache.save()
+        if snapshot is not None:
+            snapshot.save()
+
 
 def create_source_pool(lrc, rrc, repo, ref, filename,
                        original_ref=None, update_repos=True,
-                       status_cb=None):
+                       status_cb=None, resolve_jobs=1,
+                       morphology_cache=None, ref_cache=None,
+                       snapshot=None):
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -190,7 +335,12 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     implementation, and so they must be handled separately.
 
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
-    caches used for resolving the sources.
+    caches used for resolving the sources. Up to 'resolve_jobs' repositories
+    are updated and resolved at the same time. Parsed morphologies are
+    looked up in, and added to, 'morphology_cache' if it is given, and
+    recently resolved refs are reused from 'ref_cache' in the same way.
+    If a SourcePoolSnapshot is given as 'snapshot', only the parts of the
+    definitions that changed since it was taken are loaded and resolved.
 
     '''
     pool = morphlib.sourcepool.SourcePool()
@@ -202,8 +352,79 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
         for source in sources:
             pool.add(source)
 
-    resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              resolve_jobs, morphology_cache, ref_cache,
+                              snapshot)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
     return pool
+
+
+def create_multi_arch_source_pool(lrc, rrc, repo, ref, filenames,
+                                  original_ref=None, update_repos=True,
+                                  status_cb=None, resolve_jobs=1,
+                                  morphology_cache=None, ref_cache=None,
+                                  snapshot=None):
+    '''Find all the sources involved in building several systems.
+
+    This is like create_source_pool(), but the morphologies and refs of
+    strata and chunks that the systems share are only loaded and resolved
+    once. Each Source in the pool is made for the architecture of a system
+    that needs it, which is set as its `arch`, so the same stratum or chunk
+    has one Source per architecture it is built for.
+
+    '''
+    pool = morphlib.sourcepool.SourcePool()
+    visits = collections.OrderedDict()
+
+    def record_visit(reponame, ref, filename, absref, tree, morphology):
+        visits.setdefault((reponame, ref, filename),
+                          (absref, tree, morphology))
+
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              resolve_jobs, morphology_cache, ref_cache,
+                              snapshot)
+    resolver.traverse_morphs(repo, ref, filenames,
+                             visit=record_visit,
+                             definitions_original_ref=original_ref)
+
+    # Work out which architectures each morphology is needed for, by
+    # following the same references as ArtifactResolver does.
+    archs = collections.defaultdict(set)
+
+    def mark(key, arch):
+        if arch in archs[key]:
+            return
+        archs[key].add(arch)
+        reponame, ref, filename = key
+        morphology = visits[key][2]
+        if morphology['kind'] == 'system':
+            specs = morphology['strata']
+        elif morphology['kind'] == 'stratum':
+            specs = morphology['build-depends'] or []
+            for info in morphology['chunks']:
+                mark((info['repo'], info['ref'],
+                      morphlib.util.sanitise_morphology_path(
+                          info.get('morph', info['name']))),
+                     arch)
+        else:
+            specs = []
+        for info in specs:
+            mark((info.get('repo') or reponame,
+                  info.get('ref') or ref,
+                  morphlib.util.sanitise_morphology_path(info['morph'])),
+                 arch)
+
+    definitions_ref = original_ref or ref
+    for filename in filenames:
+        key = (repo, definitions_ref, filename)
+        mark(key, visits[key][2].get('arch'))
+
+    for key, (absref, tree, morphology) in visits.iteritems():
+        reponame, ref, filename = key
+        for arch in sorted(archs[key]):
+            for source in morphlib.source.make_sources(
+                    reponame, ref, filename, absref, tree, morphology, arch):
+                pool.add(source)
+    return pool
@@ -0,0 +1,86 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import json
+import os
+import tempfile
+
+import morphlib
+
+
+class SourceTreeCache(morphlib.directorycache.DirectoryCache):
+
+    '''Extracted source trees, to copy into staging areas.
+
+    Each tree is the work tree of a commit, with its submodules checked
+    out, and is found by the SHA1 of the commit's tree and the commits of
+    the submodules. The trees are kept without their .git directories,
+    which depend on the commit rather than the tree, so those must be set
+    up again after copying a tree out.
+
+    Trees are copied in and out with `cp --reflink=auto`, so that on
+    filesystems which support it the copies share their blocks until they
+    are changed. Elsewhere they are plain copies.
+
+    '''
+
+    @staticmethod
+    def key(tree, submodules):
+        '''Return the basename of a tree.
+
+        `tree` is the tree SHA1 of the commit, and `submodules` are (path,
+        commit) pairs for its submodules, and theirs.
+
+        '''
+
+        data = json.dumps([tree, sorted(submodules)])
+        return 'source.' + hashlib.sha1(data).hexdigest()
+
+    def add_tree(self, basename, srcdir, gitdirs, runcmd):
+        '''Add a copy of `srcdir` to the cache, without its .git directories.
+
+        `gitdirs` are the .git directories in `srcdir`, which are moved
+        aside while it is copied.
+
+        '''
+
+        def fill(savedir):
+            # Beside srcdir, as it may be on a filesystem of its own.
+            asidedir = tempfile.mkdtemp(
+                dir=os.path.dirname(os.path.abspath(srcdir)))
+            moved = []
+            try:
+                for gitdir in gitdirs:
+                    aside = os.path.join(asidedir, str(len(moved)))
+                    os.rename(gitdir, aside)
+                    moved.append((gitdir, aside))
+                self._copy(runcmd, srcdir, savedir)
+            finally:
+                for gitdir, aside in moved:
+                    os.rename(aside, gitdir)
+                os.rmdir(asidedir)
+
+        self.add(basename, fill)
+
+    def copy_tree(self, reference, destdir, runcmd):
+        '''Copy a tree, acquired from the cache, into `destdir`.'''
+
+        self._copy(runcmd, reference.path, destdir)
+
+    @staticmethod
+    def _copy(runcmd, srcdir, destdir):
+        runcmd(['cp', '-a', '--reflink=auto', srcdir + '/.', destdir])
@@ -0,0 +1,92 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import cliapp
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class SourceTreeCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'sources')
+        os.mkdir(self.cachedir)
+        self.cache = morphlib.sourcetreecache.SourceTreeCache(self.cachedir)
+
+        self.srcdir = os.path.join(self.tempdir, 'src')
+        for dirname in ('.git', 'sub', os.path.join('sub', '.git')):
+            os.makedirs(os.path.join(self.srcdir, dirname))
+        for filename in ('README', os.path.join('.git', 'HEAD'),
+                         os.path.join('sub', 'main.c'),
+                         os.path.join('sub', '.git', 'HEAD')):
+            with open(os.path.join(self.srcdir, filename), 'w') as f:
+                f.write(filename)
+        self.gitdirs = [os.path.join(self.srcdir, '.git'),
+                        os.path.join(self.srcdir, 'sub', '.git')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def list_tree(self, root):
+        files = []
+        for dirname, subdirs, basenames in os.walk(root):
+            for name in basenames:
+                files.append(os.path.relpath(os.path.join(dirname, name),
+                                             root))
+        return sorted(files)
+
+    def test_keys_depend_on_tree_and_submodules(self):
+        key = self.cache.key('a' * 40, [('sub', 'b' * 40)])
+        self.assertEqual(key, self.cache.key('a' * 40, [('sub', 'b' * 40)]))
+        self.assertNotEqual(key, self.cache.key('a' * 40, []))
+        self.assertNotEqual(key,
+                            self.cache.key('a' * 40, [('sub', 'c' * 40)]))
+        self.assertNotEqual(key,
+                            self.cache.key('d' * 40, [('sub', 'b' * 40)]))
+
+    def test_keeps_trees_without_git_directories(self):
+        self.cache.add_tree('source.x', self.srcdir, self.gitdirs,
+                            cliapp.runcmd)
+        reference = self.cache.acquire_existing('source.x')
+        try:
+            self.assertEqual(self.list_tree(reference.path),
+                             ['README', 'sub/main.c'])
+        finally:
+            reference.release()
+
+    def test_leaves_source_directory_as_it_was(self):
+        before = self.list_tree(self.srcdir)
+        self.cache.add_tree('source.x', self.srcdir, self.gitdirs,
+                            cliapp.runcmd)
+        self.assertEqual(self.list_tree(self.srcdir), before)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['sources', 'src'])
+
+    def test_copies_trees_out(self):
+        self.cache.add_tree('source.x', self.srcdir, self.gitdirs,
+                            cliapp.runcmd)
+        destdir = os.path.join(self.tempdir, 'dest')
+        os.mkdir(destdir)
+        reference = self.cache.acquire_existing('source.x')
+        try:
+            self.cache.copy_tree(reference, destdir, cliapp.runcmd)
+        finally:
+            reference.release()
+        self.assertEqual(self.list_tree(destdir), ['README', 'sub/main.c'])
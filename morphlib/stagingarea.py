@@ -14,17 +14,91 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import hashlib
+import json
 import logging
 import os
 import shutil
-import stat
+import tempfile
 import cliapp
 from urlparse import urlparse
-import tempfile
 
 import morphlib
 
 
+# Whether overlay filesystems with several lower layers can be mounted,
+# found out by overlayfs_supported() the first time it is needed.
+_overlayfs_supported = None
+
+# The kernel refuses to stack more lower layers than this.
+_max_overlay_layers = 500
+
+
+def overlayfs_supported(app):  # pragma: no cover
+    '''Return whether staging areas can be mounted with overlayfs.
+
+    This tries mounting an overlay filesystem in TEMPDIR/staging the first
+    time it is called, and remembers the result.
+
+    '''
+
+    global _overlayfs_supported
+    if _overlayfs_supported is None:
+        testdir = tempfile.mkdtemp(
+            dir=os.path.join(app.settings['tempdir'], 'staging'))
+        try:
+            for name in ('0', '1', 'upper', 'work', 'merged'):
+                os.mkdir(os.path.join(testdir, name))
+            try:
+                _mount_overlay(app.runcmd, ['0', '1'], 'upper', 'work',
+                               'merged', testdir)
+            except cliapp.AppException as e:
+                logging.warning('Cannot mount overlayfs, hardlinking '
+                                'staging areas instead: %s' % e)
+                _overlayfs_supported = False
+            else:
+                app.runcmd(['umount', os.path.join(testdir, 'merged')])
+                _overlayfs_supported = True
+        finally:
+            shutil.rmtree(testdir)
+    return _overlayfs_supported
+
+
+def _mount_overlay(runcmd, lowerdirs, upperdir, workdir, mountpoint,
+                   cwd):  # pragma: no cover
+    '''Mount an overlay filesystem, with the first of `lowerdirs` on top.
+
+    The directories may be given relative to `cwd`, which keeps the mount
+    options short: the kernel limits them to a page.
+
+    '''
+
+    options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+        ':'.join(lowerdirs), upperdir, workdir)
+    runcmd(['mount', '-t', 'overlay', 'overlay', '-o', options, mountpoint],
+           cwd=cwd)
+
+
+def overlay_conflicts(manifests):
+    '''Return the paths overlayfs would stage differently from hardlinking.
+
+    `manifests` are the LinkManifests of the chunks to stage. Hardlinking a
+    directory of one chunk where another has a symbolic link puts its
+    contents where the link points, but overlayfs shows either the link or
+    the directory, not both.
+
+    '''
+
+    manifests = list(manifests)
+    symlinks = set()
+    for manifest in manifests:
+        symlinks.update(path for path, target in manifest.symlinks)
+    conflicts = set()
+    for manifest in manifests:
+        conflicts.update(path for path in manifest.dirs if path in symlinks)
+    return sorted(conflicts)
+
+
 class StagingArea(object):
 
     '''Represent the staging area for building software.
@@ -46,6 +120,10 @@ class StagingArea(object):
         self.builddirname = None
         self.destdirname = None
         self._bind_readonly_mount = None
+        # Set while the staging area is an overlay mount, see
+        # install_artifacts().
+        self._overlay_dir = None
+        self._chunk_references = []
 
         self.use_chroot = use_chroot
         self.env = build_env.env
@@ -101,83 +179,182 @@ class StagingArea(object):
         assert filename.startswith(dirname)
         return filename[len(dirname) - 1:]  # include leading slash
 
-    def hardlink_all_files(self, srcpath, destpath): # pragma: no cover
-        '''Hardlink every file in the path to the staging-area
+    def install_artifact(self, handle):
+        '''Install a build artifact into the staging area.
 
-        If an exception is raised, the staging-area is indeterminate.
+        We access the artifact via an open file handle. For now, we assume
+        the artifact is a tarball.
 
         '''
 
-        file_stat = os.lstat(srcpath)
-        mode = file_stat.st_mode
-
-        if stat.S_ISDIR(mode):
-            # Ensure directory exists in destination, then recurse.
-            if not os.path.lexists(destpath):
-                os.makedirs(destpath)
-            dest_stat = os.stat(os.path.realpath(destpath))
-            if not stat.S_ISDIR(dest_stat.st_mode):
-                raise IOError('Destination not a directory. source has %s'
-                              ' destination has %s' % (srcpath, destpath))
-
-            for entry in os.listdir(srcpath):
-                self.hardlink_all_files(os.path.join(srcpath, entry),
-                                        os.path.join(destpath, entry))
-        elif stat.S_ISLNK(mode):
-            # Copy the symlink.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.symlink(os.readlink(srcpath), destpath)
-
-        elif stat.S_ISREG(mode):
-            # Hardlink the file.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.link(srcpath, destpath)
-
-        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-            # Block or character device. Put contents of st_dev in a mknod.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-            os.chmod(destpath, file_stat.st_mode)
+        chunk_cache = morphlib.util.new_unpacked_chunk_cache(
+            self._app.settings)
+        with chunk_cache.use(handle, status=self._app.status) as unpacked:
+            if not os.path.exists(self.dirname):
+                self._mkdir(self.dirname)
 
-        else:
-            # Unsupported type.
-            raise IOError('Cannot extract %s into staging-area. Unsupported'
-                          ' type.' % srcpath)
+            manifest = chunk_cache.manifest(os.path.basename(handle.name))
+            manifest.link(unpacked, self.dirname,
+                          self._app.settings['staging-link-jobs'])
 
-    def install_artifact(self, handle):
-        '''Install a build artifact into the staging area.
+    def install_artifacts(self, handles, ldconfig=False):
+        '''Install several chunk artifacts into the staging area, in order.
 
-        We access the artifact via an open file handle. For now, we assume
-        the artifact is a tarball.
+        If `ldconfig` is true, ldconfig is then run in the staging area.
+
+        With the staging-overlayfs setting, the chunks are unpacked and
+        stacked as the read-only lower layers of an overlay filesystem
+        mounted on the staging area, with the writes of the build going to
+        a directory of its own. Neither this nor remove() then takes time
+        in proportion to the number of files in the chunks.
+
+        Otherwise, or if the kernel cannot mount overlayfs, or the chunks
+        would be staged differently that way, their files are hardlinked
+        into the staging area, as by install_artifact().
+
+        The result is kept as a template for the next staging area with
+        the same chunks, unless the staging-templates setting is 0. With
+        overlayfs, only what ldconfig wrote needs keeping, as a layer over
+        the chunks. Templates are kept with the unpacked chunks, and
+        evicted with them, as well as when there are too many.
 
         '''
 
-        chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
-            self._app.status(
-                msg='Unpacking chunk from cache %(filename)s',
-                filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
+        handles = list(handles)
+        chunk_cache = morphlib.util.new_unpacked_chunk_cache(
+            self._app.settings)
+        if (handles and self._app.settings['staging-overlayfs'] and
+                self._overlay_dir is None and
+                not (os.path.exists(self.dirname) and
+                     os.listdir(self.dirname)) and
+                overlayfs_supported(self._app)):
+            if self._stack_artifacts(chunk_cache, handles, ldconfig):
+                return
+        self._link_artifacts(chunk_cache, handles, ldconfig)
+
+    def _template_name(self, handles, method, ldconfig):
+        '''Return the basename of the template for a set of chunks.'''
+
+        if not handles or self._app.settings['staging-templates'] <= 0:
+            return None
+        basenames = [os.path.basename(handle.name) for handle in handles]
+        fingerprint = hashlib.sha1(json.dumps([method, ldconfig, basenames]))
+        return 'template.' + fingerprint.hexdigest()
+
+    def _save_template(self, chunk_cache, template, fill):
+        self._app.status(msg='Keeping staging area as template %(name)s',
+                         name=template, chatty=True)
+        chunk_cache.add(template, fill)
+        chunk_cache.evict_count('template.',
+                                self._app.settings['staging-templates'])
+
+    def _link_artifacts(self, chunk_cache, handles, ldconfig):
+        template = self._template_name(handles, 'hardlink', ldconfig)
+        reference = (chunk_cache.acquire_existing(template)
+                     if template is not None else None)
+        if reference is not None:
             try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException, e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
+                if not os.path.exists(self.dirname):
+                    self._mkdir(self.dirname)
+                chunk_cache.manifest(template).link(
+                    reference.path, self.dirname,
+                    self._app.settings['staging-link-jobs'])
+            finally:
+                reference.release()
+            return
+
+        for handle in handles:
+            self.install_artifact(handle)
+        if ldconfig:
+            morphlib.builder.ldconfig(self._app.runcmd, self.dirname)
+
+        if template is not None:
+            def fill(savedir):
+                manifest = morphlib.linkmanifest.LinkManifest.scan(
+                    self.dirname)
+                manifest.link(self.dirname, savedir,
+                              self._app.settings['staging-link-jobs'])
+                return manifest
+            self._save_template(chunk_cache, template, fill)
+
+    def _stack_artifacts(self, chunk_cache, handles, ldconfig):
+        '''Mount the unpacked chunks as an overlay filesystem.
+
+        Returns False, having done nothing, if the chunks cannot be stacked.
 
-        if not os.path.exists(self.dirname):
-            self._mkdir(self.dirname)
+        '''
 
-        self.hardlink_all_files(unpacked_artifact, self.dirname)
+        # Nothing is written to the staging area without ldconfig.
+        template = (self._template_name(handles, 'overlayfs', ldconfig)
+                    if ldconfig else None)
+        references = []
+        overlay_dir = self.dirname + '.overlay'
+        try:
+            for handle in handles:
+                references.append(
+                    chunk_cache.acquire(handle, status=self._app.status))
+            conflicts = overlay_conflicts(
+                chunk_cache.manifest(os.path.basename(handle.name))
+                for handle in handles)
+            if conflicts or len(references) + 1 > _max_overlay_layers:
+                self._app.status(
+                    msg='Hardlinking staging area: cannot stack '
+                        '%(layers)d chunks with overlayfs%(conflicts)s',
+                    layers=len(references),
+                    conflicts=(', which conflict at %s' % conflicts[0]
+                               if conflicts else ''),
+                    chatty=True)
+                for reference in references:
+                    reference.release()
+                return False
+
+            # Later chunks replace the files of earlier ones, so they go
+            # on top, under the template if there is one.
+            lowerdirs = [reference.path for reference in reversed(references)]
+            from_template = False
+            if template is not None:
+                reference = chunk_cache.acquire_existing(template)
+                if reference is not None:
+                    references.append(reference)
+                    lowerdirs.insert(0, reference.path)
+                    from_template = True
+
+            if not os.path.exists(self.dirname):
+                self._mkdir(self.dirname)
+            os.mkdir(overlay_dir)
+            os.mkdir(os.path.join(overlay_dir, 'upper'))
+            os.mkdir(os.path.join(overlay_dir, 'work'))
+            # Numbered links to the layers keep the options short.
+            layers = []
+            for lowerdir in lowerdirs:
+                layers.append(str(len(layers)))
+                os.symlink(lowerdir, os.path.join(overlay_dir, layers[-1]))
+            _mount_overlay(self._app.runcmd, layers, 'upper', 'work',
+                           self.dirname, overlay_dir)
+        except BaseException:
+            for reference in references:
+                reference.release()
+            if os.path.exists(overlay_dir):
+                shutil.rmtree(overlay_dir)
+            raise
+
+        self._overlay_dir = overlay_dir
+        self._chunk_references = references
+
+        if ldconfig and not from_template:
+            morphlib.builder.ldconfig(self._app.runcmd, self.dirname)
+            if template is not None:
+                def fill(savedir):
+                    self._app.runcmd(['cp', '-a', upper + '/.', savedir])
+                upper = os.path.join(overlay_dir, 'upper')
+                self._save_template(chunk_cache, template, fill)
+        return True
+
+    def _unmount_overlay(self):
+        self._app.runcmd(['umount', self.dirname])
+        for reference in self._chunk_references:
+            reference.release()
+        self._chunk_references = []
 
     def remove(self):
         '''Remove the entire staging area.
@@ -188,6 +365,10 @@ class StagingArea(object):
 
         '''
 
+        if self._overlay_dir is not None:
+            self._unmount_overlay()
+            shutil.rmtree(self._overlay_dir)
+            self._overlay_dir = None
         shutil.rmtree(self.dirname)
 
     to_mount_in_staging = (
@@ -254,6 +435,7 @@ class StagingArea(object):
             del kwargs['extra_env']
 
         ccache_dir = kwargs.pop('ccache_dir', None)
+        jobserver = kwargs.pop('jobserver', None)
 
         chroot_dir = self.dirname if self.use_chroot else '/'
         temp_dir = kwargs["env"].get("TMPDIR", "/tmp")
@@ -281,6 +463,24 @@ class StagingArea(object):
         else:
             binds = ()
 
+        cmd_argv = argv
+        if jobserver:
+            # The jobserver's directory is made visible to the command, so
+            # that it can open the FIFO itself.
+            jobserver_dir = os.path.dirname(jobserver.path)
+            if self.use_chroot:
+                jobserver_target = os.path.join(
+                    self.dirname, temp_dir.lstrip('/'), 'morph-jobserver')
+                if not os.path.isdir(jobserver_target):
+                    os.makedirs(jobserver_target)
+                binds += ((jobserver_dir, jobserver_target),)
+                cmd_argv = jobserver.wrap_command(
+                    argv, os.path.join(temp_dir, 'morph-jobserver',
+                                       os.path.basename(jobserver.path)))
+            else:
+                do_not_mount_dirs.append(jobserver_dir)
+                cmd_argv = jobserver.wrap_command(argv)
+
         container_config=dict(
             cwd=kwargs.pop('cwd', '/'),
             root=chroot_dir,
@@ -290,7 +490,7 @@ class StagingArea(object):
             writable_paths=do_not_mount_dirs)
 
         cmdline = morphlib.util.containerised_cmdline(
-            argv, **container_config)
+            cmd_argv, **container_config)
 
         if kwargs.get('logfile') != None:
             logfile = kwargs.pop('logfile')
@@ -322,6 +522,15 @@ class StagingArea(object):
         #       hook it up here
 
         dest_dir = self._failed_location()
-        os.rename(self.dirname, dest_dir)
+        if self._overlay_dir is not None:
+            # Only what the build changed can be kept, as the chunks are
+            # shared with other staging areas.
+            self._unmount_overlay()
+            os.rename(os.path.join(self._overlay_dir, 'upper'), dest_dir)
+            shutil.rmtree(self._overlay_dir)
+            self._overlay_dir = None
+            os.rmdir(self.dirname)
+        else:
+            os.rename(self.dirname, dest_dir)
         self.dirname = dest_dir
 
@@ -40,14 +40,24 @@ class FakeSource(object):
         self.name = 'le-name'
 
 
+class FakeHandle(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
 class FakeApplication(object):
 
     def __init__(self, cachedir, tempdir):
         self.settings = {
             'cachedir': cachedir,
             'tempdir': tempdir,
+            'chunk-cache-max-size': 0,
+            'staging-link-jobs': 1,
+            'staging-overlayfs': False,
+            'staging-templates': 0,
         }
-        for leaf in ('chunks',):
+        for leaf in ('chunks', 'staging'):
             d = os.path.join(tempdir, leaf)
             if not os.path.exists(d):
                 os.makedirs(d)
@@ -69,28 +79,106 @@ class StagingAreaTests(unittest.TestCase):
         self.cachedir = os.path.join(self.tempdir, 'cachedir')
         os.mkdir(self.cachedir)
         os.mkdir(os.path.join(self.cachedir, 'artifacts'))
-        self.staging = os.path.join(self.tempdir, 'staging')
+        self.staging = os.path.join(self.tempdir, 'staging-area')
         self.created_dirs = []
         self.build_env = FakeBuildEnvironment()
+        self.app = FakeApplication(self.cachedir, self.tempdir)
         self.sa = morphlib.stagingarea.StagingArea(
-            FakeApplication(self.cachedir, self.tempdir), self.staging,
-            self.build_env)
+            self.app, self.staging, self.build_env)
+        self.mounts = []
+        self.upperdirs = {}
+        self.ldconfig_runs = []
+        self.real_mount_overlay = morphlib.stagingarea._mount_overlay
+        self.real_overlayfs_supported = \
+            morphlib.stagingarea._overlayfs_supported
+        self.real_max_overlay_layers = \
+            morphlib.stagingarea._max_overlay_layers
 
     def tearDown(self):
+        morphlib.stagingarea._mount_overlay = self.real_mount_overlay
+        morphlib.stagingarea._overlayfs_supported = \
+            self.real_overlayfs_supported
+        morphlib.stagingarea._max_overlay_layers = \
+            self.real_max_overlay_layers
         shutil.rmtree(self.tempdir)
 
-    def create_chunk(self):
-        chunkdir = os.path.join(self.tempdir, 'chunk')
+    def create_chunk(self, name='chunk.tar', fill=None):
+        chunkdir = os.path.join(self.tempdir, name + '-files')
         os.mkdir(chunkdir)
-        with open(os.path.join(chunkdir, 'file.txt'), 'w'):
-            pass
-        chunk_tar = os.path.join(self.tempdir, 'chunk.tar')
+        if fill is None:
+            open(os.path.join(chunkdir, 'file.txt'), 'w').close()
+        else:
+            fill(chunkdir)
+        chunk_tar = os.path.join(self.tempdir, name)
         tf = tarfile.TarFile(name=chunk_tar, mode='w')
         tf.add(chunkdir, arcname='.')
         tf.close()
 
         return chunk_tar
 
+    def fill_chunk(self, dirname):
+        with open(os.path.join(dirname, 'file.txt'), 'w') as f:
+            f.write('data')
+
+    def fake_overlayfs(self):
+        '''Stage with a fake overlayfs, which copies the lower layers.
+
+        This lets the tests run where overlay filesystems cannot be
+        mounted.
+
+        '''
+
+        def mount_overlay(runcmd, lowerdirs, upperdir, workdir, mountpoint,
+                          cwd):
+            self.mounts.append(mountpoint)
+            self.upperdirs[mountpoint] = os.path.join(cwd, upperdir)
+            for lowerdir in reversed(lowerdirs):
+                cliapp.runcmd(['cp', '-a',
+                               os.path.join(cwd, lowerdir) + '/.',
+                               mountpoint])
+
+        self.app.settings['staging-overlayfs'] = True
+        morphlib.stagingarea._overlayfs_supported = True
+        morphlib.stagingarea._mount_overlay = mount_overlay
+        self.app.runcmd = self.fake_runcmd
+
+    def fake_runcmd(self, argv, **kwargs):
+        '''Run a command, faking umount and ldconfig.
+
+        The fake ldconfig writes its cache to the upper directory of a fake
+        overlay mount too, as the real one would.
+
+        '''
+
+        if argv[0] == 'umount':
+            self.mounts.remove(argv[1])
+            del self.upperdirs[argv[1]]
+            return ''
+        if argv[0] == 'ldconfig':
+            rootdir = argv[2]
+            self.ldconfig_runs.append(rootdir)
+            for dirname in (rootdir, self.upperdirs.get(rootdir)):
+                if dirname is not None:
+                    etc = os.path.join(dirname, 'etc')
+                    if not os.path.exists(etc):
+                        os.mkdir(etc)
+                    with open(os.path.join(etc, 'ld.so.cache'), 'w') as f:
+                        f.write('cache')
+            return ''
+        return cliapp.runcmd(argv, **kwargs)
+
+    def fill_chunk_with_libraries(self, dirname):
+        self.fill_chunk(dirname)
+        os.mkdir(os.path.join(dirname, 'etc'))
+        open(os.path.join(dirname, 'etc', 'ld.so.conf'), 'w').close()
+
+    def unpacked_chunks(self):
+        return [x for x in os.listdir(os.path.join(self.tempdir, 'chunks'))
+                if x.endswith('.d')]
+
+    def evict_chunks(self):
+        morphlib.util.new_unpacked_chunk_cache(self.app.settings).evict(0)
+
     def list_tree(self, root):
         files = []
         for dirname, subdirs, basenames in os.walk(root):
@@ -136,8 +224,201 @@ class StagingAreaTests(unittest.TestCase):
         self.sa.remove()
         self.assertFalse(os.path.exists(self.staging))
 
+    def test_installs_artifacts_by_hardlinking(self):
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+        self.assertEqual(self.sa._overlay_dir, None)
+
+    def test_keeps_template(self):
+        self.app.settings['staging-templates'] = 1
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        chunkdir = os.path.join(self.tempdir, 'chunks')
+        templates = [x for x in os.listdir(chunkdir)
+                     if x.startswith('template.') and x.endswith('.d')]
+        self.assertEqual(len(templates), 1)
+        self.assertEqual(
+            self.list_tree(os.path.join(chunkdir, templates[0])),
+            ['/', '/file.txt'])
+
+    def test_copies_template_of_same_chunks(self):
+        self.app.settings['staging-templates'] = 1
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.sa.remove()
+
+        def fail(handle):
+            raise AssertionError('chunk installed again')
+        self.sa.install_artifact = fail
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+
+    def test_template_names_depend_on_order(self):
+        self.app.settings['staging-templates'] = 1
+        a, b = FakeHandle('a'), FakeHandle('b')
+        self.assertNotEqual(self.sa._template_name([a, b], 'hardlink', True),
+                            self.sa._template_name([b, a], 'hardlink', True))
+        self.assertNotEqual(self.sa._template_name([a], 'hardlink', True),
+                            self.sa._template_name([a], 'hardlink', False))
+
+    def test_installs_artifacts_with_overlayfs(self):
+        self.app.settings['staging-overlayfs'] = True
+        if not morphlib.stagingarea.overlayfs_supported(self.app):
+            raise unittest.SkipTest('cannot mount overlayfs here')
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        try:
+            self.assertTrue(os.path.ismount(self.staging))
+            self.assertEqual(self.list_tree(self.staging),
+                             ['/', '/file.txt'])
+            with open(os.path.join(self.staging, 'file.txt'), 'w') as f:
+                f.write('changed')
+        finally:
+            self.sa.remove()
+        self.assertFalse(os.path.exists(self.staging))
+        unpacked = os.path.join(self.tempdir, 'chunks', 'chunk.tar.d')
+        with open(os.path.join(unpacked, 'file.txt')) as f:
+            self.assertEqual(f.read(), '')
+
+    def test_finds_no_overlay_conflicts_in_merged_directories(self):
+        manifests = [
+            morphlib.linkmanifest.LinkManifest(dirs=['usr', 'usr/lib']),
+            morphlib.linkmanifest.LinkManifest(dirs=['usr', 'usr/lib'],
+                                               files=['usr/lib/libc.so']),
+        ]
+        self.assertEqual(morphlib.stagingarea.overlay_conflicts(manifests),
+                         [])
+
+    def test_finds_overlay_conflicts_with_symlinks(self):
+        manifests = [
+            morphlib.linkmanifest.LinkManifest(
+                dirs=['usr', 'usr/lib'], symlinks=[('lib', 'usr/lib')]),
+            morphlib.linkmanifest.LinkManifest(
+                dirs=['lib'], files=['lib/libc.so']),
+        ]
+        self.assertEqual(morphlib.stagingarea.overlay_conflicts(manifests),
+                         ['lib'])
+
     def test_supports_non_isolated_mode(self):
         sa = morphlib.stagingarea.StagingArea(
             object(), self.staging, self.build_env, use_chroot=False)
         filename = os.path.join(self.staging, 'foobar')
         self.assertEqual(sa.relative(filename), filename)
+
+    def test_stacks_artifacts_with_overlayfs(self):
+        self.fake_overlayfs()
+        chunk_tar = self.create_chunk(fill=self.fill_chunk)
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.assertEqual(self.mounts, [self.staging])
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+        self.evict_chunks()
+        self.assertEqual(self.unpacked_chunks(), ['chunk.tar.d'])
+
+        self.sa.remove()
+        self.assertEqual(self.mounts, [])
+        self.assertFalse(os.path.exists(self.staging))
+        self.assertFalse(os.path.exists(self.staging + '.overlay'))
+        self.evict_chunks()
+        self.assertEqual(self.unpacked_chunks(), [])
+
+    def test_hardlinks_artifacts_which_conflict_with_overlayfs(self):
+        self.fake_overlayfs()
+
+        def fill_a(dirname):
+            os.makedirs(os.path.join(dirname, 'usr', 'lib'))
+            os.symlink('usr/lib', os.path.join(dirname, 'lib'))
+
+        def fill_b(dirname):
+            os.mkdir(os.path.join(dirname, 'lib'))
+            open(os.path.join(dirname, 'lib', 'libc.so'), 'w').close()
+
+        a = self.create_chunk('a.tar', fill_a)
+        b = self.create_chunk('b.tar', fill_b)
+        with open(a, 'rb') as f, open(b, 'rb') as g:
+            self.sa.install_artifacts([f, g])
+        self.assertEqual(self.mounts, [])
+        self.assertEqual(self.sa._overlay_dir, None)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.staging, 'usr', 'lib', 'libc.so')))
+
+    def test_finds_overlay_conflicts_in_any_iterable(self):
+        manifests = [
+            morphlib.linkmanifest.LinkManifest(symlinks=[('lib', 'usr')]),
+            morphlib.linkmanifest.LinkManifest(dirs=['lib']),
+        ]
+        self.assertEqual(
+            morphlib.stagingarea.overlay_conflicts(iter(manifests)), ['lib'])
+
+    def test_hardlinks_artifacts_beyond_overlayfs_layer_limit(self):
+        self.fake_overlayfs()
+        morphlib.stagingarea._max_overlay_layers = 1
+        chunk_tar = self.create_chunk()
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f])
+        self.assertEqual(self.mounts, [])
+        self.assertEqual(self.list_tree(self.staging), ['/', '/file.txt'])
+
+    def test_cleans_up_if_overlayfs_mount_fails(self):
+        self.fake_overlayfs()
+
+        def fail(*args):
+            raise cliapp.AppException('mount failed')
+
+        morphlib.stagingarea._mount_overlay = fail
+        chunk_tar = self.create_chunk(fill=self.fill_chunk)
+        with open(chunk_tar, 'rb') as f:
+            self.assertRaises(cliapp.AppException,
+                              self.sa.install_artifacts, [f])
+        self.assertFalse(os.path.exists(self.staging + '.overlay'))
+        self.assertEqual(self.sa._overlay_dir, None)
+        self.evict_chunks()
+        self.assertEqual(self.unpacked_chunks(), [])
+
+    def test_runs_ldconfig_after_hardlinking(self):
+        self.app.runcmd = self.fake_runcmd
+        chunk_tar = self.create_chunk(fill=self.fill_chunk_with_libraries)
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f], ldconfig=True)
+        self.assertEqual(self.ldconfig_runs, [self.staging])
+        self.assertEqual(self.list_tree(self.staging),
+                         ['/', '/file.txt', '/etc', '/etc/ld.so.cache',
+                          '/etc/ld.so.conf'])
+
+    def test_keeps_what_ldconfig_wrote_as_overlayfs_template(self):
+        self.fake_overlayfs()
+        self.app.settings['staging-templates'] = 1
+        chunk_tar = self.create_chunk(fill=self.fill_chunk_with_libraries)
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifacts([f], ldconfig=True)
+        self.sa.remove()
+        self.assertEqual(self.ldconfig_runs, [self.staging])
+        templates = [x for x in self.unpacked_chunks()
+                     if x.startswith('template.')]
+        self.assertEqual(len(templates), 1)
+        self.assertEqual(
+            self.list_tree(os.path.join(self.tempdir, 'chunks',
+                                        templates[0])),
+            ['/', '/etc', '/etc/ld.so.cache'])
+
+        sa = morphlib.stagingarea.StagingArea(
+            self.app, self.staging, self.build_env)
+        with open(chunk_tar, 'rb') as f:
+            sa.install_artifacts([f], ldconfig=True)
+        try:
+            self.assertEqual(self.ldconfig_runs, [self.staging])
+            self.assertEqual(self.list_tree(self.staging),
+                             ['/', '/file.txt', '/etc', '/etc/ld.so.cache',
+                              '/etc/ld.so.conf'])
+            self.evict_chunks()
+            self.assertEqual(len(self.unpacked_chunks()), 2)
+        finally:
+            sa.remove()
+        self.evict_chunks()
+        self.assertEqual(self.unpacked_chunks(), [])
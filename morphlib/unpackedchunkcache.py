@@ -0,0 +1,107 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import os
+
+import morphlib
+
+
+class UnpackedChunkCache(morphlib.directorycache.DirectoryCache):
+
+    '''Chunk artifacts unpacked into directories, for staging areas.
+
+    Each chunk is unpacked into `DIRNAME/BASENAME.d`, where BASENAME is
+    the name of the artifact in the artifact cache. The chunks are shared
+    between processes, and the least recently used are removed to keep
+    within `max_size` bytes, as described for DirectoryCache.
+
+    The LinkManifest of each chunk is kept in `BASENAME.d.manifest`, so
+    that staging areas can be populated without examining the chunk.
+
+    Other directories for staging areas, such as the templates kept by
+    StagingArea, can be added to the cache, under basenames of their own.
+    The function filling them in may return their LinkManifest, to save
+    scanning them again.
+
+    '''
+
+    side_files = ('.size', '.manifest', '.lock')
+
+    def acquire(self, handle, status=None):
+        '''Unpack a chunk if needed, and return a reference to it.
+
+        `handle` is an open file of the chunk artifact. The directory the
+        chunk is in, given by the `path` attribute of the reference, is not
+        removed until the reference's release method is called.
+
+        '''
+
+        basename = os.path.basename(handle.name)
+
+        def unpack(savedir):
+            if status is not None:
+                status(msg='Unpacking chunk from cache %(filename)s',
+                       filename=basename)
+            morphlib.bins.unpack_binary_from_file(handle, savedir + '/')
+
+        return self._acquire(basename, unpack)
+
+    @contextlib.contextmanager
+    def use(self, handle, status=None):
+        '''Unpack a chunk if needed, and yield the directory it is in.
+
+        `handle` is an open file of the chunk artifact. The directory may
+        not be removed until the with statement ends.
+
+        '''
+
+        reference = self.acquire(handle, status)
+        try:
+            yield reference.path
+        finally:
+            reference.release()
+
+    def prepare(self, handle, status=None):
+        '''Unpack a chunk now, so that it is ready when it is used.'''
+
+        with self.use(handle, status):
+            pass
+
+    def _created(self, basename, dirname, manifest):
+        self._save_manifest(basename, dirname, manifest)
+
+    def _save_manifest(self, basename, dirname, manifest=None):
+        if manifest is None:
+            manifest = morphlib.linkmanifest.LinkManifest.scan(dirname)
+        with morphlib.savefile.SaveFile(
+                self._path(basename, '.manifest'), 'w') as f:
+            manifest.save(f)
+        return manifest
+
+    def manifest(self, basename):
+        '''Return the LinkManifest of an unpacked chunk.
+
+        This must only be called while the chunk is in use.
+
+        '''
+
+        try:
+            with open(self._path(basename, '.manifest')) as f:
+                return morphlib.linkmanifest.LinkManifest.load(f)
+        except (IOError, ValueError):
+            # Chunks unpacked by earlier versions have no manifest.
+            return self._save_manifest(basename, self._path(basename))
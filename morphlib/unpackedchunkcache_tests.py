@@ -0,0 +1,220 @@
+# Copyright (C) 2015  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.cachedir)
+        self.cache = morphlib.unpackedchunkcache.UnpackedChunkCache(
+            self.cachedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, name, size):
+        chunkdir = os.path.join(self.tempdir, name + '-files')
+        os.mkdir(chunkdir)
+        with open(os.path.join(chunkdir, 'file.txt'), 'w') as f:
+            f.write('x' * size)
+        chunk_tar = os.path.join(self.tempdir, name)
+        with tarfile.TarFile(name=chunk_tar, mode='w') as tf:
+            tf.add(chunkdir, arcname='.')
+        return chunk_tar
+
+    def use(self, chunk_tar):
+        with open(chunk_tar) as f:
+            with self.cache.use(f) as unpacked:
+                return unpacked
+
+    def test_unpacks_chunk(self):
+        unpacked = self.use(self.create_chunk('a', 10))
+        with open(os.path.join(unpacked, 'file.txt')) as f:
+            self.assertEqual(f.read(), 'x' * 10)
+
+    def test_unpacks_chunk_only_once(self):
+        chunk_tar = self.create_chunk('a', 10)
+        unpacked = self.use(chunk_tar)
+        marker = os.path.join(unpacked, 'marker')
+        open(marker, 'w').close()
+        self.use(chunk_tar)
+        self.assertTrue(os.path.exists(marker))
+
+    def test_leaves_no_temporary_directories(self):
+        self.use(self.create_chunk('a', 10))
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         ['a.d', 'a.d.lock', 'a.d.manifest', 'a.d.size'])
+
+    def test_removes_its_own_copy_if_another_process_won(self):
+        chunk_tar = self.create_chunk('a', 10)
+        real_unpack = morphlib.bins.unpack_binary_from_file
+
+        def unpack_racing(handle, dirname):
+            real_unpack(handle, dirname)
+            os.mkdir(os.path.join(self.cachedir, 'a.d'))
+            open(os.path.join(self.cachedir, 'a.d', 'winner'), 'w').close()
+
+        morphlib.bins.unpack_binary_from_file = unpack_racing
+        try:
+            unpacked = self.use(chunk_tar)
+        finally:
+            morphlib.bins.unpack_binary_from_file = real_unpack
+        self.assertEqual(os.listdir(unpacked), ['winner'])
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         ['a.d', 'a.d.lock', 'a.d.manifest', 'a.d.size'])
+
+    def test_records_size(self):
+        self.use(self.create_chunk('a', 1000))
+        (basename, size, last_used), = self.cache.contents()
+        self.assertEqual(basename, 'a')
+        self.assertTrue(size >= 1000)
+
+    def test_counts_hardlinked_files_once(self):
+        chunk_tar = self.create_chunk('a', 1000)
+        with tarfile.TarFile(name=chunk_tar, mode='a') as tf:
+            info = tarfile.TarInfo('./link.txt')
+            info.type = tarfile.LNKTYPE
+            info.linkname = './file.txt'
+            tf.addfile(info)
+        unpacked = self.use(chunk_tar)
+        self.assertEqual(os.stat(os.path.join(unpacked, 'link.txt')).st_nlink,
+                         2)
+        (basename, size, last_used), = self.cache.contents()
+        self.assertTrue(1000 <= size < 2000)
+
+    def test_reports_unpacking(self):
+        messages = []
+
+        def status(**kwargs):
+            messages.append(kwargs['msg'] % kwargs)
+
+        chunk_tar = self.create_chunk('a', 10)
+        with open(chunk_tar) as f:
+            self.cache.prepare(f, status=status)
+            self.cache.prepare(f, status=status)
+        self.assertEqual(messages, ['Unpacking chunk from cache a'])
+
+    def test_evicts_least_recently_used(self):
+        a = self.create_chunk('a', 1000)
+        b = self.create_chunk('b', 1000)
+        self.use(a)
+        self.use(b)
+        os.utime(os.path.join(self.cachedir, 'a.d.lock'), (1, 1))
+        self.cache.evict(1500)
+        self.assertEqual([c[0] for c in self.cache.contents()], ['b'])
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         ['b.d', 'b.d.lock', 'b.d.manifest', 'b.d.size'])
+
+    def test_keeps_chunks_in_use(self):
+        a = self.create_chunk('a', 1000)
+        with open(a) as f:
+            with self.cache.use(f) as unpacked:
+                self.cache.evict(0)
+                self.assertTrue(os.path.exists(unpacked))
+        self.cache.evict(0)
+        self.assertFalse(os.path.exists(unpacked))
+
+    def test_keeps_acquired_chunks_until_released(self):
+        a = self.create_chunk('a', 1000)
+        with open(a) as f:
+            reference = self.cache.acquire(f)
+        self.cache.evict(0)
+        self.assertTrue(os.path.exists(reference.path))
+        reference.release()
+        reference.release()
+        self.cache.evict(0)
+        self.assertFalse(os.path.exists(reference.path))
+
+    def test_adds_directories(self):
+        def fill(savedir):
+            open(os.path.join(savedir, 'f'), 'w').close()
+        self.cache.add('template.x', fill)
+        reference = self.cache.acquire_existing('template.x')
+        self.assertEqual(os.listdir(reference.path), ['f'])
+        self.assertEqual(self.cache.manifest('template.x').files, ['f'])
+        reference.release()
+
+    def test_finds_no_missing_directories(self):
+        self.assertEqual(self.cache.acquire_existing('template.x'), None)
+
+    def test_evicts_beyond_count(self):
+        for name, when in (('template.a', 3), ('template.b', 1),
+                           ('template.c', 2)):
+            self.cache.add(name, lambda savedir: None)
+            os.utime(os.path.join(self.cachedir, name + '.d.lock'),
+                     (when, when))
+        self.use(self.create_chunk('a', 10))
+        self.cache.evict_count('template.', 2)
+        self.assertEqual(sorted(x[0] for x in self.cache.contents()),
+                         ['a', 'template.a', 'template.c'])
+
+    def test_evicts_after_unpacking_beyond_max_size(self):
+        self.cache.max_size = 1500
+        a = self.create_chunk('a', 1000)
+        b = self.create_chunk('b', 1000)
+        self.use(a)
+        os.utime(os.path.join(self.cachedir, 'a.d.lock'), (1, 1))
+        self.use(b)
+        self.assertEqual([c[0] for c in self.cache.contents()], ['b'])
+
+    def test_unpacks_again_after_eviction(self):
+        a = self.create_chunk('a', 10)
+        self.use(a)
+        self.cache.evict(0)
+        unpacked = self.use(a)
+        self.assertEqual(os.listdir(unpacked), ['file.txt'])
+
+    def test_counts_chunks_unpacked_by_older_versions(self):
+        os.mkdir(os.path.join(self.cachedir, 'old.d'))
+        with open(os.path.join(self.cachedir, 'old.d', 'f'), 'w') as f:
+            f.write('x' * 100)
+        (basename, size, last_used), = self.cache.contents()
+        self.assertEqual(basename, 'old')
+        self.assertEqual(size, 100)
+        self.cache.evict(0)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_keeps_manifest(self):
+        with open(self.create_chunk('a', 10)) as f:
+            with self.cache.use(f):
+                manifest = self.cache.manifest('a')
+        self.assertEqual(manifest.files, ['file.txt'])
+
+    def test_creates_manifest_for_chunks_unpacked_by_older_versions(self):
+        os.mkdir(os.path.join(self.cachedir, 'old.d'))
+        open(os.path.join(self.cachedir, 'old.d', 'f'), 'w').close()
+        self.assertEqual(self.cache.manifest('old').files, ['f'])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cachedir, 'old.d.manifest')))
+
+    def test_prepares_chunk_for_later_use(self):
+        chunk_tar = self.create_chunk('a', 10)
+        with open(chunk_tar) as f:
+            self.cache.prepare(f)
+        self.assertEqual(os.listdir(os.path.join(self.cachedir, 'a.d')),
+                         ['file.txt'])
+        self.cache.evict(0)
+        self.assertEqual(os.listdir(self.cachedir), [])
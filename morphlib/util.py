@@ -15,6 +15,7 @@
 
 import contextlib
 import itertools
+import multiprocessing.pool
 import os
 import pipes
 import re
@@ -121,28 +122,101 @@ def get_git_resolve_cache_server(settings): # pragma: no cover
     return None
 
 
-def new_artifact_caches(settings):  # pragma: no cover
-    '''Create new objects for local and remote artifact caches.
+def new_local_artifact_cache(cachedir):  # pragma: no cover
+    '''Create a new object for the local artifact cache in `cachedir`.
 
-    This includes creating the directories on disk, if missing.
+    The artifacts are kept in the `artifacts` subdirectory, which is
+    created if missing, and their index in `artifacts.index`.
 
     '''
 
-    cachedir = create_cachedir(settings)
     artifact_cachedir = os.path.join(cachedir, 'artifacts')
     if not os.path.exists(artifact_cachedir):
         os.mkdir(artifact_cachedir)
 
-    lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(artifact_cachedir))
+    return morphlib.localartifactcache.LocalArtifactCache(
+        fs.osfs.OSFS(artifact_cachedir),
+        os.path.join(cachedir, 'artifacts.index'))
+
+
+def new_artifact_caches(settings):  # pragma: no cover
+    '''Create new objects for local and remote artifact caches.
+
+    This includes creating the directories on disk, if missing.
+
+    '''
+
+    cachedir = create_cachedir(settings)
+    lac = new_local_artifact_cache(cachedir)
 
     rac_url = get_artifact_cache_server(settings)
     rac = None
     if rac_url:
-        rac = morphlib.remoteartifactcache.RemoteArtifactCache(rac_url)
+        rac = morphlib.remoteartifactcache.RemoteArtifactCache(
+            rac_url, settings['artifact-download-jobs'])
     return lac, rac
 
 
+def new_unpacked_chunk_cache(settings):  # pragma: no cover
+    '''Create a new object for the unpacked chunks in the tempdir.'''
+
+    return morphlib.unpackedchunkcache.UnpackedChunkCache(
+        os.path.join(settings['tempdir'], 'chunks'),
+        settings['chunk-cache-max-size'])
+
+
+def new_source_tree_cache(settings):  # pragma: no cover
+    '''Create a new object for the extracted sources in the tempdir.
+
+    Returns None if the cache is disabled.
+
+    '''
+
+    if settings['source-cache-max-size'] <= 0:
+        return None
+    return morphlib.sourcetreecache.SourceTreeCache(
+        os.path.join(settings['tempdir'], 'sources'),
+        settings['source-cache-max-size'])
+
+
+def new_morphology_cache(settings):  # pragma: no cover
+    '''Create a new object for the parsed morphology cache.'''
+
+    cachedir = create_cachedir(settings)
+    return morphlib.morphologycache.MorphologyCache(
+        os.path.join(cachedir, 'morphologies'),
+        settings['morphology-cache-max-size'])
+
+
+def new_build_graph_cache(settings):  # pragma: no cover
+    '''Create a new object for the resolved build graph cache.'''
+
+    cachedir = create_cachedir(settings)
+    return morphlib.buildgraphcache.BuildGraphCache(
+        os.path.join(cachedir, 'build-graphs'),
+        settings['build-graph-cache-max-size'])
+
+
+def new_source_pool_snapshot(settings):  # pragma: no cover
+    '''Create a new object for the source pool snapshots.'''
+
+    cachedir = create_cachedir(settings)
+    return morphlib.sourcepoolsnapshot.SourcePoolSnapshot(
+        os.path.join(cachedir, 'source-pools'))
+
+
+def new_ref_cache(settings):  # pragma: no cover
+    '''Create a new object for the resolved ref cache.'''
+
+    cachedir = create_cachedir(settings)
+    build_ref_prefix = settings['build-ref-prefix']
+    return morphlib.refcache.RefCache(
+        os.path.join(cachedir, 'refs.json'),
+        settings['ref-cache-ttl'],
+        refresh=settings['ref-cache-refresh'],
+        volatile_prefixes=[build_ref_prefix] if build_ref_prefix else [])
+
+
 def combine_aliases(app):  # pragma: no cover
     '''Create a full repo-alias set from the app's settings.
 
@@ -510,6 +584,43 @@ def iter_trickle(iterable, limit):
         yield buf
 
 
+def map_concurrently(function, items, max_workers):
+    '''Call `function` on each item, using up to `max_workers` threads.
+
+    Returns a list of the results, in the same order as `items`. If any of
+    the calls raised an exception, the exception from the earliest item is
+    re-raised once all the calls have finished, so errors are reported
+    the same way regardless of the order the threads finish in.
+
+    With `max_workers` of 1 or less, everything runs in the calling thread.
+
+    '''
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    def call(item):
+        try:
+            return True, function(item)
+        except BaseException:
+            return False, sys.exc_info()
+
+    pool = multiprocessing.pool.ThreadPool(min(max_workers, len(items)))
+    try:
+        # A timeout is given so that the wait can be interrupted with ^C.
+        outcomes = pool.map_async(call, items).get(sys.maxint)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    results = []
+    for ok, value in outcomes:
+        if not ok:
+            raise value[0], value[1], value[2]
+        results.append(value)
+    return results
+
+
 def get_data_path(relative_path): # pragma: no cover
     '''Return path to a data file in the morphlib Python package.
 
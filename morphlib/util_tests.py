@@ -17,6 +17,7 @@
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 
 import morphlib
@@ -136,3 +137,25 @@ class IterTrickleTests(unittest.TestCase):
     def test_truncated_final_sequence(self):
         self.assertEqual(list(morphlib.util.iter_trickle("barquux", 3)),
                          [["b", "a", "r"], ["q", "u", "u"], ["x"]])
+
+
+class MapConcurrentlyTests(unittest.TestCase):
+
+    def test_returns_results_in_order(self):
+        self.assertEqual(
+            morphlib.util.map_concurrently(lambda x: x * 2, range(20), 4),
+            [x * 2 for x in range(20)])
+
+    def test_runs_in_calling_thread_with_one_worker(self):
+        threads = morphlib.util.map_concurrently(
+            lambda x: threading.current_thread(), range(3), 1)
+        self.assertEqual(threads, [threading.current_thread()] * 3)
+
+    def test_raises_error_of_earliest_failing_item(self):
+        def fail_on_odd(x):
+            if x % 2:
+                raise ValueError(x)
+            return x
+        with self.assertRaises(ValueError) as cm:
+            morphlib.util.map_concurrently(fail_on_odd, range(10), 4)
+        self.assertEqual(cm.exception.args, (1,))